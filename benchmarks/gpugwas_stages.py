@@ -0,0 +1,277 @@
+"""
+Per-stage benchmark of the gpugwas pipeline on synthetic data.
+
+Generates a synthetic VCF and annotation file (see synthetic.py), times
+every pipeline stage on the CPU (numpy) backend and, when CuPy and a GPU
+are available, the GPU (cupy) backend, and checks association p-values
+against a per-variant least-squares reference. The association stage is
+runner.run_gwas as the pipeline calls it, including block scheduling and
+result frame assembly. With --history the results are appended as one JSON
+line per run to that file, flagging stages that got slower than the
+previous run with the same parameters.
+
+Example:
+    python benchmarks/gpugwas_stages.py --samples 2000 --variants 50000 --backend all --history ./temp/history.jsonl
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+from gpugwas.backend import gpu_available, set_backend  # noqa: E402
+
+
+PHENOTYPE = "CaffeineConsumption"
+STAGES = ["parse", "filter", "matrix", "pca", "association", "plot"]
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def _to_numpy(values):
+    if hasattr(values, "to_pandas"):
+        values = values.to_pandas()
+    values = getattr(values, "values", values)
+    if hasattr(values, "get"):
+        values = values.get()
+    return np.asarray(values, dtype=np.float64)
+
+
+def _timed(timings, name, func, *args, repeat=1):
+    """Run func `repeat` times, keep the best wall time and the last result."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    timings[name] = best
+    return result
+
+
+def stage_parse(vcf_path):
+    import gpugwas.io as gwasio
+
+    return gwasio.load_genotypes(vcf_path, info_keys=["AF"], format_keys=["GT", "DP", "AD"], allele_balance=True)
+
+
+def stage_filter(data):
+    """Same QC as benchmarks/hail_cpu.py (allele balance is applied by stage_parse)."""
+    import gpugwas.filter as gwasfilter
+
+    data = gwasfilter.filter_samples(data, min_dp_mean=4, min_call_rate=0.97)
+    return gwasfilter.filter_variant_qc(data, min_af=0.01, min_p_hwe=1e-6)
+
+
+def stage_matrix(data, ann_df):
+    import gpugwas.dataprep as dp
+
+    return dp.create_phenotype_matrix(data, ann_df, [PHENOTYPE])
+
+
+def stage_pca(backend, genotypes, n_components=2):
+    """(n_samples, n_components) PC scores as a host array."""
+    from gpugwas.backend import to_host
+    from gpugwas.pca import genotype_pca
+
+    return to_host(genotype_pca(genotypes, n_components, backend=backend))
+
+
+def stage_association(phenotypes_df, covariate_cols, genotypes, feature_ids, variants):
+    """Results frame of run_gwas with the principal components as covariates."""
+    from gpugwas.association import LinearAssociation
+    from gpugwas.runner import run_gwas
+
+    return run_gwas(phenotypes_df, PHENOTYPE, feature_ids, LinearAssociation, add_cols=covariate_cols,
+                    genotypes=genotypes, variants=variants)
+
+
+def _neglog10_p_by_column(results, feature_ids):
+    """-log10 p of every genotype matrix column (NaN for untested variants)."""
+    import pandas as pd
+
+    results = results.to_pandas() if hasattr(results, "to_pandas") else results
+    out = np.full(len(feature_ids), np.nan)
+    out[pd.Index(feature_ids).get_indexer(results["feature"].values)] = results["neglog10_p_value"].values
+    return out
+
+
+def stage_plot(results, out_dir):
+    """Static Manhattan and Q-Q PNGs, as rendered on headless nodes."""
+    from gpugwas import vizstatic
+
+    results = results.to_pandas() if hasattr(results, "to_pandas") else results
+    return [
+        vizstatic.manhattan_plot(results, os.path.join(out_dir, "manhattan.png")),
+        vizstatic.qq_plot(results, os.path.join(out_dir, "qq.png")),
+    ]
+
+
+def reference_neglog10_p(y, covariates, genotypes, n_check=200):
+    """-log10 p of a per-variant least-squares fit for up to n_check variants."""
+    n_variants = genotypes.n_variants
+    check = np.unique(np.linspace(0, n_variants - 1, min(n_check, n_variants)).astype(int))
+    g = genotypes.to_float(check, dtype=np.float64)
+    base = np.ones((len(y), 1))
+    if covariates is not None:
+        base = np.column_stack([base, covariates])
+    out = np.full(len(check), np.nan)
+    for i in range(len(check)):
+        X = np.column_stack([base, g[:, i]])
+        beta, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+        if rank < X.shape[1]:
+            continue
+        dof = len(y) - X.shape[1]
+        sigma2 = ((y - X @ beta) ** 2).sum() / dof
+        se = np.sqrt(sigma2 * np.linalg.inv(X.T @ X)[-1, -1])
+        out[i] = -stats.t.logsf(abs(beta[-1] / se), dof) / np.log(10) - np.log10(2)
+    return check, out
+
+
+def run_backend(backend, vcf_path, ann_path, repeat=1):
+    import pandas as pd
+
+    set_backend(backend)
+    timings = {}
+    data = _timed(timings, "parse", stage_parse, vcf_path, repeat=repeat)
+    data = _timed(timings, "filter", stage_filter, data, repeat=repeat)
+    ann_df = pd.read_csv(ann_path, sep="\t")
+    phenotypes_df, genotypes, feature_ids = _timed(timings, "matrix", stage_matrix, data, ann_df, repeat=repeat)
+    y = _to_numpy(phenotypes_df[PHENOTYPE])
+
+    covariates = _timed(timings, "pca", stage_pca, backend, genotypes, repeat=repeat)
+    covariate_cols = [f"PC{i}" for i in range(covariates.shape[1])]
+    for i, col in enumerate(covariate_cols):
+        phenotypes_df[col] = covariates[:, i]
+
+    results = _timed(timings, "association", stage_association, phenotypes_df, covariate_cols, genotypes,
+                     _to_numpy(feature_ids).astype(np.int64), data.variants, repeat=repeat)
+    _timed(timings, "plot", stage_plot, results, os.path.dirname(os.path.abspath(vcf_path)), repeat=repeat)
+    neglog10_p = _neglog10_p_by_column(results, _to_numpy(feature_ids).astype(np.int64))
+
+    check, reference = reference_neglog10_p(y, covariates, genotypes)
+    valid = np.isfinite(reference) & np.isfinite(neglog10_p[check])
+    diff = np.abs(neglog10_p[check][valid] - reference[valid])
+    agreement = {
+        "n_checked": int(valid.sum()),
+        "max_abs_diff_neglog10_p": float(diff.max()) if diff.size else None,
+        "max_rel_diff_neglog10_p": float((diff / np.maximum(reference[valid], 1.0)).max()) if diff.size else None,
+    }
+    shape = {"samples_after_qc": int(genotypes.n_samples), "variants_after_qc": int(genotypes.n_variants)}
+    return timings, agreement, shape
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_with_history(history, record, slowdown=1.2, min_seconds=0.05):
+    """
+    Print per-stage ratios against the last run with the same parameters and
+    backend, flagging stages over `slowdown` (stages faster than `min_seconds`
+    are too noisy to flag).
+    """
+    previous = [
+        r for r in history
+        if r["params"] == record["params"] and r["backend"] == record["backend"]
+    ]
+    if not previous:
+        print(f"[{record['backend']}] no previous run with these parameters")
+        return []
+    last = previous[-1]
+    regressions = []
+    for stage in STAGES:
+        old, new = last["timings"].get(stage), record["timings"].get(stage)
+        if not old or not new:
+            continue
+        ratio = new / old
+        flag = "  <-- REGRESSION" if ratio > slowdown and new > min_seconds else ""
+        if flag:
+            regressions.append(stage)
+        print(f"[{record['backend']}] {stage:12s} {old:9.3f}s -> {new:9.3f}s ({ratio:.2f}x){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gpugwas stages on synthetic data')
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--variants', type=int, default=10000)
+    parser.add_argument('--missing', type=float, default=0.01, help='Fraction of missing calls')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='all', choices=['cpu', 'gpu', 'all'])
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per stage, the fastest is kept')
+    parser.add_argument('--workdir', default='./temp/')
+    parser.add_argument('--history', default=None,
+                        help='JSON lines file to append the results to and compare them with')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='Max relative -log10(p) difference to the reference')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    prefix = os.path.join(args.workdir, f"synthetic_{args.samples}x{args.variants}_{args.missing}_{args.seed}")
+    if os.path.exists(prefix + ".vcf") and os.path.exists(prefix + "_annotations.txt"):
+        vcf_path, ann_path = prefix + ".vcf", prefix + "_annotations.txt"
+    else:
+        vcf_path, ann_path, _ = synthetic.generate(prefix, args.samples, args.variants, args.missing, seed=args.seed)
+
+    backends = {"cpu": ["numpy"], "gpu": ["cupy"], "all": ["numpy", "cupy"]}[args.backend]
+    if "cupy" in backends and not gpu_available():
+        print("No GPU available, skipping the cupy backend")
+        backends.remove("cupy")
+
+    history = load_history(args.history) if args.history else []
+    params = {"samples": args.samples, "variants": args.variants, "missing": args.missing, "seed": args.seed}
+    failed = False
+    for backend in backends:
+        timings, agreement, shape = run_backend(backend, vcf_path, ann_path, repeat=args.repeat)
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "backend": backend,
+            "params": params,
+            "shape": shape,
+            "timings": timings,
+            "agreement": agreement,
+        }
+        for stage in STAGES:
+            value = timings.get(stage)
+            print(f"[{backend}] {stage:12s} " + ("skipped" if value is None else f"{value:9.3f}s"))
+        print(f"[{backend}] p-value agreement: {agreement}")
+        if args.history:
+            compare_with_history(history, record)
+            with open(args.history, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        rel = agreement["max_rel_diff_neglog10_p"]
+        if rel is None or rel > args.tolerance:
+            print(f"[{backend}] p-values disagree with the reference (tolerance {args.tolerance})")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
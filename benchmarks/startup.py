@@ -0,0 +1,131 @@
+"""
+Startup-time benchmark of the gpugwas package.
+
+Imports `gpugwas` and every pipeline module in a fresh interpreter, and
+runs `python -m gpugwas --help` and `workflow.py --help`, keeping the best
+wall time of `--repeat` runs. Fails (exit status 1) when a time exceeds its budget, or when importing a
+module loads a heavy dependency that should only be imported on first use
+(cuDF/CuPy/cuML, scipy.stats, matplotlib, Bokeh, Dash/Plotly).
+
+Example:
+    python benchmarks/startup.py --repeat 5 --import-budget 1.0 --help-budget 2.0
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "gpugwas",
+    "gpugwas.backend",
+    "gpugwas.io",
+    "gpugwas.filter",
+    "gpugwas.dataprep",
+    "gpugwas.association",
+    "gpugwas.algorithms",
+    "gpugwas.pca",
+    "gpugwas.ld",
+    "gpugwas.runner",
+    "gpugwas.results",
+    "gpugwas.store",
+    "gpugwas.cli",
+    "gpugwas.vizprep",
+    "gpugwas.vizstatic",
+    "gpugwas.vizb",
+    "gpugwas.viz",
+]
+
+LAZY = ["cudf", "cupy", "cuml", "rmm", "scipy.stats", "matplotlib", "bokeh", "dash", "plotly"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT] + [p for p in [env.get("PYTHONPATH")] if p])
+    return env
+
+
+def time_import(module, repeat=3):
+    """Best import time of `module` in a fresh interpreter and the lazy dependencies it loaded."""
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, lazy=LAZY)],
+            env=_env(), cwd=ROOT, capture_output=True, text=True,
+        )
+        if out.returncode != 0:
+            return None, [out.stderr.strip().splitlines()[-1]]
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        best = result["seconds"] if best is None else min(best, result["seconds"])
+        loaded = result["loaded"]
+    return best, loaded
+
+
+def time_command(command, repeat=3):
+    """Best wall time of a command, including interpreter startup."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=_env(), cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup-time benchmark of gpugwas")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--import-budget", type=float, default=1.0, help="Seconds allowed per module import")
+    parser.add_argument("--help-budget", type=float, default=2.0, help="Seconds allowed for a --help invocation")
+    args = parser.parse_args(argv)
+
+    failures = []
+    for module in MODULES:
+        seconds, loaded = time_import(module, args.repeat)
+        if seconds is None:
+            print(f"{module:26s}   failed: {loaded[0]}")
+            failures.append(module)
+            continue
+        flags = []
+        if seconds > args.import_budget:
+            flags.append("OVER BUDGET")
+        if loaded:
+            flags.append("eagerly imports " + ", ".join(loaded))
+        print(f"{module:26s} {seconds:8.3f}s  {'  '.join(flags)}")
+        if flags:
+            failures.append(module)
+
+    commands = {
+        "python -m gpugwas --help": [sys.executable, "-m", "gpugwas", "--help"],
+        "workflow.py --help": [sys.executable, os.path.join(ROOT, "workflow.py"), "--help"],
+    }
+    for name, command in commands.items():
+        seconds = time_command(command, args.repeat)
+        over = seconds > args.help_budget
+        print(f"{name:26s} {seconds:8.3f}s  {'OVER BUDGET' if over else ''}")
+        if over:
+            failures.append(name)
+
+    if failures:
+        print("Startup regressions: " + ", ".join(failures))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
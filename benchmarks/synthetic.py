@@ -0,0 +1,143 @@
+"""
+Synthetic VCF and annotation generator for benchmarks.
+
+Genotypes are drawn for two populations with diverged allele frequencies
+(Balding-Nichols model) so PCA has structure to find, and the phenotypes
+in the annotation file depend on a few causal variants so association
+results have true hits.
+
+Example:
+    python benchmarks/synthetic.py --samples 1000 --variants 20000 --out ./temp/synth
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+
+_BASES = np.array(["A", "C", "G", "T"])
+_MAX_DP = 40
+
+
+def _call_strings():
+    """Lookup table of "GT:DP:AD" strings indexed by dosage code * (_MAX_DP + 1) + DP."""
+    gts = ["0/0", "0/1", "1/1", "./."]
+    table = []
+    for code, gt in enumerate(gts):
+        for dp in range(_MAX_DP + 1):
+            if code == 3:
+                table.append("./.:.:.,.")
+                continue
+            alt = int(round(dp * code / 2.0))
+            table.append(f"{gt}:{dp}:{dp - alt},{alt}")
+    return np.array(table)
+
+
+def simulate_genotypes(n_samples, n_variants, missing_rate=0.01, fst=0.1, seed=0):
+    """
+    Return (dosage, populations, allele_freqs): an int8 (n_samples, n_variants)
+    dosage matrix with -1 for missing calls, the population of every sample
+    and the ancestral allele frequencies.
+    """
+    rng = np.random.default_rng(seed)
+    populations = rng.integers(0, 2, size=n_samples)
+    freqs = rng.uniform(0.02, 0.5, size=n_variants)
+    a = freqs * (1 - fst) / fst
+    b = (1 - freqs) * (1 - fst) / fst
+    pop_freqs = rng.beta(a, b, size=(2, n_variants))
+    dosage = rng.binomial(2, pop_freqs[populations]).astype(np.int8)
+    dosage[rng.random(dosage.shape) < missing_rate] = -1
+    return dosage, populations, freqs
+
+
+def simulate_phenotypes(dosage, populations, n_causal=10, seed=0):
+    """Quantitative and binary phenotypes driven by `n_causal` variants plus ancestry."""
+    rng = np.random.default_rng(seed + 1)
+    n_samples, n_variants = dosage.shape
+    causal = rng.choice(n_variants, size=min(n_causal, n_variants), replace=False)
+    g = np.where(dosage[:, causal] < 0, 0, dosage[:, causal]).astype(float)
+    liability = g @ rng.normal(0, 0.5, size=len(causal)) + 0.5 * populations
+    quantitative = liability + rng.normal(size=n_samples)
+    binary = quantitative > np.median(quantitative)
+    return quantitative, binary, causal
+
+
+def write_vcf(path, dosage, contigs=("1",), seed=0):
+    """Write a dosage matrix as a VCF with GT:DP:AD calls and an INFO AF field."""
+    rng = np.random.default_rng(seed + 2)
+    n_samples, n_variants = dosage.shape
+    samples = [f"S{i:06d}" for i in range(n_samples)]
+    table = _call_strings()
+    per_contig = -(-n_variants // len(contigs))
+
+    called = dosage >= 0
+    af = np.where(called, dosage, 0).sum(axis=0) / np.maximum(2 * called.sum(axis=0), 1)
+    codes = np.where(called, dosage, 3).astype(np.int64)
+
+    with open(path, "w") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        for contig in contigs:
+            f.write(f"##contig=<ID={contig},length={per_contig * 100 + 1000}>\n")
+        f.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
+        f.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n')
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n")
+        for v in range(n_variants):
+            contig = contigs[v // per_contig]
+            pos = (v % per_contig) * 100 + 1
+            ref, alt = rng.choice(_BASES, size=2, replace=False)
+            dp = rng.integers(1, _MAX_DP + 1, size=n_samples)
+            calls = table[codes[:, v] * (_MAX_DP + 1) + dp]
+            f.write(
+                f"{contig}\t{pos}\t.\t{ref}\t{alt}\t50\tPASS\tAF={af[v]:.4f}\tGT:DP:AD\t"
+                + "\t".join(calls.tolist())
+                + "\n"
+            )
+    return samples
+
+
+def write_annotations(path, samples, populations, quantitative, binary, seed=0):
+    """Write an annotation table in the layout of data/1kg_annotations.txt."""
+    rng = np.random.default_rng(seed + 3)
+    is_female = rng.random(len(samples)) < 0.5
+    with open(path, "w") as f:
+        f.write("Sample\tPopulation\tSuperPopulation\tisFemale\tPurpleHair\tCaffeineConsumption\n")
+        for i, sample in enumerate(samples):
+            pop = "POP" + str(populations[i])
+            f.write(
+                f"{sample}\t{pop}\t{pop}\t{str(is_female[i]).lower()}\t{str(bool(binary[i])).lower()}"
+                f"\t{quantitative[i]:.5f}\n"
+            )
+
+
+def generate(out_prefix, n_samples, n_variants, missing_rate=0.01, n_contigs=1, seed=0):
+    """Write <out_prefix>.vcf and <out_prefix>_annotations.txt, return their paths and the dosage."""
+    dosage, populations, _ = simulate_genotypes(n_samples, n_variants, missing_rate, seed=seed)
+    quantitative, binary, _ = simulate_phenotypes(dosage, populations, seed=seed)
+    vcf_path = out_prefix + ".vcf"
+    ann_path = out_prefix + "_annotations.txt"
+    contigs = tuple(str(c + 1) for c in range(n_contigs))
+    samples = write_vcf(vcf_path, dosage, contigs=contigs, seed=seed)
+    write_annotations(ann_path, samples, populations, quantitative, binary, seed=seed)
+    return vcf_path, ann_path, dosage
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic GWAS inputs')
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--variants', type=int, default=10000)
+    parser.add_argument('--missing', type=float, default=0.01, help='Fraction of missing calls')
+    parser.add_argument('--contigs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='./temp/synthetic')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    vcf_path, ann_path, _ = generate(args.out, args.samples, args.variants, args.missing, args.contigs, args.seed)
+    print(vcf_path, ann_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""Entry point of `python -m gpugwas`, see gpugwas.cli."""
+
+import sys
+
+from gpugwas.cli import main
+
+sys.exit(main())
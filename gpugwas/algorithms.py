@@ -3,25 +3,44 @@
 ## Logistic regrssion: https://gist.github.com/VibhuJawa/316792903e90b7379c06a9c9cb4187ef
 ## Both: https://gist.github.com/VibhuJawa/b33927bda957355ebdc9bc261a24b142
 
-from cuml import linear_model as cuml_linear_model
-import cupy as cp
-import cudf
 import numpy as np
-import scipy.stats as stat
 
-from cuml import PCA
-import cupy as cp
-from cuml import linear_model as cuml_linear_model
-import numpy as np
-from scipy import stats
-import cudf
+from gpugwas import instrument, pvalues
+from gpugwas.backend import backend_of, to_host
+from gpugwas.pca import genotype_pca
 
-def PCA_concat(df, n_components=2):
-    pca_float = PCA(n_components = n_components)
-    pca_float.fit(df[df.columns[df.dtypes == np.float32]])
-    scores = pca_float.transform(df[df.columns[df.dtypes == np.float32]])
-    scores.columns = ['PC' + str(x) for x in range(n_components)]
-    return cudf.concat([df, scores],axis=1)
+@instrument.instrumented("PCA_concat")
+def PCA_concat(df, n_components=2, genotypes=None):
+    """
+    Append PC0..PCn columns to df. The PCA runs on the float32 columns of
+    df, or on `genotypes` (a samples x variants array or GenotypeMatrix
+    with rows aligned to df) when given, using the streaming randomized
+    pca.genotype_pca. Runs on the backend of df (cuML/CuPy for cuDF,
+    NumPy for pandas).
+    """
+    columns = ['PC' + str(x) for x in range(n_components)]
+    backend = backend_of(df)
+    if genotypes is not None:
+        scores = genotype_pca(genotypes, n_components, backend=backend.name)
+        scores = backend.df.DataFrame(dict(zip(columns, backend.xp.asarray(scores).T)))
+        return backend.df.concat([df.reset_index(drop=True), scores], axis=1)
+
+    float_cols = df.columns[df.dtypes == np.float32]
+    if backend.name == "cupy":
+        from cuml import PCA
+
+        pca_float = PCA(n_components = n_components)
+        pca_float.fit(df[float_cols])
+        scores = pca_float.transform(df[float_cols])
+        scores.columns = columns
+        return backend.df.concat([df, scores],axis=1)
+
+    # Same projection as cuml.PCA: centered columns onto the leading right singular vectors
+    values = df[float_cols].values.astype(np.float64)
+    values = values - values.mean(axis=0)
+    _, _, vt = np.linalg.svd(values, full_matrices=False)
+    scores = backend.df.DataFrame(values @ vt[:n_components].T, columns=columns, index=df.index)
+    return backend.df.concat([df, scores], axis=1)
 
 
 ## Port of sklearn Logistic Regression
@@ -42,12 +61,15 @@ class cuml_LogisticReg:
     """
 
     def __init__(self, *args, **kwargs):  # ,**kwargs):
+        from cuml import linear_model as cuml_linear_model
+
         self.model = cuml_linear_model.LogisticRegression(*args, **kwargs)  # ,**args)
 
     def fit(self, X, y):
+        cp = backend_of(X).xp
         self.model.fit(X, y)
         #### Get p-values for the fitted model ####
-        denom = 2.0 * (1.0 + np.cosh(self.model.decision_function(X)))
+        denom = 2.0 * (1.0 + cp.cosh(cp.asarray(self.model.decision_function(X))))
         denom = cp.tile(denom, (X.shape[1], 1)).T
         F_ij = cp.dot((X / denom).T, X)  ## Fisher Information Matrix
         Cramer_Rao = cp.linalg.inv(F_ij)  ## Inverse Information Matrix
@@ -59,11 +81,10 @@ class cuml_LogisticReg:
         )  # z-score for eaach model coefficient
         # z_scores = self.model.coef_[0]/sigma_estimates # z-score for eaach model coefficient
 
-        # serial on cpu but only n_features so should not be too bad
-        ## cna look into gpu accerattion if needed
-        p_values = [
-            stat.norm.sf(abs(x.item())) * 2 for x in z_scores
-        ]  ### two tailed test for p-values
+        ### two tailed test for p-values, computed for all coefficients at once on the gpu
+        logp = pvalues.norm_logp(z_scores)
+        p_values = to_host(cp.exp(logp))
+        neglog10_p_values = to_host(pvalues.neglog10(logp))
 
         ### In case we need confidence intervals
         # from: https://gist.github.com/rspeare/77061e6e317896be29c6de9a85db301d#gistcomment-2267786
@@ -75,6 +96,7 @@ class cuml_LogisticReg:
 
         self.z_scores = z_scores
         self.p_values = p_values
+        self.neglog10_p_values = neglog10_p_values
         self.sigma_estimates = sigma_estimates
         self.F_ij = F_ij
 
@@ -92,9 +114,12 @@ class cuml_LinearReg:
     """
 
     def __init__(self, *args, **kwargs):  # ,**kwargs):
+        from cuml import linear_model as cuml_linear_model
+
         self.model = cuml_linear_model.LinearRegression(*args, **kwargs)  # ,**args)
 
     def fit(self, X, y):
+        cp = backend_of(X).xp
         self.model.fit(X, y)
         predictions = self.model.predict(X)
 
@@ -123,15 +148,17 @@ class cuml_LinearReg:
         sd_b = cp.sqrt(var_b)
         ts_b = params / sd_b
 
-        ### TODO: May be can do on gpu if slow (should not be as ts_b is just n_features long
-        p_values = [2 * (1 - stats.t.cdf(np.abs(i.get()), len_delta)) for i in ts_b]
+        # p-values stay unrounded: tiny p-values carry the signal, -log10(p) is taken from the same log-p
+        logp = pvalues.t_logp(ts_b, len_delta)
+        p_values = to_host(cp.exp(logp))
+        neglog10_p_values = to_host(pvalues.neglog10(logp))
 
-        sd_b = np.round(sd_b, 3)
-        ts_b = np.round(ts_b, 3)
-        p_values = np.round(p_values, 3)
-        params = np.round(params, 4)
+        sd_b = cp.round(sd_b, 3)
+        ts_b = cp.round(ts_b, 3)
+        params = cp.round(params, 4)
 
         self.coefficients = params
         self.standard_errors = sd_b
         self.t_values = ts_b
         self.p_values = p_values
+        self.neglog10_p_values = neglog10_p_values
@@ -0,0 +1,402 @@
+"""Module for batched association tests over blocks of variants.
+
+Instead of fitting one regression per variant, the phenotype and the shared
+covariates are residualized once and the statistics of every variant in a
+block are computed with a handful of dense matrix products (the approach
+used by Hail's `linear_regression_rows`).
+"""
+
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+from gpugwas import pvalues
+from gpugwas.backend import backend_of, get_backend, to_host
+from gpugwas.genotype import GenotypeMatrix
+
+
+def _design_matrix(xp, n_samples, covariates, dtype):
+    """Intercept column followed by the covariates."""
+    design = xp.ones((n_samples, 1), dtype=dtype)
+    if covariates is not None:
+        covariates = xp.asarray(covariates, dtype=dtype)
+        if covariates.ndim == 1:
+            covariates = covariates[:, None]
+        design = xp.concatenate([design, covariates], axis=1)
+    return design
+
+
+def _genotype_array(xp, genotypes, dtype):
+    """Dense (n_samples, n_variants) array of a genotype block."""
+    if isinstance(genotypes, GenotypeMatrix):
+        genotypes = genotypes.to_float(dtype=dtype, xp=xp)
+    g = xp.asarray(genotypes, dtype=dtype)
+    if g.ndim == 1:
+        g = g[:, None]
+    return g
+
+
+_PhenotypeGroup = namedtuple("_PhenotypeGroup", ["columns", "rows", "q", "y_res", "yy", "dof"])
+
+
+class LinearAssociation:
+    """
+    Batched linear regression of one or more phenotypes on each variant in
+    turn, with an intercept and the shared covariates in every model.
+
+    `fit` residualizes the phenotypes against the covariates once, `test`
+    then returns a dict with `beta`, `standard_error`, `t_value`, `p_value`
+    and `neglog10_p_value` arrays (one entry per variant column, or one row
+    per variant and one column per phenotype when `fit` got a 2-D `y`).
+    Variants without variance after residualization (e.g. monomorphic) get
+    NaN statistics.
+
+    backend: 'numpy', 'cupy' or 'auto' (pick from the type of `y` in `fit`).
+    """
+
+    batched = True
+    multi_phenotype = True
+    # n_samples-long float vectors allocated per variant by `test`
+    work_buffers = 6
+
+    def __init__(self, backend="auto", dtype="float64"):
+        self.backend = backend
+        self.dtype = dtype
+        self.xp = None if backend == "auto" else get_backend(backend).xp
+
+    def fit(self, y, covariates=None):
+        """
+        Residualize `y` against intercept + covariates. `y` is (n_samples,) or
+        (n_samples, n_phenotypes) with NaN for missing values: phenotypes
+        sharing a missingness pattern are fitted together on their samples.
+        """
+        if self.xp is None:
+            self.xp = backend_of(y).xp
+        xp = self.xp
+
+        y = xp.asarray(y, dtype=self.dtype)
+        self._y_2d = y.ndim == 2
+        y = y.reshape(y.shape[0], -1)
+        n_samples, n_phenotypes = y.shape
+        design = _design_matrix(xp, n_samples, covariates, self.dtype)
+
+        patterns = defaultdict(list)
+        observed = to_host(~xp.isnan(y))
+        for column in range(n_phenotypes):
+            patterns[observed[:, column].tobytes()].append(column)
+
+        self.groups = []
+        for columns in patterns.values():
+            mask = observed[:, columns[0]]
+            rows = None if mask.all() else xp.asarray(np.flatnonzero(mask))
+            group_design = design if rows is None else design[rows]
+            group_y = y[:, columns] if rows is None else y[rows][:, columns]
+            # Orthonormal basis of the covariate space, projections use Q Q^T
+            q, _ = xp.linalg.qr(group_design)
+            y_res = group_y - q @ (q.T @ group_y)
+            dof = group_design.shape[0] - design.shape[1] - 1
+            self.groups.append(_PhenotypeGroup(columns, rows, q, y_res, (y_res * y_res).sum(axis=0), dof))
+        self.n_samples = n_samples
+        self.n_phenotypes = n_phenotypes
+        self.n_covariates = design.shape[1]
+        return self
+
+    def test(self, genotypes):
+        """
+        Test every column of `genotypes`, a (n_samples, n_variants) array or
+        a GenotypeMatrix (unpacked with mean imputation of missing calls).
+        """
+        xp = self.xp
+        g = _genotype_array(xp, genotypes, self.dtype)
+        names = ["beta", "standard_error", "t_value", "p_value", "neglog10_p_value"]
+        out = {name: xp.full((g.shape[1], self.n_phenotypes), xp.nan, dtype=self.dtype) for name in names}
+
+        for group in self.groups:
+            g_group = g if group.rows is None else g[group.rows]
+            g_res = g_group - group.q @ (group.q.T @ g_group)
+            gg = (g_res * g_res).sum(axis=0)
+            # y_res is orthogonal to the covariates so G^T y_res == G_res^T y_res,
+            # one (variants x phenotypes) product covers the whole group
+            gy = g_group.T @ group.y_res
+
+            valid = gg > 1e-8 * xp.maximum((g_group * g_group).sum(axis=0), 1.0)
+            gg = xp.where(valid, gg, xp.nan)[:, None]
+            beta = gy / gg
+            sigma2 = (group.yy[None, :] - beta * gy) / group.dof
+            se = xp.sqrt(sigma2 / gg)
+            t_value = beta / se
+            logp = pvalues.t_logp(t_value, group.dof)
+
+            columns = xp.asarray(group.columns)
+            for name, value in zip(names, [beta, se, t_value, xp.exp(logp), pvalues.neglog10(logp)]):
+                out[name][:, columns] = value
+
+        if not self._y_2d:
+            return {name: to_host(value[:, 0]) for name, value in out.items()}
+        return {name: to_host(value) for name, value in out.items()}
+
+
+class LinearSufficientStats:
+    """
+    Additive sufficient statistics of the LinearAssociation model, so a
+    GWAS can be updated with new sample batches or new variant shards
+    without revisiting the genotypes already processed.
+
+    With design C (intercept + covariates), phenotype y and genotypes g
+    whose missing calls are zeroed (g0) and flagged (m), every statistic
+    is a sum over samples: C^T C, C^T y, y^T y and per variant C^T g0,
+    C^T m, g0^T g0, g0^T y, m^T y and the missing count. Mean imputation
+    with the mean over all merged samples is applied exactly at `test`
+    time. Covariates must be fixed per sample (e.g. PCs are not refitted
+    when samples are added).
+
+    This is a library API: run_gwas and the command line (whose shards
+    split variants over the same samples, so merging their results is
+    enough) do not use it. Build batches with `from_batch`, combine them
+    with `add_samples` / `add_variants` and `save` / `load` them between
+    processes.
+    """
+
+    fields = ["n_samples", "cc", "cy", "yy", "cg", "cm", "gg", "gy", "my", "n_missing"]
+
+    def __init__(self, n_samples, cc, cy, yy, cg, cm, gg, gy, my, n_missing):
+        self.n_samples = int(n_samples)
+        self.cc, self.cy, self.yy = np.asarray(cc), np.asarray(cy), float(yy)
+        self.cg, self.cm = np.asarray(cg), np.asarray(cm)
+        self.gg, self.gy, self.my, self.n_missing = (np.asarray(a) for a in (gg, gy, my, n_missing))
+
+    @property
+    def n_variants(self):
+        return self.cg.shape[0]
+
+    @classmethod
+    def from_batch(cls, genotypes, y, covariates=None, backend="auto", dtype="float64", block_size=8192):
+        """Statistics of one batch of samples (y without missing values)."""
+        xp = (backend_of(y) if backend == "auto" else get_backend(backend)).xp
+        y = xp.asarray(y, dtype=dtype).ravel()
+        design = _design_matrix(xp, y.shape[0], covariates, dtype)
+
+        parts = defaultdict(list)
+        for start in range(0, genotypes.shape[1], block_size):
+            stop = min(start + block_size, genotypes.shape[1])
+            if isinstance(genotypes, GenotypeMatrix):
+                g = genotypes.to_float(slice(start, stop), dtype=dtype, impute=None, xp=xp)
+            else:
+                g = xp.asarray(genotypes[:, start:stop], dtype=dtype)
+            missing = xp.isnan(g)
+            g0 = xp.where(missing, 0, g)
+            m = missing.astype(dtype)
+            parts["cg"].append(to_host((design.T @ g0).T))
+            parts["cm"].append(to_host((design.T @ m).T))
+            parts["gg"].append(to_host((g0 * g0).sum(axis=0)))
+            parts["gy"].append(to_host(y @ g0))
+            parts["my"].append(to_host(y @ m))
+            parts["n_missing"].append(to_host(missing.sum(axis=0)))
+
+        k = design.shape[1]
+        stacked = {
+            name: np.concatenate(parts[name]) if parts[name] else np.zeros((0, k) if name in ("cg", "cm") else 0)
+            for name in ["cg", "cm", "gg", "gy", "my", "n_missing"]
+        }
+        return cls(y.shape[0], to_host(design.T @ design), to_host(design.T @ y), float(y @ y), **stacked)
+
+    def add_samples(self, other):
+        """Statistics of the union of two sample batches over the same variants."""
+        if other.n_variants != self.n_variants or other.cc.shape != self.cc.shape:
+            raise ValueError("Sample batches must cover the same variants and covariates")
+        return LinearSufficientStats(*(getattr(self, f) + getattr(other, f) for f in self.fields))
+
+    def add_variants(self, other):
+        """Statistics of two variant shards computed over the same samples."""
+        if other.n_samples != self.n_samples or not np.allclose(other.cc, self.cc) or not np.allclose(other.cy, self.cy):
+            raise ValueError("Variant shards must be computed over the same samples and covariates")
+        shared = [self.n_samples, self.cc, self.cy, self.yy]
+        per_variant = [np.concatenate([getattr(self, f), getattr(other, f)]) for f in self.fields[4:]]
+        return LinearSufficientStats(*shared, *per_variant)
+
+    def save(self, path):
+        """Write the statistics to an .npz file."""
+        np.savez(path, **{f: getattr(self, f) for f in self.fields})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*(data[f] for f in cls.fields))
+
+    def test(self):
+        """Association statistics of every variant, as LinearAssociation.test returns them."""
+        n_called = self.n_samples - self.n_missing
+        means = self.cg[:, 0] / np.maximum(n_called, 1)
+        # Mean imputation: g = g0 + mean * m, and g0^T m == 0
+        cg = self.cg + means[:, None] * self.cm
+        gg = self.gg + means * means * self.n_missing
+        gy = self.gy + means * self.my
+
+        # Partial out the covariates (Schur complement of C^T C)
+        solved = np.linalg.solve(self.cc, np.column_stack([self.cy, cg.T]))
+        cc_inv_cy, cc_inv_cg = solved[:, 0], solved[:, 1:]
+        yy = self.yy - self.cy @ cc_inv_cy
+        gy = gy - cg @ cc_inv_cy
+        gg_res = gg - (cg * cc_inv_cg.T).sum(axis=1)
+        dof = self.n_samples - self.cc.shape[0] - 1
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gg_res = np.where(gg_res > 1e-8 * np.maximum(gg, 1.0), gg_res, np.nan)
+            beta = gy / gg_res
+            se = np.sqrt((yy - beta * gy) / dof / gg_res)
+            t_value = beta / se
+        logp = pvalues.t_logp(t_value, dof)
+        return {
+            "beta": beta,
+            "standard_error": se,
+            "t_value": t_value,
+            "p_value": np.exp(logp),
+            "neglog10_p_value": pvalues.neglog10(logp),
+        }
+
+
+def _sigmoid(xp, eta):
+    return 1.0 / (1.0 + xp.exp(-eta))
+
+
+def _fit_firth(xp, X, y, max_iter=25, tol=1e-6, max_step=5.0, n_free=None):
+    """
+    Firth-penalized logistic regression for a batch of designs.
+
+    X: (n_models, n_samples, n_params), y: (n_samples,). Only the first
+    `n_free` parameters (default: all) are estimated, the others stay at 0,
+    while the Jeffreys penalty always uses the information matrix of the
+    full design (the profile penalized likelihood of Heinze and Schemper),
+    so fits with and without the last columns share a penalty. Returns the
+    estimates (n_models, n_params), the inverse information matrices and
+    the penalized log-likelihoods (n_models,).
+    """
+    n_free = X.shape[2] if n_free is None else n_free
+    beta = xp.zeros((X.shape[0], X.shape[2]), dtype=X.dtype)
+    for _ in range(max_iter):
+        mu = _sigmoid(xp, xp.einsum("fnp,fp->fn", X, beta))
+        w = mu * (1.0 - mu)
+        info = xp.einsum("fnp,fn,fnq->fpq", X, w, X)
+        info_inv = xp.linalg.inv(info)
+        # Hat matrix diagonal of the weighted design
+        h = w * xp.einsum("fnp,fpq,fnq->fn", X, info_inv, X)
+        score = xp.einsum("fnp,fn->fp", X[:, :, :n_free], y - mu + h * (0.5 - mu))
+        step = xp.linalg.solve(info[:, :n_free, :n_free], score[:, :, None])[:, :, 0]
+        largest = xp.abs(step).max(axis=1, keepdims=True)
+        step = step * xp.minimum(1.0, max_step / xp.maximum(largest, 1e-300))
+        beta[:, :n_free] = beta[:, :n_free] + step
+        if float(largest.max()) < tol:
+            break
+
+    mu = _sigmoid(xp, xp.einsum("fnp,fp->fn", X, beta))
+    w = mu * (1.0 - mu)
+    info = xp.einsum("fnp,fn,fnq->fpq", X, w, X)
+    eps = 1e-15
+    loglik = (y * xp.log(mu + eps) + (1.0 - y) * xp.log(1.0 - mu + eps)).sum(axis=1)
+    _, logdet = xp.linalg.slogdet(info)
+    return beta, xp.linalg.inv(info), loglik + 0.5 * logdet
+
+
+class LogisticAssociation:
+    """
+    Batched logistic association for binary (0/1) phenotypes.
+
+    `fit` estimates the covariate-only (null) model once. `test` computes
+    the score test of every variant in the block with matrix products and
+    refits the variants with p < `firth_threshold` by Firth-penalized
+    logistic regression (batched Newton steps), reporting the penalized
+    likelihood ratio test for those instead.
+
+    `test` returns `beta`, `standard_error`, `chi_sq`, `p_value`,
+    `neglog10_p_value` and `firth` (whether the variant was refit). For
+    score-tested variants beta and standard_error are the one-step
+    estimates U / V and 1 / sqrt(V).
+
+    backend: 'numpy', 'cupy' or 'auto' (pick from the type of `y` in `fit`).
+    """
+
+    batched = True
+    # n_samples-long float vectors allocated per variant by `test`
+    work_buffers = 8
+
+    def __init__(self, backend="auto", dtype="float64", firth_threshold=0.05, firth_batch_size=64, max_iter=25):
+        self.backend = backend
+        self.dtype = dtype
+        self.firth_threshold = firth_threshold
+        self.firth_batch_size = firth_batch_size
+        self.max_iter = max_iter
+        self.xp = None if backend == "auto" else get_backend(backend).xp
+
+    def fit(self, y, covariates=None):
+        """Fit the null model of binary phenotype `y` on intercept + covariates."""
+        if self.xp is None:
+            self.xp = backend_of(y).xp
+        xp = self.xp
+
+        y = xp.asarray(y, dtype=self.dtype).ravel()
+        design = _design_matrix(xp, y.shape[0], covariates, self.dtype)
+
+        # Newton-Raphson (IRLS) on the covariates only
+        beta = xp.zeros(design.shape[1], dtype=self.dtype)
+        for _ in range(self.max_iter):
+            mu = _sigmoid(xp, design @ beta)
+            w = mu * (1.0 - mu)
+            step = xp.linalg.solve(design.T @ (w[:, None] * design), design.T @ (y - mu))
+            beta = beta + step
+            if float(xp.abs(step).max()) < 1e-8:
+                break
+
+        mu = _sigmoid(xp, design @ beta)
+        self.y = y
+        self.design = design
+        self.mu = mu
+        self.w = mu * (1.0 - mu)
+        self.info_inv = xp.linalg.inv(design.T @ (self.w[:, None] * design))
+        self.null_beta = beta
+        return self
+
+    def test(self, genotypes):
+        """
+        Test every column of `genotypes`, a (n_samples, n_variants) array or
+        a GenotypeMatrix (unpacked with mean imputation of missing calls).
+        """
+        xp = self.xp
+        g = _genotype_array(xp, genotypes, self.dtype)
+
+        # Score U and its variance V, with G projected off the covariates in the W metric
+        u = g.T @ (self.y - self.mu)
+        wg = self.design.T @ (self.w[:, None] * g)
+        v = (self.w[:, None] * g * g).sum(axis=0) - (wg * (self.info_inv @ wg)).sum(axis=0)
+        v = xp.where(v > 1e-8 * xp.maximum((g * g).sum(axis=0), 1.0), v, xp.nan)
+
+        chi_sq = u * u / v
+        beta = u / v
+        se = 1.0 / xp.sqrt(v)
+        logp = pvalues.chi2_1df_logp(chi_sq)
+        firth = xp.zeros(g.shape[1], dtype=bool)
+
+        refit = xp.flatnonzero(xp.exp(logp) < self.firth_threshold)
+        for start in range(0, int(refit.shape[0]), self.firth_batch_size):
+            idx = refit[start:start + self.firth_batch_size]
+            n_models = int(idx.shape[0])
+            design = xp.broadcast_to(self.design, (n_models,) + self.design.shape)
+            X = xp.concatenate([design, g[:, idx].T[:, :, None]], axis=2)
+            firth_beta, firth_info_inv, loglik = _fit_firth(xp, X, self.y, self.max_iter)
+            # Null of each variant: its beta fixed at 0, penalized with the information of its full model
+            _, _, null_loglik = _fit_firth(xp, X, self.y, self.max_iter, n_free=X.shape[2] - 1)
+
+            lrt = xp.maximum(2.0 * (loglik - null_loglik), 0.0)
+            beta[idx] = firth_beta[:, -1]
+            se[idx] = xp.sqrt(firth_info_inv[:, -1, -1])
+            chi_sq[idx] = lrt
+            logp[idx] = pvalues.chi2_1df_logp(lrt)
+            firth[idx] = True
+
+        return {
+            "beta": to_host(beta),
+            "standard_error": to_host(se),
+            "chi_sq": to_host(chi_sq),
+            "p_value": to_host(xp.exp(logp)),
+            "neglog10_p_value": to_host(pvalues.neglog10(logp)),
+            "firth": to_host(firth),
+        }
@@ -0,0 +1,157 @@
+"""Module for choosing between the CPU and GPU implementations of the pipeline.
+
+Both backends provide the same dataframe, array and special function APIs:
+
+    numpy - pandas, NumPy and SciPy on the CPU
+    cupy  - cuDF, CuPy and cupyx.scipy on the GPU
+
+The configured backend is the one passed to `set_backend`, else the
+GPUGWAS_BACKEND environment variable ('numpy', 'cupy' or 'auto', the
+default); 'auto' picks cupy when cuDF and CuPy import and a GPU is visible.
+Only loaders create data in the configured backend. Every other stage
+follows the type of its input (see `backend_of` and `compute_backend`), so
+frames and arrays are never moved between devices behind the caller's
+back; inputs on neither device (a GenotypeMatrix) use the configured backend.
+
+On the CPU, the heavy stages (association, PCA, LD) are blocked matrix
+products, so they run on the multithreaded BLAS NumPy is linked against;
+use `set_blas_threads` to share the cores with other work.
+"""
+
+import os
+from collections import namedtuple
+
+
+ENV_VAR = "GPUGWAS_BACKEND"
+BACKENDS = ("numpy", "cupy")
+_ALIASES = {"cpu": "numpy", "pandas": "numpy", "gpu": "cupy", "cudf": "cupy"}
+
+Backend = namedtuple("Backend", ["name", "xp", "df", "sparse", "special"])
+Backend.__doc__ = """
+name: str
+    'numpy' or 'cupy'.
+xp: module
+    numpy or cupy.
+df: module
+    pandas or cudf.
+sparse, special: module
+    scipy.sparse / scipy.special or their cupyx.scipy counterparts.
+"""
+
+_selected = None
+_auto = None
+_loaded = {}
+
+
+def gpu_available():
+    """True when cuDF and CuPy import and at least one GPU is visible."""
+    try:
+        import cudf  # noqa: F401
+        import cupy
+
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        return False
+
+
+def resolve(name=None):
+    """
+    'numpy' or 'cupy' for `name`, or for the configured backend when None.
+    'cpu'/'pandas' and 'gpu'/'cudf' are accepted as aliases.
+    """
+    global _auto
+    if name is None:
+        name = _selected or os.environ.get(ENV_VAR) or "auto"
+    name = _ALIASES.get(name.lower(), name.lower())
+    if name == "auto":
+        if _auto is None:
+            _auto = "cupy" if gpu_available() else "numpy"
+        return _auto
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', expected one of {BACKENDS} or 'auto'")
+    return name
+
+
+def get_backend(name=None):
+    """The Backend for `name` (default: the configured backend), importing its libraries on first use."""
+    name = resolve(name)
+    if name not in _loaded:
+        if name == "cupy":
+            import cudf
+            import cupy
+            import cupyx.scipy.sparse as sparse
+            import cupyx.scipy.special as special
+
+            _loaded[name] = Backend(name, cupy, cudf, sparse, special)
+        else:
+            import numpy
+            import pandas
+            import scipy.sparse as sparse
+            import scipy.special as special
+
+            _loaded[name] = Backend(name, numpy, pandas, sparse, special)
+    return _loaded[name]
+
+
+def set_backend(name):
+    """Configure the backend used by loaders for this process and return it."""
+    global _selected
+    backend = get_backend(name)
+    _selected = backend.name
+    return backend
+
+
+def backend_of(obj):
+    """The Backend holding a frame, series or array: cupy for cuDF and device objects, numpy otherwise."""
+    on_device = hasattr(obj, "__cuda_array_interface__") or type(obj).__module__.split(".")[0] == "cudf"
+    return get_backend("cupy" if on_device else "numpy")
+
+
+def compute_backend(data, name=None):
+    """
+    The Backend a stage computes on: `name` when given, else the backend
+    holding `data` for arrays and frames, else (e.g. a host-packed
+    GenotypeMatrix, which unpacks on either device) the configured backend.
+    None and 'auto' both mean "choose from the data".
+    """
+    if name is not None and name != "auto":
+        return get_backend(name)
+    if hasattr(data, "__cuda_array_interface__") or hasattr(data, "__array__"):
+        return backend_of(data)
+    return get_backend()
+
+
+def to_host(array):
+    """Copy an array to host memory as a numpy array."""
+    if hasattr(array, "__cuda_array_interface__"):
+        return array.get()
+    import numpy
+
+    return numpy.asarray(array)
+
+
+def to_backend(df, name=None):
+    """Convert a pandas or cuDF frame to the dataframe type of backend `name` (default: the configured one)."""
+    backend = get_backend(name)
+    if backend_of(df) is backend:
+        return df
+    if backend.name == "numpy":
+        return df.to_pandas()
+    return backend.df.DataFrame.from_pandas(df)
+
+
+def set_blas_threads(n_threads):
+    """
+    Limit the BLAS/OpenMP threads of the numpy backend. Uses threadpoolctl
+    when installed (takes effect immediately); otherwise only sets the
+    usual environment variables, which BLAS reads when NumPy is first
+    imported. Returns True when the limit was applied to a running BLAS.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+            os.environ[var] = str(n_threads)
+        return False
+    threadpool_limits(limits=n_threads)
+    return True
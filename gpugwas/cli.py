@@ -0,0 +1,379 @@
+"""Module for the gpugwas command line interface.
+
+    python -m gpugwas <command> --config gwas.json [options]
+
+Every command runs one pipeline stage and exchanges files with the others
+through the work directory of the config:
+
+    ingest  VCF                  -> <workdir>/ingest
+    qc      <workdir>/ingest     -> <workdir>/qc
+    pca     <workdir>/qc         -> <workdir>/pcs.tsv
+    assoc   <workdir>/qc         -> <workdir>/assoc/<shard>
+    merge   <workdir>/assoc/*    -> <workdir>/results
+    plot    <workdir>/results    -> <workdir>/plots
+
+`assoc` tests the whole genome, one chromosome (--chrom), one region
+(--region chr:start-end), or every chromosome as a separate shard in a
+local process pool (--all_chroms --jobs N). A shard is written to a
+temporary directory, checkpointed after every variant block, and renamed
+when complete: rerunning a command skips finished shards and resumes
+failed ones from their last finished block.
+
+The config is a JSON file whose sections override DEFAULT_CONFIG. Heavy
+modules are imported inside the commands, so `--help` returns quickly.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONFIG = {
+    "backend": None,
+    "workdir": "./gwas",
+    "vcf": "./data/test.vcf",
+    "annotations": "./data/1kg_annotations.txt",
+    "sample_column": "Sample",
+    "ingest": {
+        "info_keys": ["AF"],
+        "format_keys": ["GT", "DP", "AD"],
+        "allele_balance": True,
+        "variants_per_block": 10000,
+        "cache_dir": None,
+    },
+    "qc": {"min_dp_mean": 4, "min_call_rate": 0.97, "min_af": 0.01, "min_p_hwe": 1e-6},
+    "pca": {"n_components": 2, "ld_prune": {"r2_threshold": 0.2, "window_bp": 1000000}},
+    "assoc": {
+        "phenotypes": ["CaffeineConsumption"],
+        "covariates": ["PC0", "PC1"],
+        "model": "linear",
+        "batch_size": None,
+        "memory_budget": None,
+    },
+    "plot": {"phenotypes": None, "significance": 1e-5},
+}
+
+MODELS = {"linear": "LinearAssociation", "logistic": "LogisticAssociation"}
+
+
+def load_config(path=None):
+    """DEFAULT_CONFIG with the values of the JSON file `path` (sections are merged key by key)."""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is None:
+        return config
+    with open(path) as f:
+        user = json.load(f)
+    for key, value in user.items():
+        if isinstance(config.get(key), dict) and isinstance(value, dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    return config
+
+
+def _workpath(config, *names):
+    return os.path.join(config["workdir"], *names)
+
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def parse_region(region):
+    """'chr1:1000-2000' -> ('chr1', 1000, 2000); 'chr1' -> ('chr1', None, None)."""
+    chrom, _, span = region.partition(":")
+    if not span:
+        return chrom, None, None
+    start, _, end = span.replace(",", "").partition("-")
+    return chrom, int(start) if start else None, int(end) if end else None
+
+
+def shard_name(chrom=None, start=None, end=None):
+    if chrom is None:
+        return "all"
+    if start is None and end is None:
+        return str(chrom)
+    return f"{chrom}_{'' if start is None else start}-{'' if end is None else end}"
+
+
+def cmd_ingest(config, args):
+    import gpugwas.io as gwasio
+
+    options = config["ingest"]
+    data = gwasio.load_genotypes(
+        args.vcf or config["vcf"],
+        info_keys=options["info_keys"],
+        format_keys=options["format_keys"],
+        variants_per_block=options["variants_per_block"],
+        cache_dir=options["cache_dir"],
+        allele_balance=options["allele_balance"],
+    )
+    output = args.output or _workpath(config, "ingest")
+    gwasio.save_genotype_data(data, output)
+    logger.info("Wrote %d samples x %d variants to %s", data.genotypes.n_samples, data.genotypes.n_variants, output)
+
+
+def cmd_qc(config, args):
+    import gpugwas.filter as gwasfilter
+    import gpugwas.io as gwasio
+
+    options = config["qc"]
+    data = gwasio.read_genotype_data(args.input or _workpath(config, "ingest"))
+    data = gwasfilter.filter_samples(data, min_dp_mean=options["min_dp_mean"], min_call_rate=options["min_call_rate"])
+    data = gwasfilter.filter_variant_qc(data, min_af=options["min_af"], min_p_hwe=options["min_p_hwe"])
+    output = args.output or _workpath(config, "qc")
+    gwasio.save_genotype_data(data, output)
+    logger.info("Wrote %d samples x %d variants to %s", data.genotypes.n_samples, data.genotypes.n_variants, output)
+
+
+def cmd_pca(config, args):
+    import pandas as pd
+
+    import gpugwas.io as gwasio
+    from gpugwas.backend import get_backend, to_host
+    from gpugwas.ld import ld_prune
+    from gpugwas.pca import genotype_pca
+
+    options = config["pca"]
+    backend = get_backend().name
+    data = gwasio.read_genotype_data(args.input or _workpath(config, "qc"))
+    variants = None
+    if options.get("ld_prune"):
+        variants = ld_prune(data, backend=backend, **options["ld_prune"])
+        logger.info("Kept %d of %d variants after LD pruning", variants.sum(), len(variants))
+    scores = to_host(genotype_pca(data.genotypes, options["n_components"], variants=variants, backend=backend))
+
+    pcs = pd.DataFrame(scores, columns=[f"PC{i}" for i in range(scores.shape[1])])
+    pcs.insert(0, "sample", data.samples["sample"].values)
+    output = args.output or _workpath(config, "pcs.tsv")
+    pcs.to_csv(output, sep="\t", index=False)
+    logger.info("Wrote %d principal components to %s", scores.shape[1], output)
+
+
+def _phenotype_table(config, pcs_path):
+    """Annotations (host pandas) with the principal components joined by sample when needed."""
+    import pandas as pd
+
+    sample_column = config["sample_column"]
+    ann_df = pd.read_csv(config["annotations"], sep="\t")
+    missing = [c for c in config["assoc"]["covariates"] if c not in ann_df.columns]
+    if missing:
+        if not os.path.exists(pcs_path):
+            raise ValueError(f"Covariates {missing} are not annotations and {pcs_path} does not exist, run `pca` first")
+        pcs = pd.read_csv(pcs_path, sep="\t").rename(columns={"sample": sample_column})
+        ann_df = ann_df.merge(pcs, on=sample_column, how="inner")
+    return ann_df
+
+
+def run_assoc_shard(config, input_path, pcs_path, output_dir, chrom=None, start=None, end=None, force=False):
+    """
+    Test the variants of one shard and write them to <output_dir>/<shard>.
+    Returns the shard path; complete shards are kept and interrupted ones
+    resumed, unless `force`.
+    """
+    import numpy as np
+
+    import gpugwas.association as assoc
+    import gpugwas.dataprep as dp
+    import gpugwas.io as gwasio
+    import gpugwas.runner as runner
+    from gpugwas.backend import set_backend
+    from gpugwas.genotype import GenotypeData
+    from gpugwas.results import VariantIndex
+    from gpugwas.store import INDEX_FILE, ResultsWriter
+
+    final = os.path.join(output_dir, shard_name(chrom, start, end))
+    if os.path.exists(os.path.join(final, INDEX_FILE)) and not force:
+        logger.info("Shard %s is complete, skipping", final)
+        return final
+    set_backend(config["backend"])
+    options = config["assoc"]
+
+    data = gwasio.read_genotype_data(input_path)
+    coords = VariantIndex.from_table(data.variants)
+    keep = np.ones(len(data.variants), dtype=bool)
+    if chrom is not None:
+        keep &= data.variants["chrom"].astype(str).values == str(chrom)
+    if start is not None:
+        keep &= data.variants["pos"].values >= start
+    if end is not None:
+        keep &= data.variants["pos"].values <= end
+    data = GenotypeData(data.genotypes.subset(variants=keep), data.variants[keep].reset_index(drop=True), data.samples)
+    logger.info("Shard %s: %d variants", final, keep.sum())
+
+    phenotypes = _as_list(options["phenotypes"])
+    covariates = list(options["covariates"])
+    ann_df = _phenotype_table(config, pcs_path)
+    phenotypes_df, genotypes, variant_index = dp.create_phenotype_matrix(
+        data, ann_df, phenotypes + covariates, ann_sample_col=config["sample_column"]
+    )
+
+    tmp, checkpoint = final + ".tmp", final + ".checkpoint"
+    if force or not os.path.exists(os.path.join(checkpoint, runner.Checkpoint.MANIFEST)):
+        # Nothing to resume: drop any output of a run that died before its first block was recorded
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.rmtree(checkpoint, ignore_errors=True)
+    runner.run_gwas(
+        phenotypes_df, phenotypes, variant_index, getattr(assoc, MODELS[options["model"]]),
+        add_cols=covariates, batch_size=options["batch_size"], genotypes=genotypes,
+        memory_budget=options["memory_budget"], variants=coords, output=ResultsWriter(tmp),
+        checkpoint=checkpoint, resume=True,
+    )
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(tmp, final)
+    shutil.rmtree(checkpoint)
+    return final
+
+
+def _run_shard_worker(config, log_level, *shard_args):
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    return run_assoc_shard(config, *shard_args)
+
+
+def cmd_assoc(config, args):
+    input_path = args.input or _workpath(config, "qc")
+    pcs_path = args.pcs or _workpath(config, "pcs.tsv")
+    output_dir = args.output_dir or _workpath(config, "assoc")
+    os.makedirs(output_dir, exist_ok=True)
+
+    if not args.all_chroms:
+        chrom, start, end = parse_region(args.region) if args.region else (args.chrom, None, None)
+        run_assoc_shard(config, input_path, pcs_path, output_dir, chrom, start, end, args.force)
+        return 0
+
+    import pandas as pd
+
+    from gpugwas.results import chrom_sort_key
+
+    chroms = pd.read_parquet(os.path.join(input_path, "variants.parquet"), columns=["chrom"])["chrom"]
+    chroms = sorted(chroms.astype(str).unique(), key=chrom_sort_key)
+    # Spawned workers do not inherit CUDA state or BLAS thread pools from this process
+    context = multiprocessing.get_context("spawn")
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context) as pool:
+        futures = {
+            chrom: pool.submit(_run_shard_worker, config, args.log_level, input_path, pcs_path, output_dir, chrom,
+                               None, None, args.force)
+            for chrom in chroms
+        }
+        for chrom, future in futures.items():
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Shard %s failed", chrom)
+                failed.append(chrom)
+    if failed:
+        logger.error("%d of %d shards failed (%s), rerun to retry them", len(failed), len(chroms), ", ".join(failed))
+        return 1
+    return 0
+
+
+def cmd_merge(config, args):
+    from gpugwas.store import INDEX_FILE, merge_stores
+
+    inputs = args.inputs
+    if not inputs:
+        assoc_dir = _workpath(config, "assoc")
+        inputs = sorted(
+            os.path.join(assoc_dir, name) for name in os.listdir(assoc_dir)
+            if os.path.exists(os.path.join(assoc_dir, name, INDEX_FILE)) and not name.endswith((".tmp", ".checkpoint"))
+        )
+    output = args.output or _workpath(config, "results")
+    if args.force:
+        shutil.rmtree(output, ignore_errors=True)
+    store = merge_stores(inputs, output)
+    logger.info("Merged %d shards (%d rows) into %s", len(inputs), store.n_rows, output)
+
+
+def cmd_plot(config, args):
+    from gpugwas import vizstatic
+    from gpugwas.store import ResultsStore
+
+    options = config["plot"]
+    store = ResultsStore(args.input or _workpath(config, "results"))
+    output_dir = args.output_dir or _workpath(config, "plots")
+    os.makedirs(output_dir, exist_ok=True)
+    for phenotype in _as_list(options["phenotypes"] or store.phenotypes):
+        results = store.read(phenotype, columns=["chrom", "pos", "p_value"])
+        vizstatic.manhattan_plot(results, os.path.join(output_dir, f"{phenotype}_manhattan.png"),
+                                 title=f"{phenotype} Manhattan Plot", significance=options["significance"])
+        vizstatic.qq_plot(results, os.path.join(output_dir, f"{phenotype}_qq.png"), title=f"{phenotype} Q-Q Plot",
+                          significance=options["significance"])
+    logger.info("Wrote plots to %s", output_dir)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="gpugwas", description="GPU GWAS pipeline")
+    parser.add_argument("--config", default=None, help="JSON config file (overrides gpugwas.cli.DEFAULT_CONFIG)")
+    parser.add_argument("--workdir", default=None, help="Work directory (overrides the config)")
+    parser.add_argument("--backend", default=None, help="numpy, cupy or auto (overrides the config)")
+    parser.add_argument("--report", default=None, help="Write per-stage timing/memory report as JSON to this path")
+    parser.add_argument("--log_level", default="INFO")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="Load a VCF into a packed genotype dataset")
+    ingest.add_argument("--vcf", default=None)
+    ingest.add_argument("--output", default=None)
+    ingest.set_defaults(func=cmd_ingest)
+
+    qc = commands.add_parser("qc", help="Sample and variant QC")
+    qc.add_argument("--input", default=None)
+    qc.add_argument("--output", default=None)
+    qc.set_defaults(func=cmd_qc)
+
+    pca = commands.add_parser("pca", help="Principal components of the QC'd genotypes")
+    pca.add_argument("--input", default=None)
+    pca.add_argument("--output", default=None)
+    pca.set_defaults(func=cmd_pca)
+
+    assoc = commands.add_parser("assoc", help="Association tests of the genome or of one shard")
+    assoc.add_argument("--input", default=None)
+    assoc.add_argument("--pcs", default=None)
+    assoc.add_argument("--output_dir", default=None)
+    shard = assoc.add_mutually_exclusive_group()
+    shard.add_argument("--chrom", default=None, help="Only test this chromosome")
+    shard.add_argument("--region", default=None, help="Only test chrom:start-end (inclusive)")
+    shard.add_argument("--all_chroms", action="store_true", help="One shard per chromosome, run in a process pool")
+    assoc.add_argument("--jobs", type=int, default=1, help="Worker processes for --all_chroms")
+    assoc.add_argument("--force", action="store_true", help="Redo complete shards and restart interrupted ones")
+    assoc.set_defaults(func=cmd_assoc)
+
+    merge = commands.add_parser("merge", help="Combine shard results into one store")
+    merge.add_argument("inputs", nargs="*", help="Shard stores (default: every complete shard of the workdir)")
+    merge.add_argument("--output", default=None)
+    merge.add_argument("--force", action="store_true", help="Replace an existing output store")
+    merge.set_defaults(func=cmd_merge)
+
+    plot = commands.add_parser("plot", help="Static Manhattan and Q-Q plots of a results store")
+    plot.add_argument("--input", default=None)
+    plot.add_argument("--output_dir", default=None)
+    plot.set_defaults(func=cmd_plot)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    config = load_config(args.config)
+    if args.workdir is not None:
+        config["workdir"] = args.workdir
+    if args.backend is not None:
+        config["backend"] = args.backend
+    os.makedirs(config["workdir"], exist_ok=True)
+
+    from gpugwas import instrument
+    from gpugwas.backend import set_backend
+
+    logger.info("Backend: %s", set_backend(config["backend"]).name)
+    status = args.func(config, args) or 0
+    if args.report:
+        instrument.get_report().to_json(args.report)
+    return status
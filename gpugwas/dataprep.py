@@ -1,5 +1,13 @@
-import cudf
-import cupy as cp
+import logging
+
+import numpy as np
+import pandas as pd
+
+from gpugwas import instrument
+from gpugwas.backend import backend_of, get_backend
+from gpugwas.genotype import GenotypeData
+
+logger = logging.getLogger(__name__)
 
 # Example use with regression at:
 # Link: https://gist.github.com/VibhuJawa/d932250a35d15197d35cf37c9d00ba42
@@ -28,38 +36,42 @@ import cupy as cp
 #    )
 
 def create_matrix_from_features(f_df, n_features, data_col):
+    """
+    Sparse (samples x features) CSR matrix of the `data_col` values, rows
+    in sample order, on the backend of f_df (scipy or cupyx sparse).
+    """
+    backend = backend_of(f_df)
     f_df = f_df.sort_values(by=['sample',data_col])
-    feature_counts = f_df["sample"].value_counts().reset_index()
-    feature_counts.rename(columns={'index':'sample','sample':'feature_counts'},inplace=True)
-    feature_counts = feature_counts.sort_values(by=['sample']).reset_index(drop=True)
+    feature_counts = f_df.groupby('sample').size().sort_index()
 
     n_samples = len(feature_counts)
 
     data = f_df[data_col].values
     indices = f_df["feature_id"].values
-    indptr = feature_counts['feature_counts'].cumsum().values
-    indptr = cp.pad(indptr, (1, 0), "constant")
+    indptr = backend.xp.pad(feature_counts.cumsum().values, (1, 0), "constant")
 
-    return cp.sparse.csr_matrix(arg1=(data, indices, indptr), dtype=cp.float32,shape=(n_samples,n_features))
+    return backend.sparse.csr_matrix((data, indices, indptr), dtype=backend.xp.float32, shape=(n_samples,n_features))
 
 
+@instrument.instrumented("create_phenotype_df")
 def create_phenotype_df(vcf_df, ann_df, phenotype_cols, vcf_col, vcf_sample_col="sample", ann_sample_col="Sample"):
     # Wrap all the matrix processing code here
 
     # Merge annotations with variant DF
-    print("Merging annotations")
+    logger.info("Merging annotations")
     f_df = ann_df.merge(vcf_df,how='inner',left_on = [ann_sample_col],right_on = [vcf_sample_col])
-    print(f_df)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", f_df)
     
     # Create feature matrix
-    print("Creating feature matrix")
+    logger.info("Creating feature matrix")
     n_features = len(f_df["feature_id"].unique())
-    print("Number of independent features is", n_features)
+    logger.info("Number of independent features is %d", n_features)
     matrix  = create_matrix_from_features(f_df, n_features = n_features, data_col=vcf_col)
-    matrix = matrix.todense()
+    matrix = matrix.toarray()
     
     # Add variant features to phenotype df
-    print("Adding variant features to phenotype df")
+    logger.info("Adding variant features to phenotype df")
     phenotypes_df = f_df[[ann_sample_col] + phenotype_cols].drop_duplicates()
     phenotypes_df = phenotypes_df.sort_values(by=[ann_sample_col]).reset_index(drop=True)
     features = []
@@ -67,5 +79,79 @@ def create_phenotype_df(vcf_df, ann_df, phenotype_cols, vcf_col, vcf_sample_col=
         f_name = f'variant_{i}'
         features.append(f_name)
         phenotypes_df[f_name]= matrix[:,i]
-    print(phenotypes_df)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", phenotypes_df)
     return phenotypes_df, features
+
+
+@instrument.instrumented("create_phenotype_matrix")
+def create_phenotype_matrix(vcf_df, ann_df, phenotype_cols, vcf_col="call_GT", vcf_sample_col="sample", ann_sample_col="Sample",
+                            impute="mean"):
+    """
+    Align phenotypes with genotypes without creating a column per variant.
+
+    vcf_df is either the long dataframe from load_vcf (the `vcf_col` values
+    become the matrix) or a GenotypeData from load_genotypes.
+
+    Returns the phenotype dataframe (one row per sample), a single
+    (samples x variants) genotype matrix with rows in the same order (a dense
+    array on the backend of vcf_df, or a GenotypeMatrix view for GenotypeData inputs) and the
+    variant index holding the feature_id of every matrix column.
+
+    Missing calls (-1 in call_GT) of the dense matrix are replaced by the
+    mean dosage of the variant (impute="mean") or NaN (impute=None), as
+    GenotypeMatrix.to_float does, so they never enter a model as a dosage.
+    """
+    if isinstance(vcf_df, GenotypeData):
+        return _align_genotype_data(vcf_df, ann_df, phenotype_cols, vcf_sample_col, ann_sample_col)
+
+    logger.info("Merging annotations")
+    f_df = ann_df.merge(vcf_df, how='inner', left_on=[ann_sample_col], right_on=[vcf_sample_col])
+
+    logger.info("Creating feature matrix")
+    n_features = len(f_df["feature_id"].unique())
+    logger.info("Number of independent features is %d", n_features)
+    matrix = create_matrix_from_features(f_df, n_features=n_features, data_col=vcf_col)
+    matrix = matrix.toarray()
+    if vcf_col == "call_GT":
+        matrix = impute_missing_calls(matrix, impute)
+
+    # Matrix rows are ordered by sample name
+    phenotypes_df = f_df[[ann_sample_col] + phenotype_cols].drop_duplicates()
+    phenotypes_df = phenotypes_df.sort_values(by=[ann_sample_col]).reset_index(drop=True)
+    variant_index = backend_of(matrix).xp.arange(n_features)
+    return phenotypes_df, matrix, variant_index
+
+
+def impute_missing_calls(matrix, impute="mean"):
+    """
+    Replace the missing calls (negative dosages) of a dense (samples x
+    variants) matrix by the mean dosage of their variant (impute="mean")
+    or NaN (impute=None).
+    """
+    xp = backend_of(matrix).xp
+    missing = matrix < 0
+    if impute == "mean":
+        n_called = (~missing).sum(axis=0)
+        means = xp.where(missing, 0, matrix).sum(axis=0) / xp.maximum(n_called, 1)
+        return xp.where(missing, means[None, :].astype(matrix.dtype), matrix)
+    if impute is None:
+        return xp.where(missing, xp.nan, matrix)
+    raise ValueError(f"Unknown impute mode '{impute}'")
+
+
+def _align_genotype_data(data, ann_df, phenotype_cols, vcf_sample_col, ann_sample_col):
+    genotypes, variants, samples = data
+    ann_df = ann_df.to_pandas() if hasattr(ann_df, "to_pandas") else ann_df
+
+    rows = pd.DataFrame({vcf_sample_col: samples["sample"].values, "_row": np.arange(len(samples))})
+    merged = rows.merge(
+        ann_df[[ann_sample_col] + phenotype_cols],
+        how="inner",
+        left_on=vcf_sample_col,
+        right_on=ann_sample_col,
+    ).sort_values(by="_row")
+
+    genotypes = genotypes.subset(samples=merged["_row"].values)
+    phenotypes_df = get_backend().df.DataFrame(merged[[ann_sample_col] + phenotype_cols].reset_index(drop=True))
+    return phenotypes_df, genotypes, variants["feature_id"].values
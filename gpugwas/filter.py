@@ -1,14 +1,32 @@
-import cudf
+import logging
 
+import numpy as np
+
+from gpugwas import instrument
+from gpugwas.backend import backend_of, to_host
+from gpugwas.genotype import GenotypeData
+
+logger = logging.getLogger(__name__)
+
+
+def _log_unique(message, column):
+    """Log the number of unique values, only computing it when INFO is enabled."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s: %d", message, len(column.unique()))
+
+
+@instrument.instrumented("filter_samples")
 def filter_samples(df, min_dp_mean = 4, min_call_rate=0.95):
+    if isinstance(df, GenotypeData):
+        return _filter_samples_genotypes(df, min_dp_mean, min_call_rate)
     
-    print("Number of samples: " + str(len(df['sample'].unique())))
+    _log_unique("Number of samples", df['sample'])
     
     # Filter DP
     dp_filter = df.groupby('sample').call_DP.mean() >= min_dp_mean
     dp_filter = dp_filter[dp_filter.values].index
     df_filtered = df[df['sample'].isin(dp_filter)]
-    print("Number of samples after filtering DP: " + str(len(df_filtered['sample'].unique())))
+    _log_unique("Number of samples after filtering DP", df_filtered['sample'])
     
     # Filter call rate
     df_filtered['called'] = df_filtered.call_GT!=-1
@@ -17,7 +35,7 @@ def filter_samples(df, min_dp_mean = 4, min_call_rate=0.95):
     call_rate_filter = call_rate_filter.rate > min_call_rate
     call_rate_filter = call_rate_filter[call_rate_filter].index
     df_filtered = df_filtered[df_filtered['sample'].isin(call_rate_filter)]
-    print("Number of samples after filtering sample call rate: " + str(len(df_filtered['sample'].unique())))
+    _log_unique("Number of samples after filtering sample call rate", df_filtered['sample'])
     
     df_filtered.reset_index(drop=True, inplace=True)
     df_filtered.drop(columns='called', inplace=True)
@@ -25,13 +43,16 @@ def filter_samples(df, min_dp_mean = 4, min_call_rate=0.95):
     return df_filtered
 
 
+@instrument.instrumented("filter_variants")
 def filter_variants(df, min_af = 0.1, min_call_rate=0.95):
+    if isinstance(df, GenotypeData):
+        return _filter_variants_genotypes(df, min_af, min_call_rate)
     
-    print("Number of variants: " + str(len(df.feature_id.unique())))
+    _log_unique("Number of variants", df.feature_id)
         
     # Filter AF
     df_filtered = df[df['AF'] >= min_af]
-    print("Number of variants after filtering AF: " + str(len(df_filtered.feature_id.unique())))
+    _log_unique("Number of variants after filtering AF", df_filtered.feature_id)
     
     # Filter call rate
     df_filtered['called'] = df_filtered.call_GT!=-1
@@ -40,16 +61,309 @@ def filter_variants(df, min_af = 0.1, min_call_rate=0.95):
     call_rate_filter = call_rate_filter.rate > min_call_rate
     call_rate_filter = call_rate_filter[call_rate_filter].index
     df_filtered = df_filtered[df_filtered['feature_id'].isin(call_rate_filter)]
-    print("Number of variants after filtering call rate: " + str(len(df_filtered.feature_id.unique())))
+    _log_unique("Number of variants after filtering call rate", df_filtered.feature_id)
     
     # Reset indices
     df_filtered.reset_index(drop=True, inplace=True)
     df_filtered.drop(columns='called', inplace=True)
     
-    feature_rename = df_filtered.feature_id.unique().reset_index()
-    feature_rename.columns = ['new_feature_id', 'feature_id']
-    df_filtered = df_filtered.merge(feature_rename)
-    df_filtered.drop(columns='feature_id', inplace=True)
-    df_filtered.rename(columns={"new_feature_id": "feature_id"}, inplace=True)
+    df_filtered['feature_id'] = _renumber(df_filtered['feature_id'], call_rate_filter)
+
+    return df_filtered
+
+
+def _renumber(feature_id, kept_ids):
+    """Map kept feature ids to 0..n-1 in id order (a lookup, no merge)."""
+    series = backend_of(feature_id).df.Series
+    kept_ids = series(kept_ids).sort_values().reset_index(drop=True)
+    return series(kept_ids.searchsorted(feature_id), index=feature_id.index)
+
+
+@instrument.instrumented("filter_qc")
+def filter_qc(df, min_dp_mean=4, min_sample_call_rate=0.95, min_af=0.1, min_variant_call_rate=0.95):
+    """
+    filter_samples followed by filter_variants in a single pass.
+
+    Per-sample (mean DP, call rate) and per-variant (call rate over the kept
+    samples) statistics are gathered with one aggregation each, both filters
+    are combined into a single row mask and variants are renumbered through
+    a sorted id lookup, so the long-format frame is only copied once.
+    GenotypeData is filtered as index views of the genotype matrix.
+    """
+    if isinstance(df, GenotypeData):
+        return _filter_qc_genotypes(df, min_dp_mean, min_sample_call_rate, min_af, min_variant_call_rate)
+
+    frame = backend_of(df).df.DataFrame
+    called = df['call_GT'] != -1
+    sample_stats = frame({'sample': df['sample'], 'call_DP': df['call_DP'], 'called': called}).groupby(
+        'sample').mean()
+    sample_keep = (sample_stats['call_DP'] >= min_dp_mean) & (sample_stats['called'] > min_sample_call_rate)
+    kept_samples = sample_stats.index[sample_keep.values]
+    logger.info("Number of samples: %d, after QC: %d", len(sample_stats), len(kept_samples))
+
+    rows = df['sample'].isin(kept_samples) & (df['AF'] >= min_af)
+    variant_stats = frame({'feature_id': df['feature_id'], 'called': called & rows, 'rows': rows}).groupby(
+        'feature_id').sum()
+    variant_keep = variant_stats['called'] / variant_stats['rows'] > min_variant_call_rate
+    kept_variants = variant_stats.index[variant_keep.values]
+    logger.info("Number of variants: %d, after QC: %d", len(variant_stats), len(kept_variants))
+
+    df_filtered = df[rows & df['feature_id'].isin(kept_variants)].reset_index(drop=True)
+    df_filtered['feature_id'] = _renumber(df_filtered['feature_id'], kept_variants)
+    return df_filtered
+
+
+def _sample_call_rate(genotypes, samples, counts=None):
+    """Per-sample call rate, as measured at load time when the sample table has one."""
+    if "call_rate" in samples.columns:
+        return samples["call_rate"].values
+    called = counts.sample_called if counts is not None else genotypes.sample_counts()[0]
+    return called / max(genotypes.n_variants, 1)
+
+
+def _filter_samples_genotypes(data, min_dp_mean, min_call_rate):
+    """Sample filters of filter_samples applied to a GenotypeData as an index view."""
+    genotypes, variants, samples = data
+    logger.info("Number of samples: %d", genotypes.n_samples)
+
+    keep = np.ones(genotypes.n_samples, dtype=bool)
+    if "dp_mean" in samples.columns:
+        keep &= samples["dp_mean"].values >= min_dp_mean
+        logger.info("Number of samples after filtering DP: %d", keep.sum())
+
+    keep &= _sample_call_rate(genotypes, samples) > min_call_rate
+    logger.info("Number of samples after filtering sample call rate: %d", keep.sum())
+
+    return GenotypeData(
+        genotypes.subset(samples=keep),
+        variants,
+        samples[keep].reset_index(drop=True),
+    )
+
+
+def _filter_variants_genotypes(data, min_af, min_call_rate):
+    """Variant filters of filter_variants applied to a GenotypeData as an index view."""
+    genotypes, variants, samples = data
+    logger.info("Number of variants: %d", genotypes.n_variants)
+
+    keep = variants["AF"].values >= min_af
+    logger.info("Number of variants after filtering AF: %d", keep.sum())
+
+    called, _ = genotypes.variant_counts()
+    keep &= called / max(genotypes.n_samples, 1) > min_call_rate
+    logger.info("Number of variants after filtering call rate: %d", keep.sum())
+
+    # Renumber the remaining variants like the dataframe path does
+    variants = variants[keep].reset_index(drop=True)
+    variants["feature_id"] = np.arange(len(variants))
+    return GenotypeData(genotypes.subset(variants=keep), variants, samples)
+
+
+def _filter_qc_genotypes(data, min_dp_mean, min_sample_call_rate, min_af, min_variant_call_rate):
+    """
+    filter_qc on a GenotypeData: one pass of counts, then masks applied as
+    index views. Variant call rates are over the kept samples, so the pass
+    counts the variants over the samples passing the filters known before
+    it (DP, and call rates measured at load time). Call rates measured by
+    the pass itself can drop more samples; their calls are then taken back
+    out with a second, partial pass that unpacks only the bytes of the
+    smaller of the dropped and kept sample sets.
+    """
+    genotypes, variants, samples = data
+    keep_samples = np.ones(genotypes.n_samples, dtype=bool)
+    if "dp_mean" in samples.columns:
+        keep_samples &= samples["dp_mean"].values >= min_dp_mean
+    if "call_rate" in samples.columns:
+        keep_samples &= samples["call_rate"].values > min_sample_call_rate
+    counted = keep_samples.copy()
+    counts = genotypes.qc_counts(sample_mask=None if counted.all() else counted)
+
+    keep_samples &= _sample_call_rate(genotypes, samples, counts) > min_sample_call_rate
+    logger.info("Number of samples: %d, after QC: %d", genotypes.n_samples, keep_samples.sum())
+
+    variant_called = counts.variant_called
+    dropped = counted & ~keep_samples
+    if dropped.sum() > keep_samples.sum():
+        variant_called, _ = genotypes.subset(samples=keep_samples).variant_counts()
+    elif dropped.any():
+        variant_called = variant_called - genotypes.subset(samples=dropped).variant_counts()[0]
+
+    keep_variants = variants["AF"].values >= min_af
+    keep_variants &= variant_called / max(keep_samples.sum(), 1) > min_variant_call_rate
+    logger.info("Number of variants: %d, after QC: %d", genotypes.n_variants, keep_variants.sum())
+
+    variants = variants[keep_variants].reset_index(drop=True)
+    variants["feature_id"] = np.arange(len(variants))
+    return GenotypeData(
+        genotypes.subset(samples=keep_samples, variants=keep_variants),
+        variants,
+        samples[keep_samples].reset_index(drop=True),
+    )
+
+
+def allele_balance_mask(gt, ad_ref, ad_alt):
+    """
+    Entries passing the allele balance filter of the Hail GWAS tutorial,
+    with ab = AD[1] / (AD[0] + AD[1]): hom-ref ab <= 0.1, het 0.25 <= ab <= 0.75,
+    hom-alt ab >= 0.9. Missing calls or depths fail. Works on numpy and
+    cupy arrays of any (matching) shape.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ab = ad_alt / (ad_ref + ad_alt)
+    return (((gt == 0) & (ab <= 0.1))
+            | ((gt == 1) & (ab >= 0.25) & (ab <= 0.75))
+            | ((gt == 2) & (ab >= 0.9)))
+
+
+@instrument.instrumented("filter_allele_balance")
+def filter_allele_balance(df):
+    """
+    Set calls failing allele_balance_mask to missing (call_GT = -1) in a
+    long-format frame with call_AD_0 / call_AD_1 columns.
+
+    For GenotypeData the mask is applied while loading, see
+    io.load_genotypes(..., allele_balance=True).
+    """
+    if isinstance(df, GenotypeData):
+        raise ValueError("Allele balance is applied when loading genotypes: use load_genotypes(allele_balance=True)")
+    keep = allele_balance_mask(df['call_GT'], df['call_AD_0'], df['call_AD_1'])
+    logger.info("Fraction of entries failing allele balance: %.4f", 1 - keep.mean())
+    df = df.copy()
+    df['call_GT'] = df['call_GT'].where(keep, -1)
+    return df
+
+
+# exp() of log-probabilities below this is exactly 0.0 in float64
+_LOG_UNDERFLOW = -750.0
+
+
+def hwe_pvalues(n_hom_ref, n_het, n_hom_alt, mid_p=True, max_cells=2 ** 20):
+    """
+    Exact Hardy-Weinberg equilibrium test p-values (Wigginton et al. 2005)
+    for arrays of genotype counts, with Hail's mid-p correction by default.
+    Variants without calls get NaN.
+
+    The het counts of each variant are only evaluated in a window of about
+    40 standard deviations around the expected count (widened where that
+    is not enough); every count outside it has a probability that
+    underflows to 0, so the p-values are those of the full distribution.
+    Windows grow with sqrt(n_samples). Variants are processed in blocks of
+    at most `max_cells` (variant, het count) pairs, sorted by window size,
+    so memory does not depend on the number of samples.
+    """
+    n_hom_ref, n_het, n_hom_alt = (np.asarray(c, dtype=np.int64) for c in (n_hom_ref, n_het, n_hom_alt))
+    n = n_hom_ref + n_het + n_hom_alt
+    n_rare = np.minimum(2 * n_hom_ref + n_het, 2 * n_hom_alt + n_het)
+    expected = n_rare * (2 * n - n_rare) / np.maximum(2 * n - 1, 1)
+    # Het counts share the parity of the rare allele count
+    parity = n_rare % 2
+    center = parity + 2 * ((np.round(expected).astype(np.int64) - parity) // 2)
+    half_width = 2 * np.ceil(20 * np.sqrt(expected + 1)).astype(np.int64)
+
+    p_values = np.full(len(n), np.nan)
+    pending = np.flatnonzero(n > 0)
+    while len(pending):
+        lo = np.maximum(center[pending] - half_width[pending], parity[pending])
+        hi = np.minimum(center[pending] + half_width[pending], n_rare[pending])
+        width = (hi - lo) // 2 + 1
+        order = np.argsort(width, kind="stable")
+        widen = np.zeros(len(pending), dtype=bool)
+        start = 0
+        while start < len(order):
+            # Rows sorted by width, so the last row of a block sets its grid width
+            stop = start + 1
+            while stop < len(order) and (stop - start + 1) * width[order[stop]] <= max_cells:
+                stop += 1
+            block = order[start:stop]
+            rows = pending[block]
+            p_values[rows], widen[block] = _hwe_block(n[rows], n_rare[rows], n_het[rows], lo[block], hi[block], mid_p)
+            start = stop
+        pending = pending[widen]
+        half_width[pending] *= 2
+    return p_values
+
+
+def _hwe_block(n, n_rare, n_het, lo, hi, mid_p):
+    """
+    Exact HWE p-values of one block of variants from the het counts in
+    [lo, hi], and whether the window of a variant must be widened.
+    """
+    from scipy.special import gammaln, logsumexp
+
+    het = lo[:, None] + 2 * np.arange((hi - lo).max() // 2 + 1)[None, :]
+    valid = het <= hi[:, None]
+    hom_rare = (n_rare[:, None] - het) // 2
+    hom_common = n[:, None] - het - hom_rare
+    with np.errstate(invalid="ignore"):
+        # log P(het | n, n_rare) up to a per-variant constant
+        logp = het * np.log(2.0) - gammaln(het + 1) - gammaln(hom_rare + 1) - gammaln(hom_common + 1)
+    logp = np.where(valid, logp, -np.inf)
+    logp -= logsumexp(logp, axis=1, keepdims=True)
+
+    # The distribution is log-concave: beyond window edges below the underflow
+    # threshold, every het count has probability 0
+    rows = np.arange(len(n))
+    widen = (((lo > n_rare % 2) & (logp[:, 0] > _LOG_UNDERFLOW))
+             | ((hi < n_rare) & (logp[rows, (hi - lo) // 2] > _LOG_UNDERFLOW)))
+
+    inside = (n_het >= lo) & (n_het <= hi)
+    observed = np.where(inside, logp[rows, np.clip((n_het - lo) // 2, 0, logp.shape[1] - 1)], -np.inf)
+    p = np.where(logp <= observed[:, None] + 1e-7, np.exp(logp), 0.0).sum(axis=1)
+    if mid_p:
+        p -= 0.5 * np.exp(observed)
+    return np.clip(p, 0.0, 1.0), widen
+
+
+@instrument.instrumented("filter_variant_qc")
+def filter_variant_qc(df, min_af=0.01, min_p_hwe=1e-6):
+    """
+    Variant QC of the Hail benchmark: keep variants with an allele frequency
+    computed from the calls above `min_af` and an exact HWE p-value above
+    `min_p_hwe`, then renumber feature_id. The per-variant genotype counts
+    come from one aggregation (long frame) or one pass over the matrix
+    (GenotypeData, which also gets `AF_calls` and `p_value_hwe` columns).
+    """
+    if isinstance(df, GenotypeData):
+        return _filter_variant_qc_genotypes(df, min_af, min_p_hwe)
+
+    gt = df['call_GT']
+    counts = backend_of(df).df.DataFrame(
+        {'feature_id': df['feature_id'], 'hom_ref': gt == 0, 'het': gt == 1, 'hom_alt': gt == 2}
+    ).groupby('feature_id').sum()
+    hom_ref, het, hom_alt = (to_host(counts[c].values) for c in ('hom_ref', 'het', 'hom_alt'))
+    keep = _variant_qc_mask(hom_ref, het, hom_alt, min_af, min_p_hwe)
+    kept_variants = to_host(counts.index.values)[keep]
+    logger.info("Number of variants: %d, after variant QC: %d", len(counts), len(kept_variants))
+
+    df_filtered = df[df['feature_id'].isin(kept_variants)].reset_index(drop=True)
+    df_filtered['feature_id'] = _renumber(df_filtered['feature_id'], kept_variants)
+    return df_filtered
+
+
+def _variant_qc_mask(hom_ref, het, hom_alt, min_af, min_p_hwe, variants=None):
+    """Computed AF > min_af and HWE p > min_p_hwe, optionally recording both in `variants`."""
+    called = hom_ref + het + hom_alt
+    with np.errstate(divide="ignore", invalid="ignore"):
+        af = (het + 2 * hom_alt) / (2 * called)
+    p_hwe = hwe_pvalues(hom_ref, het, hom_alt)
+    if variants is not None:
+        variants["AF_calls"] = af
+        variants["p_value_hwe"] = p_hwe
+    return (af > min_af) & (p_hwe > min_p_hwe)
+
+
+def _filter_variant_qc_genotypes(data, min_af, min_p_hwe):
+    """filter_variant_qc on a GenotypeData as an index view."""
+    genotypes, variants, samples = data
+    counts = genotypes.qc_counts()
+    het = counts.variant_het
+    hom_alt = (counts.variant_alt - het) // 2
+    hom_ref = counts.variant_called - het - hom_alt
+
+    variants = variants.copy()
+    keep = _variant_qc_mask(hom_ref, het, hom_alt, min_af, min_p_hwe, variants)
+    logger.info("Number of variants: %d, after variant QC: %d", genotypes.n_variants, keep.sum())
 
-    return df_filtered
\ No newline at end of file
+    variants = variants[keep].reset_index(drop=True)
+    variants["feature_id"] = np.arange(len(variants))
+    return GenotypeData(genotypes.subset(variants=keep), variants, samples)
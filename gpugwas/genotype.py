@@ -0,0 +1,259 @@
+"""Module for compact genotype matrix storage."""
+
+from collections import namedtuple
+import json
+import os
+
+import numpy as np
+
+
+# 2-bit call codes, four calls per byte (PLINK .bed style packing)
+MISSING = 3
+
+# _CODES[b, i] is the code of the i-th call packed in byte b
+_CODES = ((np.arange(256, dtype=np.uint8)[:, None] >> (2 * np.arange(4, dtype=np.uint8))) & 3).astype(np.uint8)
+_DOSAGE = np.array([0, 1, 2, -1], dtype=np.int8)
+_ALT = np.array([0, 1, 2, 0], dtype=np.uint8)
+_BYTE_CALLED = (_CODES != MISSING).sum(axis=1)
+_BYTE_ALT = _ALT[_CODES].sum(axis=1)
+
+
+GenotypeData = namedtuple("GenotypeData", ["genotypes", "variants", "samples"])
+GenotypeData.__doc__ = """
+Genotypes of a cohort with their annotation tables.
+
+genotypes: GenotypeMatrix
+    (n_samples, n_variants) hard calls.
+variants: pd.DataFrame
+    One row per matrix column (feature_id, chrom, pos, ref, alt, ...).
+samples: pd.DataFrame
+    One row per matrix row, with a `sample` name column and per-sample
+    statistics gathered while loading (e.g. `dp_mean`).
+"""
+
+
+QCCounts = namedtuple("QCCounts", ["sample_called", "sample_alt", "variant_called", "variant_alt", "variant_het"])
+QCCounts.__doc__ = """Per-sample (called, alt allele) and per-variant (called, alt allele, het) counts of a GenotypeMatrix."""
+
+
+def _array_module(xp):
+    return np if xp is None else xp
+
+
+def pack_dosage(dosage):
+    """
+    Pack a (n_samples, n_variants) dosage array (0/1/2, anything else is
+    missing) into variant-major bytes of shape (n_variants, ceil(n_samples / 4)).
+    """
+    dosage = np.asarray(dosage)
+    n_samples, n_variants = dosage.shape
+    codes = np.where((dosage >= 0) & (dosage <= 2), dosage, MISSING).astype(np.uint8).T
+    n_bytes = (n_samples + 3) // 4
+    padded = np.full((n_variants, n_bytes * 4), MISSING, dtype=np.uint8)
+    padded[:, :n_samples] = codes
+    padded = padded.reshape(n_variants, n_bytes, 4)
+    return padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+
+class GenotypeMatrix:
+    """
+    Hard-called genotypes packed to 2 bits per call.
+
+    Calls are stored variant-major (one row of packed bytes per variant)
+    and exposed as a (n_samples, n_variants) matrix. Sample and variant
+    subsets are index views over the packed bytes, so filtering never
+    copies the genotypes. Unpacking to int8 or float happens per block,
+    on the host or on the device (`xp=cupy`, only packed bytes are copied).
+    """
+
+    def __init__(self, packed, n_samples, sample_index=None, variant_index=None):
+        self.packed = packed
+        self.n_stored_samples = n_samples
+        self.sample_index = sample_index
+        self.variant_index = variant_index
+
+    @classmethod
+    def from_dosage(cls, dosage):
+        """Build from a (n_samples, n_variants) dosage array with -1 for missing."""
+        dosage = np.asarray(dosage)
+        return cls(pack_dosage(dosage), dosage.shape[0])
+
+    @classmethod
+    def concat(cls, matrices):
+        """Stack matrices over the same samples along the variant axis."""
+        n_samples = matrices[0].n_stored_samples
+        packed = []
+        for matrix in matrices:
+            if matrix.n_stored_samples != n_samples or matrix.sample_index is not None:
+                raise ValueError("Can only concatenate matrices over the same samples")
+            packed.append(matrix._packed_rows())
+        return cls(np.concatenate(packed, axis=0), n_samples)
+
+    def save(self, path, block_size=65536):
+        """
+        Write the calls of this matrix (views included) to the directory
+        `path`, block by block, so it can be reopened memory-mapped with `load`.
+        """
+        os.makedirs(path, exist_ok=True)
+        packed = np.lib.format.open_memmap(
+            os.path.join(path, "packed.npy"), mode="w+", dtype=np.uint8,
+            shape=(self.n_variants, (self.n_samples + 3) // 4),
+        )
+        for start in range(0, self.n_variants, block_size):
+            stop = min(start + block_size, self.n_variants)
+            if self.sample_index is None:
+                packed[start:stop] = self._packed_rows(slice(start, stop))
+            else:
+                packed[start:stop] = pack_dosage(self.to_int8(slice(start, stop)))
+        packed.flush()
+        with open(os.path.join(path, "genotypes.json"), "w") as f:
+            json.dump({"n_samples": self.n_samples, "n_variants": self.n_variants}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Open a matrix written by `save`, memory-mapped by default (out-of-core)."""
+        with open(os.path.join(path, "genotypes.json")) as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(path, "packed.npy"), mmap_mode=mmap_mode), meta["n_samples"])
+
+    @property
+    def n_samples(self):
+        if self.sample_index is None:
+            return self.n_stored_samples
+        return len(self.sample_index)
+
+    @property
+    def n_variants(self):
+        if self.variant_index is None:
+            return self.packed.shape[0]
+        return len(self.variant_index)
+
+    @property
+    def shape(self):
+        return (self.n_samples, self.n_variants)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def subset(self, samples=None, variants=None):
+        """
+        Return a view restricted to `samples` / `variants` (boolean masks or
+        integer positions relative to this matrix).
+        """
+        sample_index = self.sample_index
+        if samples is not None:
+            samples = np.asarray(samples)
+            if samples.dtype == bool:
+                samples = np.flatnonzero(samples)
+            sample_index = samples if sample_index is None else sample_index[samples]
+        variant_index = self.variant_index
+        if variants is not None:
+            variants = np.asarray(variants)
+            if variants.dtype == bool:
+                variants = np.flatnonzero(variants)
+            variant_index = variants if variant_index is None else variant_index[variants]
+        return GenotypeMatrix(self.packed, self.n_stored_samples, sample_index, variant_index)
+
+    def _packed_rows(self, variants=slice(None)):
+        if self.variant_index is None:
+            return self.packed[variants]
+        return self.packed[self.variant_index[variants]]
+
+    def to_codes(self, variants=slice(None), xp=None):
+        """Unpack to a (n_samples, n_block_variants) uint8 array of 2-bit codes."""
+        xp = _array_module(xp)
+        packed = xp.asarray(self._packed_rows(variants))
+        if self.sample_index is not None and 4 * len(self.sample_index) < self.n_stored_samples:
+            # Few samples: shift their codes out of their bytes instead of unpacking whole rows
+            index = xp.asarray(self.sample_index)
+            return ((packed[:, index // 4] >> (2 * (index % 4)).astype(xp.uint8)) & 3).T
+        codes = xp.asarray(_CODES)[packed]
+        codes = codes.reshape(packed.shape[0], codes.shape[1] * codes.shape[2])[:, : self.n_stored_samples]
+        if self.sample_index is not None:
+            codes = codes[:, xp.asarray(self.sample_index)]
+        return codes.T
+
+    def to_int8(self, variants=slice(None), xp=None):
+        """Unpack to int8 dosages (0/1/2, -1 for missing)."""
+        xp = _array_module(xp)
+        return xp.asarray(_DOSAGE)[self.to_codes(variants, xp)]
+
+    def to_float(self, variants=slice(None), dtype=np.float32, impute="mean", xp=None):
+        """
+        Unpack to float dosages. Missing calls are replaced by the mean
+        dosage of the variant (impute="mean") or left as NaN (impute=None).
+        """
+        xp = _array_module(xp)
+        codes = self.to_codes(variants, xp)
+        missing = codes == MISSING
+        values = codes.astype(dtype)
+        if impute == "mean":
+            n_called = (~missing).sum(axis=0)
+            total = xp.where(missing, 0, values).sum(axis=0)
+            means = total / xp.maximum(n_called, 1)
+            values = xp.where(missing, means[None, :].astype(dtype), values)
+        elif impute is None:
+            values[missing] = xp.nan
+        else:
+            raise ValueError(f"Unknown impute mode '{impute}'")
+        return values
+
+    def iter_blocks(self, block_size, **kwargs):
+        """Yield (start, float block) pairs of at most `block_size` variants."""
+        for start in range(0, self.n_variants, block_size):
+            stop = min(start + block_size, self.n_variants)
+            yield start, self.to_float(slice(start, stop), **kwargs)
+
+    def variant_counts(self, block_size=65536):
+        """Per-variant (called, alt allele) counts, without unpacking when possible."""
+        called = np.empty(self.n_variants, dtype=np.int64)
+        alt = np.empty(self.n_variants, dtype=np.int64)
+        for start in range(0, self.n_variants, block_size):
+            stop = min(start + block_size, self.n_variants)
+            if self.sample_index is None:
+                # Padding calls are coded missing, so whole bytes can be counted
+                packed = self._packed_rows(slice(start, stop))
+                called[start:stop] = _BYTE_CALLED[packed].sum(axis=1, dtype=np.int64)
+                alt[start:stop] = _BYTE_ALT[packed].sum(axis=1, dtype=np.int64)
+            else:
+                codes = self.to_codes(slice(start, stop))
+                called[start:stop] = (codes != MISSING).sum(axis=0, dtype=np.int64)
+                alt[start:stop] = _ALT[codes].sum(axis=0, dtype=np.int64)
+        return called, alt
+
+    def sample_counts(self, block_size=65536):
+        """Per-sample (called, alt allele) counts."""
+        called = np.zeros(self.n_samples, dtype=np.int64)
+        alt = np.zeros(self.n_samples, dtype=np.int64)
+        for start in range(0, self.n_variants, block_size):
+            codes = self.to_codes(slice(start, start + block_size))
+            called += (codes != MISSING).sum(axis=1, dtype=np.int64)
+            alt += _ALT[codes].sum(axis=1, dtype=np.int64)
+        return called, alt
+
+    def qc_counts(self, block_size=8192, sample_mask=None):
+        """
+        Per-sample (called, alt allele) and per-variant (called, alt allele,
+        het) counts in a single pass over the calls, unpacking every block of
+        variants only once. With `sample_mask` the per-variant counts cover
+        only the masked samples (e.g. the ones kept by sample QC).
+        """
+        sample_called = np.zeros(self.n_samples, dtype=np.int64)
+        sample_alt = np.zeros(self.n_samples, dtype=np.int64)
+        variant_called = np.empty(self.n_variants, dtype=np.int64)
+        variant_alt = np.empty(self.n_variants, dtype=np.int64)
+        variant_het = np.empty(self.n_variants, dtype=np.int64)
+        for start in range(0, self.n_variants, block_size):
+            stop = min(start + block_size, self.n_variants)
+            codes = self.to_codes(slice(start, stop))
+            called = codes != MISSING
+            alt = _ALT[codes]
+            sample_called += called.sum(axis=1, dtype=np.int64)
+            sample_alt += alt.sum(axis=1, dtype=np.int64)
+            if sample_mask is not None:
+                codes, called, alt = codes[sample_mask], called[sample_mask], alt[sample_mask]
+            variant_called[start:stop] = called.sum(axis=0, dtype=np.int64)
+            variant_alt[start:stop] = alt.sum(axis=0, dtype=np.int64)
+            variant_het[start:stop] = (codes == 1).sum(axis=0, dtype=np.int64)
+        return QCCounts(sample_called, sample_alt, variant_called, variant_alt, variant_het)
@@ -0,0 +1,332 @@
+"""Module for per-stage timing and memory instrumentation of the pipeline.
+
+Stages are recorded with the `stage` context manager or the `instrumented`
+decorator into a Report (a module-level one by default), which can be
+written out as JSON:
+
+    with instrument.stage("filter", rows_in=len(df)) as record:
+        df = ...
+        record["rows_out"] = len(df)
+    instrument.get_report().to_json("report.json")
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Set to 1 to measure host peaks exactly by resetting the process-wide VmHWM (Linux)
+EXACT_PEAK_ENV_VAR = "GPUGWAS_EXACT_PEAK_MEMORY"
+
+
+def _cupy():
+    """The cupy module if it is already imported, never importing it ourselves."""
+    return sys.modules.get("cupy")
+
+
+def available_memory(backend="numpy"):
+    """Free device memory for 'cupy' (including the pool's cached blocks), available host RAM otherwise."""
+    if backend == "cupy":
+        import cupy
+
+        free, _ = cupy.cuda.runtime.memGetInfo()
+        return free + cupy.get_default_memory_pool().free_bytes()
+    try:
+        import psutil
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return psutil.virtual_memory().available
+
+
+def host_memory():
+    """Resident set size of the process in bytes, None when it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def host_peak_memory():
+    """
+    High-water mark of the process resident set size in bytes since the
+    last reset_host_peak_memory (since process start where it cannot be reset).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_host_peak_memory():
+    """
+    Restart the resident set size high-water mark (Linux), False when the
+    OS does not support it. The mark is process-wide, so this also resets
+    it for any profiler or caller reading VmHWM.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def device_memory():
+    """Device bytes allocated by this process (RMM statistics when enabled, else the CuPy pool), None without cupy."""
+    cupy = _cupy()
+    if cupy is None:
+        return None
+    try:
+        statistics = _rmm_statistics()
+        if statistics is not None:
+            return statistics.get_statistics().current_bytes
+        return cupy.get_default_memory_pool().used_bytes()
+    except Exception:
+        # e.g. no visible device
+        return None
+
+
+def _rmm_statistics():
+    """rmm.statistics when RMM is imported and its allocation statistics are enabled."""
+    if "rmm" not in sys.modules:
+        return None
+    try:
+        import rmm.statistics
+    except ImportError:
+        return None
+    return rmm.statistics if rmm.statistics.is_statistics_enabled() else None
+
+
+class PeakMemory:
+    """
+    Context manager measuring the peak host and device memory of a block of
+    code, as absolute bytes (`host_peak`, `device_peak`) and relative to its
+    start (`host_delta`, `device_delta`).
+
+    Current usage is sampled every `interval` seconds by a background
+    thread, so peaks shorter than that can be missed. With `exact_host`
+    (default: the GPUGWAS_EXACT_PEAK_MEMORY environment variable set to 1)
+    the host peak is instead the resident set size high-water mark, reset
+    on entry where the OS allows it (Linux); this resets the process-wide
+    VmHWM, so it is opt-in. Device peaks come from RMM's scoped statistics
+    when they are enabled, else from sampling. Scopes nest: each one hands
+    its peak to the enclosing scope on exit, so resetting the high-water
+    mark for an inner scope does not hide it from outer ones.
+    """
+
+    _active = []
+
+    def __init__(self, interval=0.01, exact_host=None):
+        self.interval = interval
+        if exact_host is None:
+            exact_host = os.environ.get(EXACT_PEAK_ENV_VAR) == "1"
+        self.exact_host = exact_host
+        self.host_start = self.host_peak = None
+        self.device_start = self.device_peak = None
+        self._exact_host = False
+        self._rmm = None
+        self._sampler = None
+
+    @property
+    def host_delta(self):
+        return None if self.host_peak is None else self.host_peak - self.host_start
+
+    @property
+    def device_delta(self):
+        return None if self.device_peak is None else self.device_peak - self.device_start
+
+    def _add(self, host=None, device=None):
+        if host is not None:
+            self.host_peak = host if self.host_peak is None else max(self.host_peak, host)
+        if device is not None:
+            self.device_peak = device if self.device_peak is None else max(self.device_peak, device)
+
+    def _sample(self, stop):
+        while not stop.wait(self.interval):
+            self._add(None if self._exact_host else host_memory(), None if self._rmm else device_memory())
+
+    def __enter__(self):
+        parent = self._active[-1] if self._active else None
+        if parent is not None and parent._exact_host:
+            # Keep what the parent reached before the mark is reset
+            parent._add(host=host_peak_memory())
+        self.host_start = self.host_peak = host_memory()
+        self.device_start = self.device_peak = device_memory()
+        self._exact_host = self.exact_host and self.host_start is not None and reset_host_peak_memory()
+        self._rmm = _rmm_statistics() if self.device_start is not None else None
+        if self._rmm is not None:
+            self._rmm.push_statistics()
+        if not self._exact_host or (self.device_start is not None and self._rmm is None):
+            stop = threading.Event()
+            thread = threading.Thread(target=self._sample, args=(stop,), daemon=True)
+            thread.start()
+            self._sampler = (stop, thread)
+        self._active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        self._active.remove(self)
+        if self._sampler is not None:
+            stop, thread = self._sampler
+            stop.set()
+            thread.join()
+            self._sampler = None
+        if self._exact_host:
+            self._add(host=host_peak_memory())
+        if self._rmm is not None:
+            # Scoped statistics count only the allocations made inside the scope
+            self._add(device=self.device_start + self._rmm.pop_statistics().peak_bytes)
+        self._add(host_memory(), device_memory())
+        parent = self._active[-1] if self._active else None
+        if parent is not None:
+            parent._add(self.host_peak, self.device_peak)
+        return False
+
+
+def _n_rows(obj):
+    """Best-effort row count of a stage input or output."""
+    if obj is None or isinstance(obj, (str, bytes)):
+        return None
+    genotypes = getattr(obj, "genotypes", None)
+    if genotypes is not None and hasattr(genotypes, "n_variants"):
+        return int(genotypes.n_variants)
+    if isinstance(obj, tuple) and obj:
+        return _n_rows(obj[0])
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+class Report:
+    """
+    Ordered list of stage records (dicts) with JSON export. Only the last
+    `max_stages` records are kept (None: all), so a long-lived process
+    does not accumulate the stages of every run; `dropped_stages` counts
+    the others.
+    """
+
+    def __init__(self, max_stages=10000):
+        self.stages = []
+        self.max_stages = max_stages
+        self.dropped_stages = 0
+        self._active = []
+
+    def add(self, record):
+        """Append a stage record, dropping the oldest ones beyond `max_stages`."""
+        self.stages.append(record)
+        if self.max_stages is not None and len(self.stages) > self.max_stages:
+            n_dropped = len(self.stages) - self.max_stages
+            del self.stages[:n_dropped]
+            self.dropped_stages += n_dropped
+
+    def current(self):
+        """Record of the innermost running stage, None outside stages."""
+        return self._active[-1] if self._active else None
+
+    def to_dict(self):
+        return {
+            "stages": self.stages,
+            "total_wall_time": sum(s.get("wall_time", 0.0) for s in self.stages if s.get("depth") == 0),
+            "dropped_stages": self.dropped_stages,
+        }
+
+    def to_json(self, path=None):
+        """Return the report as a JSON string and write it to `path` when given."""
+        text = json.dumps(self.to_dict(), indent=2, default=str)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+
+_report = Report()
+
+
+def get_report():
+    return _report
+
+
+def reset_report():
+    """Start a fresh module-level report and return it."""
+    global _report
+    _report = Report()
+    return _report
+
+
+def annotate(**fields):
+    """Attach extra fields to the innermost running stage record."""
+    record = _report.current()
+    if record is not None:
+        record.update(fields)
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, report=None):
+    """
+    Record wall time, rows in/out and the peak host/device memory of a
+    block of code (see PeakMemory): `*_peak_bytes` is the peak reached
+    during the stage, `*_peak_delta_bytes` that peak minus the usage on
+    entry. The yielded record dict can be updated (e.g. `rows_out`).
+    """
+    report = report if report is not None else _report
+    record = {"stage": name, "rows_in": rows_in, "rows_out": None, "depth": len(report._active)}
+    report._active.append(record)
+    report.add(record)
+    start = time.perf_counter()
+    memory = PeakMemory()
+    try:
+        with memory:
+            yield record
+    finally:
+        record["wall_time"] = time.perf_counter() - start
+        record["host_peak_bytes"] = memory.host_peak
+        record["host_peak_delta_bytes"] = memory.host_delta
+        record["device_peak_bytes"] = memory.device_peak
+        record["device_peak_delta_bytes"] = memory.device_delta
+        report._active.pop()
+        logger.info(
+            "%s: %.3fs rows %s -> %s",
+            name,
+            record["wall_time"],
+            record["rows_in"],
+            record["rows_out"],
+        )
+
+
+def instrumented(name=None):
+    """Decorator running the function inside a `stage` named after it."""
+
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rows_in = _n_rows(args[0]) if args else None
+            with stage(stage_name, rows_in=rows_in) as record:
+                result = func(*args, **kwargs)
+                record["rows_out"] = _n_rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
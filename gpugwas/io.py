@@ -1,11 +1,23 @@
 """Module for loading data into dataframe."""
 
-import cudf
+import numpy as np
 import pysam
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import hashlib
+import json
+import logging
 import math
 import os
+import shutil
+
+from gpugwas import instrument
+from gpugwas.backend import get_backend
+from gpugwas.filter import allele_balance_mask
+from gpugwas.genotype import GenotypeData, GenotypeMatrix
+
+logger = logging.getLogger(__name__)
 
 
 nucleotide_dict = {"A": 1, "C": 2, "G": 3, "T": 4}
@@ -70,34 +82,26 @@ def _create_numerical_features(df, groupby_columns=["chrom", "pos", "ref", "alt"
     return df, feature_mapping
 
 
-def load_vcf(vcf_file, info_keys=[], format_keys=[]):
-    """Function to load VCF into gwas dataframe."""
-    # Load VCF file using pysam
-    reader = pysam.VariantFile(vcf_file)
-
+def _expand_keys(reader, info_keys, format_keys):
+    """Replace a "*" wildcard with all INFO/FORMAT keys declared in the header."""
     if "*" in info_keys:
-        header_dict = dict(reader.header.info)
-        new_keys = []
-        for k in header_dict.keys():
-            new_keys.append(k)
-        info_keys = new_keys
+        info_keys = list(dict(reader.header.info).keys())
     if "*" in format_keys:
-        header_dict = dict(reader.header.formats)
-        new_keys = []
-        for k in header_dict.keys():
-            new_keys.append(k)
-        format_keys = new_keys
+        format_keys = list(dict(reader.header.formats).keys())
+    return list(info_keys), list(format_keys)
 
-    print(info_keys)
-    info_keys = set(info_keys)
-    print(format_keys)
-    format_keys = set(format_keys)
 
+def _is_biallelic_snv(record):
+    if record.alts is None or len(record.alts) != 1:
+        return False
+    return record.ref in nucleotide_dict and record.alts[0] in nucleotide_dict
+
+
+def _parse_records(records, info_keys, format_keys):
+    """Parse pysam records into the long (key, value) frame used by load_vcf."""
     df_dict = defaultdict(list)
-    for record in reader:
-        if len(record.alts) != 1:
-            continue
-        if record.ref not in nucleotide_dict or record.alts[0] not in nucleotide_dict:
+    for record in records:
+        if not _is_biallelic_snv(record):
             continue
 
         # Run through all variants and all their keys in format
@@ -122,20 +126,607 @@ def load_vcf(vcf_file, info_keys=[], format_keys=[]):
                 # _add_basic_component(record, sample, df_dict)
                 _add_key_value(record, sample, key, value, df_dict)
 
-    df = pd.DataFrame.from_dict(df_dict)
+    return pd.DataFrame.from_dict(df_dict)
+
+
+_pivot_index = ["chrom", "pos", "ref", "alt", "sample", "quality"]
+
+
+def _parse_region(vcf_file, contig, start, end, info_keys, format_keys):
+    """Parse and pivot the records starting inside one region of an indexed VCF."""
+    reader = pysam.VariantFile(vcf_file)
+    records = reader.fetch(contig, start, end)
+    if start is not None:
+        # fetch also returns records overlapping the start of the window
+        records = (record for record in records if record.start >= start)
+    df = _parse_records(records, info_keys, format_keys)
+    if len(df) == 0:
+        return df
+    return df.pivot_table(index=_pivot_index, columns="key", values="value").reset_index()
+
+
+def _empty_vcf_frames(info_keys, format_keys):
+    """The load_vcf frame and feature mapping of a VCF without biallelic SNVs."""
+    value_cols = sorted([f"call_{key}" for key in format_keys] + list(info_keys))
+    df = pd.DataFrame(columns=_pivot_index + ["feature_id"] + value_cols)
+    feature_mapping = pd.DataFrame(columns=["feature_id", "chrom", "pos", "ref", "alt"])
+    return df, feature_mapping
+
+
+def _vcf_regions(reader, region_size):
+    """Split the indexed contigs of a VCF into (contig, start, end) windows."""
+    regions = []
+    for name in reader.index:
+        contig = reader.header.contigs.get(name)
+        if contig is None or contig.length is None:
+            regions.append((name, None, None))
+            continue
+        for start in range(0, contig.length, region_size):
+            regions.append((name, start, min(start + region_size, contig.length)))
+    return regions
+
+
+def _load_vcf_parallel(vcf_file, regions, info_keys, format_keys, num_workers):
+    """Parse regions in a process pool and stitch them together in genomic order."""
+    n = len(regions)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        parts = pool.map(
+            _parse_region,
+            [vcf_file] * n,
+            [r[0] for r in regions],
+            [r[1] for r in regions],
+            [r[2] for r in regions],
+            [info_keys] * n,
+            [format_keys] * n,
+        )
+        parts = [part for part in parts if len(part) > 0]
+    if not parts:
+        return _empty_vcf_frames(info_keys, format_keys)
+    df = pd.concat(parts, ignore_index=True)
+
+    # Same feature_ids as the serial path: ordered by chrom, pos, ref, alt
+    df, feature_mapping = _create_numerical_features(df)
+    df = df.sort_values(by=["feature_id", "sample"]).reset_index(drop=True)
+    value_cols = sorted(c for c in df.columns if c not in _pivot_index + ["feature_id"])
+    df = df[_pivot_index + ["feature_id"] + value_cols]
+    return df, feature_mapping
+
+
+@instrument.instrumented("load_vcf")
+def load_vcf(
+    vcf_file,
+    info_keys=[],
+    format_keys=[],
+    cache_dir=None,
+    num_workers=None,
+    region_size=5000000,
+):
+    """
+    Function to load VCF into gwas dataframe.
+
+    When `cache_dir` is set the VCF is parsed once into an on-disk cache
+    (see open_vcf_cache) and later calls are served from it. The cache
+    only saves the parsing: the long (variant, sample) frame is still
+    built in memory from it. Use load_genotypes for genotypes served
+    memory-mapped from the cache.
+
+    Indexed (bgzip + tabix/csi) VCFs are split into `region_size` bp
+    windows parsed by `num_workers` processes (default: all cores).
+    Unindexed files are parsed serially.
+    """
+    if cache_dir is not None:
+        cache = open_vcf_cache(vcf_file, cache_dir, info_keys, format_keys)
+        df, feature_mapping = _block_to_long_df(cache)
+        return get_backend().df.DataFrame(df), feature_mapping
+
+    # Load VCF file using pysam
+    reader = pysam.VariantFile(vcf_file)
+    info_keys, format_keys = _expand_keys(reader, info_keys, format_keys)
+
+    logger.info("INFO keys: %s", info_keys)
+    info_keys = set(info_keys)
+    logger.info("FORMAT keys: %s", format_keys)
+    format_keys = set(format_keys)
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    regions = _vcf_regions(reader, region_size) if reader.index is not None else []
+    if num_workers > 1 and len(regions) > 1:
+        reader.close()
+        df, feature_mapping = _load_vcf_parallel(
+            vcf_file, regions, info_keys, format_keys, num_workers
+        )
+        return get_backend().df.DataFrame(df), feature_mapping
+
+    df = _parse_records(reader, info_keys, format_keys)
+    if len(df) == 0:
+        df, feature_mapping = _empty_vcf_frames(info_keys, format_keys)
+        return get_backend().df.DataFrame(df), feature_mapping
     df, feature_mapping = _create_numerical_features(df)
     df = df.pivot_table(
         index=["chrom", "pos", "ref", "alt", "sample", "quality", "feature_id"],
         columns="key",
         values="value",
     ).reset_index()
-    cuda_df = cudf.DataFrame(df)
-    return cuda_df, feature_mapping
+    return get_backend().df.DataFrame(df), feature_mapping
+
+
+VariantBlock = namedtuple("VariantBlock", ["variants", "samples", "calls"])
+VariantBlock.__doc__ = """
+A block of consecutive variants from a VCF file.
+
+variants: pd.DataFrame
+    One row per variant with feature_id, chrom, pos, ref, alt, quality
+    and the requested INFO keys.
+samples: list
+    Sample names, in the order of the matrix rows.
+calls: dict
+    Dense (n_samples, n_variants) arrays per FORMAT key, named like the
+    load_vcf columns (call_GT, call_DP, call_AD_0, ...). call_GT holds
+    the alt allele dosage as int8 with -1 for missing calls, other keys
+    are float32 with NaN for missing values.
+"""
+
+
+def _value_width(header_field):
+    """Number of values a biallelic record carries for a header field."""
+    number = header_field.number
+    if number == "A":
+        return 1
+    if number == "R":
+        return 2
+    if number == "G":
+        return 3
+    if isinstance(number, int) and number > 0:
+        return number
+    return 1
+
+
+def _value_names(key, width):
+    if width == 1:
+        return [key]
+    return [f"{key}_{i}" for i in range(width)]
+
+
+def _fill_values(value, width, out, row):
+    """Write a scalar/tuple pysam value into out[:, row] (NaN when missing)."""
+    if value is None:
+        return
+    if not isinstance(value, (tuple, list)):
+        value = (value,)
+    for i, val in enumerate(value[:width]):
+        if val is not None:
+            out[i][row] = val
+
+
+def _format_call_keys(reader, format_keys):
+    """Map each FORMAT key to the call_* array names it expands to."""
+    call_keys = {}
+    for key in format_keys:
+        if key == "GT":
+            call_keys[key] = ["call_GT"]
+        else:
+            width = _value_width(reader.header.formats[key])
+            call_keys[key] = _value_names(f"call_{key}", width)
+    return call_keys
+
+
+def _info_keys(reader, info_keys):
+    """Map each INFO key to the variant table columns it expands to."""
+    return {
+        key: _value_names(key, _value_width(reader.header.info[key]))
+        for key in info_keys
+    }
+
+
+def _empty_block_buffers(call_keys, info_cols, n_variants, n_samples):
+    calls = {}
+    for names in call_keys.values():
+        for name in names:
+            if name == "call_GT":
+                calls[name] = np.full((n_variants, n_samples), -1, dtype=np.int8)
+            else:
+                calls[name] = np.full((n_variants, n_samples), np.nan, dtype=np.float32)
+    variants = {"chrom": [], "pos": [], "ref": [], "alt": [], "quality": []}
+    for names in info_cols.values():
+        for name in names:
+            variants[name] = np.full(n_variants, np.nan, dtype=np.float64)
+    return calls, variants
+
+
+def _fill_record(record, row, call_keys, info_cols, calls, variants):
+    """Write the calls and INFO values of one record into row `row` of the buffers."""
+    variants["chrom"].append(record.chrom)
+    variants["pos"].append(record.pos)
+    variants["ref"].append(nucleotide_dict[record.ref])
+    variants["alt"].append(nucleotide_dict[record.alts[0]])
+    variants["quality"].append(record.qual)
+
+    for key, names in info_cols.items():
+        value = record.info.get(key)
+        _fill_values(value, len(names), [variants[n] for n in names], row)
+
+    for j, sample in enumerate(record.samples.values()):
+        for key, names in call_keys.items():
+            value = sample.get(key)
+            if key == "GT":
+                if value is not None and None not in value:
+                    calls["call_GT"][row, j] = sum(value)
+            else:
+                _fill_values(value, len(names), [calls[n][row] for n in names], j)
+
+
+def _finish_block(calls, variants, n_variants, first_feature_id, samples):
+    block_calls = {
+        name: np.ascontiguousarray(values[:n_variants].T)
+        for name, values in calls.items()
+    }
+    block_variants = pd.DataFrame(
+        {name: values[:n_variants] for name, values in variants.items()}
+    )
+    block_variants.insert(
+        0, "feature_id", np.arange(first_feature_id, first_feature_id + n_variants)
+    )
+    return VariantBlock(block_variants, samples, block_calls)
+
+
+def iter_vcf_blocks(
+    vcf_file,
+    variants_per_block=10000,
+    info_keys=["AF"],
+    format_keys=["GT", "DP"],
+    region=None,
+):
+    """
+    Generator yielding VariantBlock objects of at most `variants_per_block`
+    biallelic SNVs, so only one block of calls is held in memory at a time.
+
+    feature_ids are assigned consecutively in file order. `region` (e.g.
+    "1:10000-20000") restricts the scan to an indexed region.
+    """
+    reader = pysam.VariantFile(vcf_file)
+    info_keys, format_keys = _expand_keys(reader, info_keys, format_keys)
+    samples = list(reader.header.samples)
+    call_keys = _format_call_keys(reader, format_keys)
+    info_cols = _info_keys(reader, info_keys)
+
+    records = reader.fetch(region=region) if region is not None else reader
+    first_feature_id = 0
+    row = 0
+    calls, variants = _empty_block_buffers(call_keys, info_cols, variants_per_block, len(samples))
+    for record in records:
+        if not _is_biallelic_snv(record):
+            continue
+        _fill_record(record, row, call_keys, info_cols, calls, variants)
+        row += 1
+        if row == variants_per_block:
+            yield _finish_block(calls, variants, row, first_feature_id, samples)
+            first_feature_id += row
+            row = 0
+            calls, variants = _empty_block_buffers(call_keys, info_cols, variants_per_block, len(samples))
+
+    if row > 0:
+        yield _finish_block(calls, variants, row, first_feature_id, samples)
+
+
+def _cache_key(vcf_file, info_keys, format_keys):
+    """Key a cache entry by file path, mtime, size and the selected keys."""
+    stat = os.stat(vcf_file)
+    payload = json.dumps(
+        [
+            os.path.abspath(vcf_file),
+            stat.st_mtime_ns,
+            stat.st_size,
+            sorted(info_keys),
+            sorted(format_keys),
+        ]
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()[:20]
+
+
+def build_vcf_cache(vcf_file, cache_path, info_keys, format_keys, variants_per_block=10000):
+    """
+    Parse a VCF once into a memory-mappable bundle at `cache_path`.
+
+    The bundle holds one raw variant-major array per call key (int8 GT
+    dosage, float32 otherwise), one .npy per variant table column, the
+    sample list and a manifest.json describing shapes and dtypes, and the
+    size and mtime of the VCF it was parsed from. An existing bundle at
+    `cache_path` is replaced unless it is current (see vcf_cache_is_current).
+    """
+    # Taken before parsing, so a VCF modified meanwhile leaves a stale entry
+    source = _source_stat(vcf_file)
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    call_files = {}
+    call_dtypes = {}
+    variant_parts = []
+    samples = []
+    try:
+        for block in iter_vcf_blocks(
+            vcf_file,
+            variants_per_block=variants_per_block,
+            info_keys=info_keys,
+            format_keys=format_keys,
+        ):
+            samples = block.samples
+            variant_parts.append(block.variants)
+            for name, values in block.calls.items():
+                if name not in call_files:
+                    call_files[name] = open(os.path.join(tmp_path, f"{name}.bin"), "wb")
+                    call_dtypes[name] = values.dtype.str
+                # Store variant-major so blocks are appended contiguously
+                call_files[name].write(np.ascontiguousarray(values.T).tobytes())
+    finally:
+        for f in call_files.values():
+            f.close()
+
+    if not samples:
+        samples = list(pysam.VariantFile(vcf_file).header.samples)
+    variants = pd.concat(variant_parts, ignore_index=True) if variant_parts else pd.DataFrame()
+    for col in variants.columns:
+        values = variants[col].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(tmp_path, f"variant_{col}.npy"), values)
+    np.save(os.path.join(tmp_path, "samples.npy"), np.asarray(samples, dtype=str))
+
+    manifest = {
+        "vcf_file": os.path.abspath(vcf_file),
+        "source": source,
+        "n_samples": len(samples),
+        "n_variants": len(variants),
+        "info_keys": list(info_keys),
+        "format_keys": list(format_keys),
+        "calls": call_dtypes,
+        "variant_columns": list(variants.columns),
+    }
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(os.path.join(cache_path, "manifest.json")) and not vcf_cache_is_current(cache_path, vcf_file):
+        shutil.rmtree(cache_path, ignore_errors=True)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Another process finished the same cache entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return cache_path
+
+
+def _source_stat(vcf_file):
+    stat = os.stat(vcf_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def vcf_cache_is_current(cache_path, vcf_file):
+    """True when the bundle at `cache_path` was built from `vcf_file` as it is now (same size and mtime)."""
+    try:
+        with open(os.path.join(cache_path, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return manifest.get("source") == _source_stat(vcf_file)
+
+
+def read_vcf_cache(cache_path):
+    """
+    Open a bundle written by build_vcf_cache as a VariantBlock spanning the
+    whole file. Call arrays are read-only memory maps (samples x variants
+    views), nothing is loaded until it is accessed.
+    """
+    with open(os.path.join(cache_path, "manifest.json")) as f:
+        manifest = json.load(f)
+    n_variants = manifest["n_variants"]
+    n_samples = manifest["n_samples"]
+
+    calls = {}
+    for name, dtype in manifest["calls"].items():
+        values = np.memmap(
+            os.path.join(cache_path, f"{name}.bin"),
+            dtype=np.dtype(dtype),
+            mode="r",
+            shape=(n_variants, n_samples),
+        )
+        calls[name] = values.T
+    variants = pd.DataFrame(
+        {
+            col: np.load(os.path.join(cache_path, f"variant_{col}.npy"), mmap_mode="r")
+            for col in manifest["variant_columns"]
+        }
+    )
+    samples = list(np.load(os.path.join(cache_path, "samples.npy")))
+    return VariantBlock(variants, samples, calls)
+
+
+def open_vcf_cache(vcf_file, cache_dir, info_keys=["AF"], format_keys=["GT", "DP"]):
+    """
+    Return the cached VariantBlock for a VCF, building the cache on the
+    first call. Entries are invalidated when the file path, mtime, size
+    or the selected INFO/FORMAT keys change; an entry whose manifest does
+    not match the VCF (e.g. rewritten with its old mtime) is rebuilt.
+    """
+    reader = pysam.VariantFile(vcf_file)
+    info_keys, format_keys = _expand_keys(reader, info_keys, format_keys)
+    reader.close()
+
+    return read_vcf_cache(_current_vcf_cache(vcf_file, cache_dir, info_keys, format_keys))
+
+
+def _current_vcf_cache(vcf_file, cache_dir, info_keys, format_keys):
+    """Path of the current cache entry of a VCF, built when missing or stale."""
+    cache_path = os.path.join(cache_dir, _cache_key(vcf_file, info_keys, format_keys))
+    if not vcf_cache_is_current(cache_path, vcf_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_vcf_cache(vcf_file, cache_path, info_keys, format_keys)
+    return cache_path
+
+
+def _block_to_long_df(block):
+    """
+    Expand a VariantBlock into the long (variant, sample) frame produced by
+    load_vcf, with feature_ids ordered by chrom, pos, ref and alt.
+    """
+    variants = block.variants
+    feature_mapping = variants[["chrom", "pos", "ref", "alt"]].sort_values(
+        by=["chrom", "pos", "ref", "alt"], kind="stable"
+    )
+    order = feature_mapping.index.values
+    feature_mapping = feature_mapping.reset_index(drop=True)
+    feature_mapping.insert(0, "feature_id", np.arange(len(feature_mapping)))
+
+    samples = np.asarray(block.samples)
+    sample_order = np.argsort(samples, kind="stable")
+    n_samples = len(samples)
+
+    df = pd.DataFrame(
+        {
+            "chrom": np.repeat(variants["chrom"].values[order], n_samples),
+            "pos": np.repeat(variants["pos"].values[order], n_samples),
+            "ref": np.repeat(variants["ref"].values[order], n_samples),
+            "alt": np.repeat(variants["alt"].values[order], n_samples),
+            "sample": np.tile(samples[sample_order], len(order)),
+            "quality": np.repeat(variants["quality"].values[order], n_samples),
+            "feature_id": np.repeat(feature_mapping["feature_id"].values, n_samples),
+        }
+    )
+    info_cols = [c for c in variants.columns if c not in df.columns]
+    value_cols = {c: np.repeat(variants[c].values[order], n_samples) for c in info_cols}
+    for name, values in block.calls.items():
+        value_cols[name] = np.asarray(values.T[order][:, sample_order]).ravel()
+    # pivot_table orders the value columns by key name
+    for name in sorted(value_cols):
+        df[name] = value_cols[name]
+    return df, feature_mapping
+
+
+def _iter_cache_blocks(cache, variants_per_block):
+    """Slice a cached VariantBlock into consecutive blocks of variants."""
+    n_variants = len(cache.variants)
+    for start in range(0, n_variants, variants_per_block):
+        stop = min(start + variants_per_block, n_variants)
+        yield VariantBlock(
+            cache.variants.iloc[start:stop].reset_index(drop=True),
+            cache.samples,
+            {name: np.asarray(values[:, start:stop]) for name, values in cache.calls.items()},
+        )
+
+
+@instrument.instrumented("load_genotypes")
+def load_genotypes(
+    vcf_file,
+    info_keys=["AF"],
+    format_keys=["GT", "DP"],
+    variants_per_block=10000,
+    cache_dir=None,
+    allele_balance=False,
+):
+    """
+    Load a VCF into a GenotypeData: a 2-bit packed GenotypeMatrix, the
+    variant table and a sample table (with `dp_mean` when DP is loaded).
+
+    Blocks are packed as they are parsed, so peak memory is the packed
+    matrix plus one block of dense calls. With `cache_dir` the result is
+    also saved in the VCF's cache entry (see open_vcf_cache), and later
+    calls return it memory-mapped (see read_genotype_data) without
+    unpacking any calls.
+
+    With `allele_balance`, calls failing filter.allele_balance_mask (from
+    AD) are stored as missing. The sample table then gets the `call_rate`
+    measured before masking, which the sample filters use, so sample QC
+    sees the same calls as when the entries are filtered after it.
+    """
+    if "GT" not in format_keys and "*" not in format_keys:
+        format_keys = ["GT"] + list(format_keys)
+    if allele_balance and "AD" not in format_keys and "*" not in format_keys:
+        format_keys = list(format_keys) + ["AD"]
+    if cache_dir is not None:
+        cache_path = _current_vcf_cache(vcf_file, cache_dir, info_keys, format_keys)
+        data_path = os.path.join(cache_path, "genotype_data_ab" if allele_balance else "genotype_data")
+        if os.path.exists(os.path.join(data_path, "samples.parquet")):
+            return read_genotype_data(data_path)
+        blocks = _iter_cache_blocks(read_vcf_cache(cache_path), variants_per_block)
+    else:
+        blocks = iter_vcf_blocks(
+            vcf_file,
+            variants_per_block=variants_per_block,
+            info_keys=info_keys,
+            format_keys=format_keys,
+        )
+
+    matrices = []
+    variant_parts = []
+    samples = list(pysam.VariantFile(vcf_file).header.samples)
+    dp_sum = np.zeros(len(samples))
+    dp_count = np.zeros(len(samples), dtype=np.int64)
+    called = np.zeros(len(samples), dtype=np.int64)
+    n_variants = 0
+    for block in blocks:
+        gt = block.calls["call_GT"]
+        if allele_balance:
+            called += (gt >= 0).sum(axis=1, dtype=np.int64)
+            n_variants += gt.shape[1]
+            keep = allele_balance_mask(gt, block.calls["call_AD_0"], block.calls["call_AD_1"])
+            gt = np.where(keep, gt, -1).astype(np.int8)
+        matrices.append(GenotypeMatrix.from_dosage(gt))
+        variant_parts.append(block.variants)
+        if "call_DP" in block.calls:
+            dp = block.calls["call_DP"]
+            dp_sum += np.nansum(dp, axis=1)
+            dp_count += (~np.isnan(dp)).sum(axis=1)
+
+    if matrices:
+        genotypes = GenotypeMatrix.concat(matrices)
+        variants = pd.concat(variant_parts, ignore_index=True)
+    else:
+        genotypes = GenotypeMatrix(np.zeros((0, (len(samples) + 3) // 4), dtype=np.uint8), len(samples))
+        variants = pd.DataFrame()
+
+    sample_df = pd.DataFrame({"sample": samples})
+    if dp_count.any():
+        sample_df["dp_mean"] = dp_sum / np.maximum(dp_count, 1)
+    if allele_balance:
+        sample_df["call_rate"] = called / max(n_variants, 1)
+    data = GenotypeData(genotypes, variants, sample_df)
+    if cache_dir is not None:
+        tmp_path = f"{data_path}.tmp-{os.getpid()}"
+        save_genotype_data(data, tmp_path)
+        try:
+            os.replace(tmp_path, data_path)
+        except OSError:
+            # Another process saved the same genotypes first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return read_genotype_data(data_path)
+    return data
+
+
+def save_genotype_data(data, path):
+    """
+    Write a GenotypeData (views included) to the directory `path`: the
+    packed matrix (see GenotypeMatrix.save) and Parquet variant and sample
+    tables, so later stages can reopen it with read_genotype_data.
+    """
+    genotypes, variants, samples = data
+    os.makedirs(path, exist_ok=True)
+    genotypes.save(os.path.join(path, "genotypes"))
+    variants.to_parquet(os.path.join(path, "variants.parquet"), index=False)
+    samples.to_parquet(os.path.join(path, "samples.parquet"), index=False)
+    return path
+
+
+def read_genotype_data(path, mmap_mode="r"):
+    """Open a GenotypeData written by save_genotype_data, the matrix memory-mapped by default."""
+    return GenotypeData(
+        GenotypeMatrix.load(os.path.join(path, "genotypes"), mmap_mode=mmap_mode),
+        pd.read_parquet(os.path.join(path, "variants.parquet")),
+        pd.read_parquet(os.path.join(path, "samples.parquet")),
+    )
 
 
 def load_annotations(annotation_path, delimiter="\t"):
-    """Function to load annotations into a Cudf (GPU accelerated) dataframe"""
-    return cudf.read_csv(annotation_path, delimiter=delimiter)
+    """Function to load annotations into a dataframe of the configured backend (cuDF on GPU, pandas on CPU)"""
+    return get_backend().df.read_csv(annotation_path, delimiter=delimiter)
 
 
 def _transform_df(df, sample_key_cols, common_key_cols, common_cols, drop_cols):
@@ -193,8 +784,8 @@ def _transform_df(df, sample_key_cols, common_key_cols, common_cols, drop_cols):
         var_name="location",
     )
     del df2
-    gdf1 = cudf.DataFrame(res_df)
-    gdf2 = cudf.DataFrame(df[common_cols])
+    gdf1 = get_backend().df.DataFrame(res_df)
+    gdf2 = get_backend().df.DataFrame(df[common_cols])
     gdf1 = gdf1.merge(gdf2, how="left", left_on="location", right_index=True)
 
     del gdf2
@@ -0,0 +1,187 @@
+"""Module for linkage disequilibrium pruning and clumping.
+
+r^2 between variants is computed with blocked matrix products of
+standardized genotypes (mean imputed, centered and scaled to unit norm, so
+r is a dot product). Only variants inside the current window are kept in
+memory, so both operations stream over millions of variants. Variants must
+be sorted by chromosome and position.
+"""
+
+import numpy as np
+import pandas as pd
+
+from gpugwas import instrument
+from gpugwas.backend import compute_backend, to_host
+from gpugwas.genotype import GenotypeData, GenotypeMatrix
+
+
+# Window size standing for "no bp limit", small enough that pos +- it cannot overflow
+_UNBOUNDED = 1 << 62
+
+
+def _standardize(genotypes, start, stop, xp):
+    """Variants start:stop as unit-norm centered columns (zero for constant variants)."""
+    if isinstance(genotypes, GenotypeMatrix):
+        block = genotypes.to_float(slice(start, stop), dtype=np.float64, xp=xp)
+    else:
+        block = xp.asarray(genotypes[:, start:stop], dtype=xp.float64)
+        means = xp.nanmean(block, axis=0)
+        block = xp.where(xp.isnan(block), means, block)
+    block = block - block.mean(axis=0)
+    norms = xp.sqrt((block * block).sum(axis=0))
+    return block / xp.where(norms > 0, norms, 1.0)
+
+
+def _locations(genotypes, chrom, pos, window_bp, window_variants):
+    """Host (chromosome code, position) arrays; positions are variant numbers without `pos`."""
+    n_variants = genotypes.shape[1]
+    if pos is None and window_variants is None:
+        raise ValueError("Need variant positions for a bp window, or window_variants")
+    chrom_codes = np.zeros(n_variants, dtype=np.int64)
+    if chrom is not None:
+        # Codes follow the order of appearance, so sorted input has sorted codes
+        chrom_codes = pd.factorize(np.asarray(to_host(chrom)))[0]
+    if pos is None or window_bp is None:
+        window_bp = _UNBOUNDED
+    pos = np.arange(n_variants) if pos is None else np.asarray(to_host(pos), dtype=np.int64)
+    steps = np.diff(chrom_codes)
+    if not ((steps > 0) | ((steps == 0) & (np.diff(pos) >= 0))).all():
+        raise ValueError("Variants must be sorted by chromosome and position")
+    return chrom_codes, pos, window_bp
+
+
+def _in_window(chrom_a, pos_a, index_a, chrom_b, pos_b, index_b, window_bp, window_variants):
+    """(len(a), len(b)) mask of variant pairs within the window of each other."""
+    near = (chrom_a[:, None] == chrom_b[None, :]) & (np.abs(pos_b[None, :] - pos_a[:, None]) <= window_bp)
+    if window_variants is not None:
+        near &= np.abs(index_b[None, :] - index_a[:, None]) <= window_variants
+    return near
+
+
+def _unpack_input(genotypes, chrom, pos):
+    if isinstance(genotypes, GenotypeData):
+        variants = genotypes.variants
+        chrom = variants["chrom"].values if chrom is None else chrom
+        pos = variants["pos"].values if pos is None else pos
+        genotypes = genotypes.genotypes
+    return genotypes, chrom, pos
+
+
+@instrument.instrumented("ld_prune")
+def ld_prune(genotypes, chrom=None, pos=None, r2_threshold=0.2, window_bp=1000000, window_variants=None,
+             block_size=1024, backend=None):
+    """
+    Greedy LD pruning: walk the variants in order and keep a variant unless
+    it has r^2 > `r2_threshold` with an already kept variant in the window
+    (same chromosome, within `window_bp` and/or `window_variants`).
+
+    genotypes: GenotypeData (chrom/pos taken from its variant table),
+        GenotypeMatrix or a samples x variants array (NaN for missing).
+    backend: "numpy", "cupy", or None (see backend.compute_backend).
+    Returns a boolean mask of kept variants, e.g. for pca.genotype_pca(variants=...).
+    """
+    genotypes, chrom, pos = _unpack_input(genotypes, chrom, pos)
+    xp = compute_backend(genotypes, backend).xp
+    chrom, pos, window_bp = _locations(genotypes, chrom, pos, window_bp, window_variants)
+    n_variants = genotypes.shape[1]
+    keep = np.zeros(n_variants, dtype=bool)
+    index = np.arange(n_variants)
+
+    # Kept variants that may still be in the window of upcoming variants
+    window_z = xp.zeros((genotypes.shape[0], 0))
+    window_index = np.zeros(0, dtype=np.int64)
+    for start in range(0, n_variants, block_size):
+        stop = min(start + block_size, n_variants)
+        z = _standardize(genotypes, start, stop, xp)
+        block = index[start:stop]
+
+        near = _in_window(chrom[window_index], pos[window_index], window_index,
+                          chrom[block], pos[block], block, window_bp, window_variants)
+        r = window_z.T @ z
+        blocked = to_host(((r * r > r2_threshold) & xp.asarray(near)).any(axis=0))
+
+        near = _in_window(chrom[block], pos[block], block, chrom[block], pos[block], block, window_bp,
+                          window_variants)
+        r = z.T @ z
+        conflict = to_host(r * r > r2_threshold) & near & np.triu(np.ones(near.shape, dtype=bool), k=1)
+        for j in range(stop - start):
+            if not blocked[j]:
+                keep[start + j] = True
+                blocked |= conflict[j]
+
+        kept = np.flatnonzero(keep[start:stop])
+        window_z = xp.concatenate([window_z, z[:, xp.asarray(kept)]], axis=1)
+        window_index = np.concatenate([window_index, start + kept])
+        if stop < n_variants:
+            # Drop kept variants out of reach of the next block (and so of all later ones)
+            alive = (chrom[window_index] == chrom[stop]) & (pos[stop] - pos[window_index] <= window_bp)
+            if window_variants is not None:
+                alive &= stop - window_index <= window_variants
+            window_z = window_z[:, xp.asarray(np.flatnonzero(alive))]
+            window_index = window_index[alive]
+    return keep
+
+
+@instrument.instrumented("ld_clump")
+def ld_clump(genotypes, p_values, chrom=None, pos=None, p1=5e-8, p2=1e-2, r2_threshold=0.1, window_bp=250000,
+             window_variants=None, backend=None):
+    """
+    p-value driven clumping (as PLINK --clump): variants with p < `p1` are
+    index variants in order of significance; each one not yet clumped claims
+    the unclumped variants in its window with p < `p2` and r^2 > `r2_threshold`.
+
+    p_values are aligned with the genotype columns (NaN for untested).
+    Returns an int array with, for each variant, the column of the index
+    variant of its clump, or -1.
+    """
+    genotypes, chrom, pos = _unpack_input(genotypes, chrom, pos)
+    xp = compute_backend(genotypes, backend).xp
+    chrom, pos, window_bp = _locations(genotypes, chrom, pos, window_bp, window_variants)
+    p_values = np.asarray(to_host(p_values), dtype=np.float64)
+    n_variants = genotypes.shape[1]
+    clump = np.full(n_variants, -1, dtype=np.int64)
+
+    with np.errstate(invalid="ignore"):
+        candidates = np.flatnonzero(p_values < p1)
+    for i in candidates[np.argsort(p_values[candidates], kind="stable")]:
+        if clump[i] >= 0:
+            continue
+        # Variants are sorted, so the window is a contiguous range found by binary search
+        chrom_lo = np.searchsorted(chrom, chrom[i], side="left")
+        chrom_hi = np.searchsorted(chrom, chrom[i], side="right")
+        lo = chrom_lo + np.searchsorted(pos[chrom_lo:chrom_hi], pos[i] - window_bp, side="left")
+        hi = chrom_lo + np.searchsorted(pos[chrom_lo:chrom_hi], pos[i] + window_bp, side="right")
+        if window_variants is not None:
+            lo, hi = max(lo, i - window_variants), min(hi, i + window_variants + 1)
+
+        z = _standardize(genotypes, lo, hi, xp)
+        r = to_host(z.T @ z[:, i - lo])
+        with np.errstate(invalid="ignore"):
+            members = (r * r > r2_threshold) & (p_values[lo:hi] < p2) & (clump[lo:hi] < 0)
+        clump[lo:hi][members] = i
+        clump[i] = i
+    return clump
+
+
+def clump_results(results, data, **kwargs):
+    """
+    Clump run_gwas results: `results` has `feature` (genotype column of
+    the GenotypeData, as passed to run_gwas) and `p_value` columns. Returns
+    the results with a `clump` column holding the feature of the index
+    variant of each row's clump (-1 when unclumped); ld_clump kwargs apply.
+    Results with a `phenotype` column are clumped per phenotype, so index
+    variants of one trait never claim variants of another.
+    """
+    frame = results.to_pandas() if hasattr(results, "to_pandas") else results.copy()
+    if "phenotype" in frame.columns:
+        groups = frame.groupby("phenotype", sort=False).indices.values()
+    else:
+        groups = [np.arange(len(frame))]
+    clump = np.full(len(frame), -1, dtype=np.int64)
+    for rows in groups:
+        features = frame["feature"].values[rows]
+        p_values = np.full(data.genotypes.n_variants, np.nan)
+        p_values[features] = frame["p_value"].values[rows]
+        clump[rows] = ld_clump(data, p_values, **kwargs)[features]
+    frame["clump"] = clump
+    return type(results)(frame)
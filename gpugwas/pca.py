@@ -0,0 +1,105 @@
+"""Module for principal component analysis of genotype matrices.
+
+Genotypes are standardized by allele frequency like Hail's
+`hwe_normalized_pca`, and the leading components are found with a
+randomized SVD that only ever holds one block of variants plus a few
+(n_samples x (k + oversamples)) matrices in memory. A GenotypeMatrix
+opened with `GenotypeMatrix.load` is therefore streamed from disk.
+"""
+
+import numpy as np
+
+from gpugwas import instrument
+from gpugwas.backend import compute_backend
+from gpugwas.genotype import GenotypeMatrix
+
+
+def _standardization(genotypes, xp, dtype):
+    """
+    Per-variant (center, scale) so that (g - center) * scale is the HWE
+    normalized genotype. Monomorphic variants get a zero scale.
+    """
+    if isinstance(genotypes, GenotypeMatrix):
+        called, alt = genotypes.variant_counts()
+        called, alt = xp.asarray(called), xp.asarray(alt)
+    else:
+        called = (~xp.isnan(genotypes)).sum(axis=0)
+        alt = xp.nansum(genotypes, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        freqs = alt / (2.0 * called)
+        valid = (freqs > 0) & (freqs < 1)
+        n_valid = max(int(valid.sum()), 1)
+        scale = xp.where(valid, 1.0 / xp.sqrt(2.0 * freqs * (1 - freqs) * n_valid), 0.0)
+    center = xp.where(valid, 2.0 * freqs, 0.0)
+    return center.astype(dtype), scale.astype(dtype)
+
+
+def _iter_standardized(genotypes, center, scale, block_size, xp, dtype):
+    """Yield (start, standardized block) pairs, missing calls set to the mean (0)."""
+    n_variants = genotypes.shape[1]
+    for start in range(0, n_variants, block_size):
+        stop = min(start + block_size, n_variants)
+        if isinstance(genotypes, GenotypeMatrix):
+            block = genotypes.to_float(slice(start, stop), dtype=dtype, impute=None, xp=xp)
+        else:
+            block = xp.asarray(genotypes[:, start:stop], dtype=dtype)
+        block = (block - center[start:stop]) * scale[start:stop]
+        yield start, xp.where(xp.isnan(block), 0, block)
+
+
+@instrument.instrumented("genotype_pca")
+def genotype_pca(genotypes, n_components=10, variants=None, n_oversamples=10, n_iter=4, block_size=4096,
+                 backend=None, dtype="float64", seed=0):
+    """
+    Return the (n_samples, n_components) PC scores of a genotype matrix.
+
+    genotypes: GenotypeMatrix or a (samples x variants) float array with
+        NaN for missing calls.
+    variants: optional mask or positions of the variants to use, e.g. an
+        LD-pruned subset.
+    n_oversamples, n_iter: extra random directions and power iterations
+        of the randomized SVD; each iteration is one pass over the variants.
+    backend: "numpy", "cupy", or None (the backend of an array, the
+        configured one for a GenotypeMatrix, see backend.compute_backend).
+        Blocks of a GenotypeMatrix are unpacked directly on the device for "cupy".
+    """
+    xp = compute_backend(genotypes, backend).xp
+    dtype = np.dtype(dtype)
+    if variants is not None:
+        if isinstance(genotypes, GenotypeMatrix):
+            genotypes = genotypes.subset(variants=variants)
+        else:
+            genotypes = genotypes[:, xp.asarray(variants)]
+    if not isinstance(genotypes, GenotypeMatrix):
+        genotypes = xp.asarray(genotypes, dtype=dtype)
+
+    n_samples, n_variants = genotypes.shape
+    rank = min(n_components + n_oversamples, n_samples, n_variants)
+    center, scale = _standardization(genotypes, xp, dtype)
+
+    def blocks():
+        return _iter_standardized(genotypes, center, scale, block_size, xp, dtype)
+
+    # Range finder Y = Z @ Omega, the random matrix is drawn per block from the seed
+    y = xp.zeros((n_samples, rank), dtype=dtype)
+    for start, z in blocks():
+        omega = np.random.default_rng([seed, start]).standard_normal((z.shape[1], rank))
+        y += z @ xp.asarray(omega, dtype=dtype)
+    q, _ = xp.linalg.qr(y)
+
+    # Power iterations Y = Z @ Z.T @ Q sharpen the spectrum
+    for _ in range(n_iter):
+        y = xp.zeros_like(y)
+        for _, z in blocks():
+            y += z @ (z.T @ q)
+        q, _ = xp.linalg.qr(y)
+
+    # B = Q.T @ Z is (rank x n_variants), so only B @ B.T is accumulated
+    bbt = xp.zeros((rank, rank), dtype=dtype)
+    for _, z in blocks():
+        b = q.T @ z
+        bbt += b @ b.T
+    eigenvalues, w = xp.linalg.eigh(bbt)
+    order = xp.argsort(eigenvalues)[::-1][:n_components]
+    singular_values = xp.sqrt(xp.maximum(eigenvalues[order], 0))
+    return (q @ w[:, order]) * singular_values
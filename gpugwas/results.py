@@ -0,0 +1,148 @@
+"""Module for GWAS result tables with genomic coordinates.
+
+Results are annotated with chrom/pos/ref/alt by indexing the arrays of a
+VariantIndex (built once per variant set) with the result `feature` ids
+instead of merging dataframes, then sorted by genomic position, so region
+lookups and the chromosome layout of a Manhattan plot are binary searches.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from gpugwas.backend import to_host
+
+
+_SEX_CHROMS = {"X": 23, "Y": 24, "XY": 25, "M": 26, "MT": 26}
+
+
+def chrom_sort_key(chrom):
+    """Natural chromosome order: 1..22, X, Y, XY, MT, then other contigs by name."""
+    name = re.sub(r"^chr", "", str(chrom), flags=re.IGNORECASE)
+    if name.isdigit():
+        return (int(name), name)
+    return (_SEX_CHROMS.get(name.upper(), 100), name)
+
+
+def _host_frame(df):
+    return df.to_pandas() if hasattr(df, "to_pandas") else df
+
+
+def _like(frame, template):
+    """Return pandas `frame` as the dataframe type of `template` (pandas or cudf)."""
+    if hasattr(template, "to_pandas"):
+        return type(template).from_pandas(frame)
+    return frame
+
+
+def _search(series, value, side="left"):
+    return int(np.asarray(to_host(series.searchsorted(value, side=side))).ravel()[0])
+
+
+class VariantIndex:
+    """
+    Coordinates of every feature id, as arrays where position i holds
+    feature i. Chromosomes are an ordered categorical in natural order,
+    alleles are categoricals (a small code per variant instead of a Python
+    string), and annotated results get the same categorical columns.
+    """
+
+    def __init__(self, chrom, pos, ref, alt):
+        chrom = np.asarray(chrom, dtype=object)
+        categories = sorted({str(c) for c in chrom if c is not None and c == c}, key=chrom_sort_key)
+        self.chrom = pd.Categorical(
+            [None if c is None or c != c else str(c) for c in chrom], categories=categories, ordered=True
+        )
+        self.pos = np.asarray(pos, dtype=np.int64)
+        self.ref = ref if isinstance(ref, pd.Categorical) else pd.Categorical(ref)
+        self.alt = alt if isinstance(alt, pd.Categorical) else pd.Categorical(alt)
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Build from any frame with feature_id, chrom, pos, ref and alt columns:
+        load_vcf's feature_mapping or (filtered) long-format frame, or the
+        `variants` table of a GenotypeData.
+        """
+        table = _host_frame(table[["feature_id", "chrom", "pos", "ref", "alt"]])
+        table = table.drop_duplicates("feature_id")
+        ids = table["feature_id"].to_numpy().astype(np.int64)
+        n_features = int(ids.max()) + 1 if len(ids) else 0
+        chrom = np.full(n_features, None, dtype=object)
+        chrom[ids] = table["chrom"].to_numpy()
+        alleles = {}
+        for name in ["ref", "alt"]:
+            # Placed by code, so no per-variant Python objects are created
+            values = pd.Categorical(table[name])
+            codes = np.full(n_features, -1, dtype=values.codes.dtype)
+            codes[ids] = values.codes
+            alleles[name] = pd.Categorical.from_codes(codes, values.categories)
+        pos = np.full(n_features, -1, dtype=np.int64)
+        pos[ids] = table["pos"].to_numpy()
+        return cls(chrom, pos, alleles["ref"], alleles["alt"])
+
+    def __len__(self):
+        return len(self.pos)
+
+    def annotate(self, results, sort=True):
+        """
+        Add chrom/pos/ref/alt columns to results with a `feature` column and
+        sort them by (phenotype,) chromosome and position. Phenotypes keep
+        the order in which they first appear in `results`.
+        """
+        frame = _host_frame(results).copy()
+        feature = frame["feature"].to_numpy().astype(np.int64)
+        frame["chrom"] = self.chrom.take(feature)
+        frame["pos"] = self.pos[feature]
+        frame["ref"] = self.ref.take(feature)
+        frame["alt"] = self.alt.take(feature)
+        if sort:
+            keys = ["chrom", "pos"]
+            if "phenotype" in frame.columns:
+                frame["_phenotype_order"] = pd.factorize(frame["phenotype"])[0]
+                keys = ["_phenotype_order"] + keys
+            frame = frame.sort_values(keys, kind="stable").drop(columns="_phenotype_order", errors="ignore")
+            frame = frame.reset_index(drop=True)
+        return _like(frame, results)
+
+
+def _phenotype_bounds(results, phenotype):
+    """Rows of `phenotype`: contiguous, but phenotypes are in the caller's order rather than sorted."""
+    if phenotype is None:
+        if "phenotype" in results.columns:
+            raise ValueError("Results hold several phenotypes, pass `phenotype`")
+        return 0, len(results)
+    rows = np.flatnonzero(np.asarray(to_host((results["phenotype"] == phenotype).values)))
+    if len(rows) == 0:
+        return 0, 0
+    return int(rows[0]), int(rows[-1]) + 1
+
+
+def chrom_bounds(results, phenotype=None):
+    """{chrom: (first row, end row)} of position-sorted results, found by binary search."""
+    lo, hi = _phenotype_bounds(results, phenotype)
+    codes = results["chrom"].cat.codes.iloc[lo:hi]
+    bounds = {}
+    for code, chrom in enumerate(results["chrom"].cat.categories):
+        start, stop = _search(codes, code, "left"), _search(codes, code, "right")
+        if stop > start:
+            bounds[chrom] = (lo + start, lo + stop)
+    return bounds
+
+
+def region(results, chrom, start=None, end=None, phenotype=None):
+    """Rows of position-sorted results in chrom:start-end (inclusive), by binary search."""
+    lo, hi = _phenotype_bounds(results, phenotype)
+    categories = list(results["chrom"].cat.categories)
+    if str(chrom) not in categories:
+        return results.iloc[0:0]
+    code = categories.index(str(chrom))
+    codes = results["chrom"].cat.codes.iloc[lo:hi]
+    lo, hi = lo + _search(codes, code, "left"), lo + _search(codes, code, "right")
+    pos = results["pos"].iloc[lo:hi]
+    if end is not None:
+        hi = lo + _search(pos, end, "right")
+    if start is not None:
+        lo = lo + _search(pos, start, "left")
+    return results.iloc[lo:hi]
@@ -1,31 +1,492 @@
 """Module for running parallel GWAS analysis per independent feature."""
 
 from collections import defaultdict
-import cupy as cp
+import hashlib
+import json
+import logging
+import os
+import numpy as np
 import pandas as pd
-import cudf
 
-def run_gwas(phenotypes_df, phenotype_col, feature_cols, algorithm, add_cols=[]):
+from gpugwas import instrument
+from gpugwas.backend import backend_of, to_host
+from gpugwas.genotype import GenotypeMatrix
+from gpugwas.results import VariantIndex
+
+logger = logging.getLogger(__name__)
+
+
+@instrument.instrumented("run_gwas")
+def run_gwas(phenotypes_df, phenotype_col, feature_cols, algorithm, add_cols=[], batch_size=None, genotypes=None,
+             memory_budget=None, report=None, variants=None, output=None, checkpoint=None, resume=False):
+    """
+    Test every feature against `phenotype_col`, adjusting for `add_cols`.
+
+    `phenotype_col` can be a list of phenotypes for batched algorithms: all
+    of them are tested against each variant block in the same pass, and the
+    result gets a `phenotype` column, in the order of `phenotype_col`.
+    Samples missing a phenotype value are left out of that phenotype's model.
+
+    Features are either variant columns of phenotypes_df (`feature_cols`
+    are column names), or the columns of a (samples x variants) `genotypes`
+    matrix aligned with phenotypes_df, as returned by
+    dataprep.create_phenotype_matrix (`feature_cols` is then the variant index).
+
+    Batched algorithms stream variant blocks sized to `memory_budget` bytes
+    (default: free device/host memory), and resized from the memory each
+    block adds, unless `batch_size` is given; the block plan and peak
+    memory per stage are written into the `report` dict. Without variants
+    to test the result is empty, with the usual columns.
+
+    With `variants` (a results.VariantIndex, or a table it can be built
+    from) the results get chrom/pos/ref/alt columns looked up by feature id
+    and are sorted by genomic position; otherwise `chrom` is set to 1.
+
+    With `output` (a store.ResultsWriter, batched algorithms and `variants`
+    only) every block is written to disk as soon as it is tested instead of
+    being collected, and the ResultsStore over the output is returned.
+
+    With `checkpoint` (a directory, batched algorithms only) every finished
+    block is recorded there (see Checkpoint). With `resume` a run that was
+    interrupted continues after its last finished block, with the recorded
+    block size, so the results are identical to an uninterrupted run.
+    """
+    if output is not None and (variants is None or not getattr(algorithm, "batched", False)):
+        raise ValueError("Writing results to a store needs a batched algorithm and `variants`")
+    if checkpoint is not None and not getattr(algorithm, "batched", False):
+        raise ValueError("Checkpointing needs a batched algorithm")
+    if variants is not None and not isinstance(variants, VariantIndex):
+        variants = VariantIndex.from_table(variants)
+    if getattr(algorithm, "batched", False):
+        return _run_gwas_batched(phenotypes_df, phenotype_col, feature_cols, algorithm, add_cols, batch_size, genotypes,
+                                 memory_budget, report, variants, output, checkpoint, resume)
+    if isinstance(phenotype_col, (list, tuple)):
+        raise ValueError("Testing several phenotypes at once needs a batched algorithm")
+
+    backend = backend_of(phenotypes_df)
+    xp = backend.xp
     p_value_dict = defaultdict(list)
     for i, f in enumerate(feature_cols):
-        if phenotypes_df[f].sum() == 0:
-            continue
+        if genotypes is None:
+            if phenotypes_df[f].sum() == 0:
+                continue
+            feature_columns = [f] + add_cols
+            X = xp.asarray(phenotypes_df[feature_columns].values, dtype=xp.float64)
+            feature = i
+        else:
+            X = xp.asarray(_genotype_block(genotypes, i, i + 1, xp), dtype=xp.float64)
+            if X.sum() == 0:
+                continue
+            if add_cols:
+                covariates = xp.asarray(phenotypes_df[add_cols].values, dtype=xp.float64)
+                X = xp.concatenate([X, covariates], axis=1)
+            feature = to_host(feature_cols[i:i + 1])[0]
 
         model  = algorithm()
-        feature_columns = [f] + add_cols
-        X = cp.array(phenotypes_df[feature_columns].as_gpu_matrix()).astype(cp.float64)
         #print("fit model for feature {}".format(f))
-        model.fit(X,phenotypes_df[phenotype_col].values.astype(cp.float64))
+        model.fit(X,phenotypes_df[phenotype_col].values.astype(xp.float64))
 
         # We just want p value of feature column, not additional columns. so we grab the first element of the list.
-        for p_val,coef,f in zip(model.p_values[1:2],model.coefficients[1:2],feature_columns[0]):
+        for p_val,neglog10_p,coef in zip(model.p_values[1:2],model.neglog10_p_values[1:2],model.coefficients[1:2]):
             #print(f'Feature:{f} p_value:{p_val}  coef:{coef}')
-            p_value_dict["feature"].append(i)
+            p_value_dict["feature"].append(feature)
             p_value_dict["p_value"].append(p_val)
+            p_value_dict["neglog10_p_value"].append(neglog10_p)
             #p_value_dict["coef"].append(coef)
-            p_value_dict["chrom"].append(1)
+            if variants is None:
+                p_value_dict["chrom"].append(1)
 
-    print("Visualizing p values")
+    logger.debug("Collecting p values")
     df = pd.DataFrame(p_value_dict)
-    df = cudf.DataFrame(df)
+    if variants is not None:
+        df = variants.annotate(df)
+    df = backend.df.DataFrame(df)
+    return df
+
+
+def _genotype_block(genotypes, start, stop, xp):
+    """Columns start:stop of a genotype matrix, unpacked to float for GenotypeMatrix."""
+    if isinstance(genotypes, GenotypeMatrix):
+        return genotypes.to_float(slice(start, stop), dtype=np.float64, xp=xp)
+    return genotypes[:, start:stop]
+
+
+class BlockScheduler:
+    """
+    Sizes variant blocks so that one block of association work fits in a
+    memory budget, and records the peak memory each stage of a run added
+    (fit, test of a block, results) on top of what was in use before it.
+
+    The budget defaults to the free device memory (cupy) or available host
+    RAM (numpy). Each variant in a block costs about `work_buffers` float
+    vectors of n_samples, on top of the fixed covariate matrices; only
+    `safety` of the budget is planned for. After every block the plan is
+    redone with the memory that block actually added (see `observe`), and
+    when a block still runs out of memory the block size is halved (see
+    `shrink`). A `block_size` given by the caller is never changed by
+    measurements.
+    """
+
+    def __init__(self, n_samples, n_covariates, backend="numpy", memory_budget=None, work_buffers=6,
+                 dtype_size=8, safety=0.8, max_block_size=65536, block_size=None):
+        self.backend = backend
+        self.memory_budget = memory_budget if memory_budget is not None else instrument.available_memory(backend)
+        self.fixed_bytes = 4 * n_samples * (n_covariates + 1) * dtype_size
+        self.min_bytes_per_variant = n_samples * dtype_size
+        self.safety = safety
+        self.max_block_size = max_block_size
+        self.adaptive = block_size is None
+        self.bytes_per_variant = work_buffers * n_samples * dtype_size
+        self.measured_bytes_per_variant = None
+        self.block_size = self._plan(self.bytes_per_variant) if block_size is None else max(1, block_size)
+        self.peak_bytes = {}
+        self.n_blocks = 0
+        self.n_shrinks = 0
+
+    def _plan(self, bytes_per_variant):
+        block_size = int((self.memory_budget * self.safety - self.fixed_bytes) // bytes_per_variant)
+        return max(1, min(block_size, self.max_block_size))
+
+    def observe(self, n_variants, memory):
+        """
+        Record the test of a block of `n_variants` (a finished
+        instrument.PeakMemory) and size the next blocks from the memory it
+        added per variant, growing by at most a factor of two per block.
+        """
+        self.n_blocks += 1
+        self.record("test", memory)
+        delta = memory.device_delta if self.backend == "cupy" else memory.host_delta
+        if not self.adaptive or not delta or n_variants == 0:
+            return
+        # A block holds at least its own genotypes, whatever the allocator reports
+        self.measured_bytes_per_variant = max(delta / n_variants, self.min_bytes_per_variant)
+        self.block_size = min(self._plan(self.measured_bytes_per_variant), 2 * self.block_size)
+
+    def shrink(self):
+        """Halve the block size after an out-of-memory error, False when already 1."""
+        if self.block_size == 1:
+            return False
+        self.block_size = max(1, self.block_size // 2)
+        # Measurements never plan a block as large as one that failed again
+        self.max_block_size = min(self.max_block_size, self.block_size)
+        self.n_shrinks += 1
+        return True
+
+    def record(self, stage, memory):
+        """Remember the peak memory `stage` added on top of its start (a finished instrument.PeakMemory)."""
+        delta = memory.device_delta if self.backend == "cupy" else memory.host_delta
+        self.peak_bytes[stage] = max(self.peak_bytes.get(stage, 0), delta or 0)
+
+    def report(self):
+        return {
+            "backend": self.backend,
+            "memory_budget": int(self.memory_budget),
+            "block_size": self.block_size,
+            "bytes_per_variant": self.bytes_per_variant,
+            "measured_bytes_per_variant": self.measured_bytes_per_variant,
+            "n_blocks": self.n_blocks,
+            "n_shrinks": self.n_shrinks,
+            "peak_bytes": dict(self.peak_bytes),
+        }
+
+
+class Checkpoint:
+    """
+    Progress of a batched run_gwas in a directory:
+
+        manifest.json        run fingerprint, block size, finished [start, stop) blocks
+        block-00000.parquet  results of each finished block (when not written to a store)
+
+    Blocks and the manifest are replaced atomically, so a run killed at any
+    point leaves the manifest describing complete blocks only. A new
+    checkpoint (resume=False) removes the manifest and blocks of an earlier
+    one, never other files, and records how many files the output store
+    already had (`n_output_files`); a non-empty directory without a
+    manifest raises FileExistsError. Resuming one written by a run with a
+    different fingerprint raises ValueError.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path, fingerprint, resume=False, n_output_files=0):
+        self.path = path
+        # Normalized through JSON so it compares equal to a loaded manifest
+        fingerprint = json.loads(json.dumps(fingerprint))
+        manifest_path = os.path.join(path, self.MANIFEST)
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest["fingerprint"] != fingerprint:
+                raise ValueError(f"Checkpoint {path} was written by a different run, cannot resume it")
+            logger.info("Resuming from %s after %d blocks", path, len(self.manifest["blocks"]))
+            return
+        n_blocks = 0
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                n_blocks = len(json.load(f)["blocks"])
+        elif os.path.isdir(path) and os.listdir(path):
+            raise FileExistsError(f"{path} is not empty and holds no checkpoint, not writing one there")
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {
+            "fingerprint": fingerprint, "block_size": None, "blocks": [], "n_output_files": n_output_files,
+        }
+        # Written before anything else, so the directory stays recognizable as a checkpoint
+        self._write_manifest()
+        for i in range(n_blocks):
+            if os.path.exists(self._block_path(i)):
+                os.remove(self._block_path(i))
+
+    @property
+    def block_size(self):
+        return self.manifest["block_size"]
+
+    @property
+    def n_output_files(self):
+        return self.manifest["n_output_files"]
+
+    @property
+    def next_start(self):
+        """First variant not covered by a finished block."""
+        blocks = self.manifest["blocks"]
+        return blocks[-1][1] if blocks else 0
+
+    def _block_path(self, i):
+        return os.path.join(self.path, f"block-{i:05d}.parquet")
+
+    def _replace(self, name, write):
+        tmp_path = os.path.join(self.path, f"{name}.tmp-{os.getpid()}")
+        write(tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    def add_block(self, start, stop, block_size, frame=None, n_output_files=0):
+        """Record a finished block, with its results unless they went to a store."""
+        if frame is not None:
+            name = os.path.basename(self._block_path(len(self.manifest["blocks"])))
+            self._replace(name, lambda path: frame.to_parquet(path, index=False))
+        self.manifest["blocks"].append([start, stop])
+        self.manifest["block_size"] = block_size
+        self.manifest["n_output_files"] = n_output_files
+        self._write_manifest()
+
+    def _write_manifest(self):
+        def write(path):
+            with open(path, "w") as f:
+                json.dump(self.manifest, f, indent=1)
+
+        self._replace(self.MANIFEST, write)
+
+    def frames(self):
+        """Results of the finished blocks, in order."""
+        return [pd.read_parquet(self._block_path(i)) for i in range(len(self.manifest["blocks"]))]
+
+
+def _digest(*arrays):
+    """SHA-1 of the dtypes, shapes and contents of host arrays."""
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype}{array.shape}".encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _genotype_source(phenotypes_df, feature_cols, genotypes, n_sampled=64):
+    """
+    Identity of the tested genotypes: the file backing a memory-mapped
+    GenotypeMatrix (path, size and mtime) and a digest of up to
+    `n_sampled` evenly spaced variants over all samples.
+    """
+    n_variants = len(feature_cols)
+    columns = np.unique(np.linspace(0, n_variants - 1, min(n_sampled, n_variants)).astype(np.int64))
+    sampled = []
+    for i in columns:
+        block, _ = _feature_block(phenotypes_df, feature_cols, genotypes, i, i + 1)
+        sampled.append(block.to_int8() if isinstance(block, GenotypeMatrix) else to_host(block).astype(np.float64))
+    source = None
+    filename = getattr(getattr(genotypes, "packed", None), "filename", None)
+    if filename is not None:
+        stat = os.stat(filename)
+        source = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+    return {"file": source, "sampled": _digest(*sampled)}
+
+
+def _fingerprint(phenotypes_df, phenotype_col, feature_cols, algorithm, add_cols, genotypes=None):
+    """
+    What a checkpoint must match to be resumed: the model, the tested
+    phenotypes and covariates with their values, and the variants with
+    their genotypes (see _genotype_source).
+    """
+    features = np.ascontiguousarray(to_host(feature_cols))
+    phenotypes = list(phenotype_col) if isinstance(phenotype_col, (list, tuple)) else [phenotype_col]
+    return {
+        "algorithm": f"{algorithm.__module__}.{algorithm.__name__}",
+        "phenotypes": list(phenotype_col) if isinstance(phenotype_col, (list, tuple)) else phenotype_col,
+        "covariates": list(add_cols),
+        "values": _digest(to_host(_phenotype_values(phenotypes_df, phenotypes + list(add_cols)))),
+        "n_samples": len(phenotypes_df),
+        "n_variants": len(features),
+        "features": _digest(features),
+        "genotypes": _genotype_source(phenotypes_df, feature_cols, genotypes),
+    }
+
+
+def _feature_block(phenotypes_df, feature_cols, genotypes, start, stop):
+    """Genotypes and feature ids of variants start:stop."""
+    if genotypes is None:
+        return phenotypes_df[feature_cols[start:stop]].values, np.arange(start, stop)
+    if isinstance(genotypes, GenotypeMatrix):
+        block = genotypes.subset(variants=np.arange(start, stop))
+    else:
+        block = genotypes[:, start:stop]
+    return block, to_host(feature_cols[start:stop])
+
+
+def _phenotype_values(phenotypes_df, phenotype_cols):
+    """(n_samples, n_phenotypes) float array with NaN for missing values."""
+    return phenotypes_df[phenotype_cols].astype("float64").fillna(np.nan).values
+
+
+def _fit_models(phenotypes_df, phenotype_col, algorithm, add_cols):
+    """
+    Fitted models, the sample rows each one was fitted on (None for all)
+    and the phenotype names of their outputs. Algorithms with
+    `multi_phenotype` fit all phenotypes in one model and mask missing
+    values themselves; others get one model per phenotype (still sharing
+    the pass over the genotypes), fitted on the samples with a value.
+    """
+    covariates = phenotypes_df[add_cols].values if add_cols else None
+    phenotype_cols = list(phenotype_col) if isinstance(phenotype_col, (list, tuple)) else None
+    if getattr(algorithm, "multi_phenotype", False):
+        if phenotype_cols is None:
+            return [algorithm().fit(phenotypes_df[phenotype_col].values, covariates)], [None], None
+        return [algorithm().fit(_phenotype_values(phenotypes_df, phenotype_cols), covariates)], [None], phenotype_cols
+
+    models, rows = [], []
+    for col in phenotype_cols or [phenotype_col]:
+        y = _phenotype_values(phenotypes_df, [col])[:, 0]
+        xp = backend_of(y).xp
+        present = to_host(~xp.isnan(y))
+        if present.all():
+            models.append(algorithm().fit(y, covariates))
+            rows.append(None)
+            continue
+        index = np.flatnonzero(present)
+        subset = xp.asarray(index)
+        models.append(algorithm().fit(y[subset], None if covariates is None else covariates[subset]))
+        rows.append(index)
+    return models, rows, phenotype_cols
+
+
+def _sample_rows(block, rows, xp):
+    """The rows of a variant block a model was fitted on."""
+    if rows is None:
+        return block
+    if isinstance(block, GenotypeMatrix):
+        # Missing calls are imputed from all samples, as for the masked linear engine
+        block = block.to_float(dtype=np.float64, xp=xp)
+    return block[backend_of(block).xp.asarray(rows)]
+
+
+def _test_block(models, rows, block, phenotype_cols):
+    """Per-phenotype dicts of 1-D statistics of one variant block."""
+    if phenotype_cols is None:
+        return [models[0].test(_sample_rows(block, rows[0], models[0].xp))]
+    if len(models) == 1:
+        stats = models[0].test(block)
+        return [{name: value[:, i] for name, value in stats.items()} for i in range(len(phenotype_cols))]
+    if isinstance(block, GenotypeMatrix):
+        # Unpack once for all models
+        block = block.to_float(dtype=np.float64, xp=models[0].xp)
+    return [model.test(_sample_rows(block, model_rows, model.xp)) for model, model_rows in zip(models, rows)]
+
+
+def _run_gwas_batched(phenotypes_df, phenotype_col, feature_cols, algorithm, add_cols, batch_size, genotypes,
+                      memory_budget, report, variants=None, output=None, checkpoint=None, resume=False):
+    """Fit the covariate model once and stream variant blocks sized by a BlockScheduler."""
+    with instrument.PeakMemory() as fit_memory:
+        models, rows, phenotype_cols = _fit_models(phenotypes_df, phenotype_col, algorithm, add_cols)
+    model = models[0]
+
+    backend = "numpy" if model.xp is np else "cupy"
+    scheduler = BlockScheduler(
+        len(phenotypes_df), len(add_cols), backend=backend, memory_budget=memory_budget,
+        work_buffers=getattr(model, "work_buffers", 6), block_size=batch_size,
+    )
+    scheduler.record("fit", fit_memory)
+
+    results = []
+    start = 0
+    n_variants = len(feature_cols)
+    if checkpoint is not None:
+        fingerprint = _fingerprint(phenotypes_df, phenotype_col, feature_cols, algorithm, add_cols, genotypes)
+        checkpoint = Checkpoint(checkpoint, fingerprint, resume, len(output.files) if output is not None else 0)
+        start = checkpoint.next_start
+        # Keep one block plan, so a resumed run tests the same blocks as an uninterrupted one
+        scheduler.adaptive = False
+        if checkpoint.block_size is not None:
+            # Continue the recorded block plan, whatever memory is free now
+            scheduler.block_size = checkpoint.block_size
+        if output is not None:
+            output.rollback(checkpoint.n_output_files)
+    while start < n_variants:
+        stop = min(start + scheduler.block_size, n_variants)
+        block, feature = _feature_block(phenotypes_df, feature_cols, genotypes, start, stop)
+        try:
+            with instrument.PeakMemory() as test_memory:
+                block_stats = _test_block(models, rows, block, phenotype_cols)
+        except MemoryError:
+            # Retry the same variants with a smaller block
+            if not scheduler.shrink():
+                raise
+            continue
+        scheduler.observe(stop - start, test_memory)
+        frame = _block_frame(block_stats, feature, phenotype_cols)
+        if output is not None:
+            output.write(variants.annotate(frame))
+        if checkpoint is not None:
+            checkpoint.add_block(start, stop, scheduler.block_size, None if output is not None else frame,
+                                 len(output.files) if output is not None else 0)
+        elif output is None:
+            results.append(frame)
+        start = stop
+
+    with instrument.PeakMemory() as results_memory:
+        if output is not None:
+            df = output.close()
+        else:
+            if checkpoint is not None:
+                # Earlier blocks may come from an interrupted run, so every block is read back
+                results = checkpoint.frames()
+            if not results:
+                # No variants: an empty block gives the result columns
+                block, feature = _feature_block(phenotypes_df, feature_cols, genotypes, 0, 0)
+                results = [_block_frame(_test_block(models, rows, block, phenotype_cols), feature, phenotype_cols)]
+            df = pd.concat(results, ignore_index=True)
+            if phenotype_cols is not None:
+                # Phenotype-major, in the order the phenotypes were given
+                order = df["phenotype"].map({name: i for i, name in enumerate(phenotype_cols)})
+                df = df.iloc[order.argsort(kind="stable")].reset_index(drop=True)
+            if variants is not None:
+                df = variants.annotate(df)
+            else:
+                df["chrom"] = 1
+            df = backend_of(phenotypes_df).df.DataFrame(df)
+    scheduler.record("results", results_memory)
+    instrument.annotate(scheduler=scheduler.report())
+    if report is not None:
+        report.update(scheduler.report())
     return df
+
+
+def _block_frame(block_stats, feature, phenotype_cols):
+    """Results of one block as a frame, without untestable variants."""
+    frames = []
+    for i, stats in enumerate(block_stats):
+        frame = pd.DataFrame(stats)
+        frame.insert(0, "feature", feature)
+        if phenotype_cols is not None:
+            frame.insert(1, "phenotype", phenotype_cols[i])
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+    # Variants without variance (e.g. monomorphic) are skipped like in the per-variant loop
+    return df[df["p_value"].notna()].reset_index(drop=True)
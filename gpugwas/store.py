@@ -0,0 +1,211 @@
+"""Module for an on-disk, queryable store of GWAS summary statistics.
+
+Results are streamed block by block into a Parquet dataset partitioned by
+phenotype and chromosome:
+
+    <path>/phenotype=<name>/chrom=<chrom>/part-00000.parquet
+    <path>/index.json
+
+Every part file is sorted by position and the index records its row
+count, position range and smallest p-value, so queries only open the
+files (and Parquet row groups) that can contain matching rows.
+"""
+
+import json
+import os
+import shutil
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from gpugwas.results import chrom_sort_key
+
+
+INDEX_FILE = "index.json"
+
+
+def _host_frame(df):
+    return df.to_pandas() if hasattr(df, "to_pandas") else df
+
+
+class ResultsWriter:
+    """
+    Append association result blocks (frames with chrom, pos and p_value,
+    e.g. annotated by results.VariantIndex) to a partitioned Parquet
+    dataset. The index is rewritten after every block, so a store is
+    readable while it is being written.
+    """
+
+    def __init__(self, path, row_group_size=65536):
+        self.path = path
+        self.row_group_size = row_group_size
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILE)
+        self.files = []
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.files = json.load(f)["files"]
+
+    def write(self, results, phenotype=None):
+        """Write one block of results, split by phenotype and chromosome."""
+        frame = _host_frame(results)
+        if len(frame) == 0:
+            return
+        frame = frame.copy()
+        frame["chrom"] = frame["chrom"].astype(str)
+        if "phenotype" not in frame.columns:
+            frame["phenotype"] = "" if phenotype is None else phenotype
+        for (name, chrom), part in frame.groupby(["phenotype", "chrom"], sort=False):
+            part = part.sort_values("pos", kind="stable")
+            directory = os.path.join(f"phenotype={quote(str(name), safe='')}", f"chrom={quote(chrom, safe='')}")
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+            file_name = os.path.join(directory, f"part-{len(self.files):05d}.parquet")
+            table = pa.Table.from_pandas(part.drop(columns=["phenotype"]), preserve_index=False)
+            pq.write_table(table, os.path.join(self.path, file_name), row_group_size=self.row_group_size)
+            self.files.append({
+                "file": file_name,
+                "phenotype": str(name),
+                "chrom": chrom,
+                "n_rows": len(part),
+                "pos_min": int(part["pos"].min()),
+                "pos_max": int(part["pos"].max()),
+                "p_min": float(part["p_value"].min()),
+            })
+        self._write_index()
+
+    def rollback(self, n_files):
+        """Forget (and delete) the part files written after the first `n_files`, e.g. by an interrupted run."""
+        for entry in self.files[n_files:]:
+            path = os.path.join(self.path, entry["file"])
+            if os.path.exists(path):
+                os.remove(path)
+        self.files = self.files[:n_files]
+        self._write_index()
+
+    def append(self, store):
+        """Copy every part file of a ResultsStore (e.g. a shard) into this dataset, without re-encoding."""
+        for entry in store.files:
+            directory = os.path.dirname(entry["file"])
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+            file_name = os.path.join(directory, f"part-{len(self.files):05d}.parquet")
+            shutil.copyfile(os.path.join(store.path, entry["file"]), os.path.join(self.path, file_name))
+            self.files.append(dict(entry, file=file_name))
+        self._write_index()
+
+    def _write_index(self):
+        tmp_path = os.path.join(self.path, f"{INDEX_FILE}.tmp-{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def close(self):
+        self._write_index()
+        return ResultsStore(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultsStore:
+    """Read-side queries over a dataset written by ResultsWriter, returning pandas frames."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.files = json.load(f)["files"]
+
+    @property
+    def phenotypes(self):
+        return sorted({entry["phenotype"] for entry in self.files})
+
+    @property
+    def n_rows(self):
+        return sum(entry["n_rows"] for entry in self.files)
+
+    def _entries(self, phenotype=None, chrom=None):
+        return [
+            entry for entry in self.files
+            if (phenotype is None or entry["phenotype"] == phenotype)
+            and (chrom is None or entry["chrom"] == str(chrom))
+        ]
+
+    def _read(self, entry, filters=None, columns=None):
+        frame = pq.read_table(os.path.join(self.path, entry["file"]), filters=filters, columns=columns).to_pandas()
+        frame.insert(0, "phenotype", entry["phenotype"])
+        return frame
+
+    @staticmethod
+    def _concat(frames, sort=True):
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return pd.DataFrame()
+        frame = pd.concat(frames, ignore_index=True)
+        if sort:
+            frame = frame.sort_values(
+                ["phenotype", "chrom", "pos"], kind="stable",
+                key=lambda column: column.map(chrom_sort_key) if column.name == "chrom" else column,
+            ).reset_index(drop=True)
+        return frame
+
+    def read(self, phenotype=None, chrom=None, columns=None):
+        """All results of a phenotype and/or chromosome, optionally only some `columns`."""
+        return self._concat([self._read(entry, columns=columns) for entry in self._entries(phenotype, chrom)],
+                            sort=columns is None)
+
+    def top(self, n=10, phenotype=None):
+        """The `n` smallest p-values; files are visited by their smallest p-value and skipped once they cannot compete."""
+        best = None
+        for entry in sorted(self._entries(phenotype), key=lambda e: e["p_min"]):
+            if best is not None and len(best) >= n and entry["p_min"] > best["p_value"].iloc[-1]:
+                break
+            frame = self._read(entry).nsmallest(n, "p_value")
+            best = frame if best is None else pd.concat([best, frame], ignore_index=True).nsmallest(n, "p_value")
+        return pd.DataFrame() if best is None else best.reset_index(drop=True)
+
+    def threshold(self, p_value=5e-8, phenotype=None):
+        """All variants with p < `p_value`, reading only files (and row groups) that can hold them."""
+        entries = [entry for entry in self._entries(phenotype) if entry["p_min"] < p_value]
+        return self._concat([self._read(entry, filters=[("p_value", "<", p_value)]) for entry in entries])
+
+    def region(self, chrom, start=None, end=None, phenotype=None):
+        """Variants in chrom:start-end (inclusive), using the position ranges of files and row groups."""
+        start = -1 if start is None else start
+        end = 2 ** 62 if end is None else end
+        entries = [
+            entry for entry in self._entries(phenotype, chrom)
+            if entry["pos_max"] >= start and entry["pos_min"] <= end
+        ]
+        filters = [("pos", ">=", start), ("pos", "<=", end)]
+        return self._concat([self._read(entry, filters=filters) for entry in entries])
+
+
+def merge_stores(paths, path):
+    """
+    Combine the stores at `paths` (e.g. per-chromosome or per-region
+    shards) into a new store at `path`. Raises ValueError when two shards
+    hold overlapping positions of the same phenotype and chromosome, as the
+    merged store would then have duplicate rows.
+    """
+    if os.path.exists(os.path.join(path, INDEX_FILE)):
+        raise FileExistsError(f"{path} already holds a results store")
+    stores = [ResultsStore(p) for p in paths]
+    ranges = {}
+    for i, store in enumerate(stores):
+        for entry in store.files:
+            ranges.setdefault((entry["phenotype"], entry["chrom"]), []).append((entry["pos_min"], entry["pos_max"], i))
+    for (phenotype, chrom), spans in ranges.items():
+        ends = {}
+        for start, end, j in sorted(spans):
+            for i, other_end in ends.items():
+                if i != j and start <= other_end:
+                    raise ValueError(f"Shards {paths[i]} and {paths[j]} overlap on chromosome {chrom} ({phenotype})")
+            ends[j] = max(ends.get(j, end), end)
+    with ResultsWriter(path) as writer:
+        for store in stores:
+            writer.append(store)
+    return ResultsStore(path)
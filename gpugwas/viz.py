@@ -8,29 +8,31 @@ Pre-reqs:
     dash_bootstrap_components \
     dash_core_components \
     dash_html_components
+
+Dash and Plotly are imported when a ManhattanPlot is created.
 """
 
 import os
-import cudf
 
-import plotly.graph_objects as go
-import dash
-import dash_bootstrap_components as dbc
-import dash_core_components as dcc
-import dash_html_components as html
+from gpugwas.backend import get_backend
+from gpugwas.vizprep import manhattan_points, qq_points
 
 # from dash.dependencies import Input, Output, State, ALL
 # from plotly.offline import init_notebook_mode
 # init_notebook_mode(connected = True)
 
 
-EXT_STYLES = ['https://codepen.io/chriddyp/pen/bWLwgP.css', dbc.themes.BOOTSTRAP]
+# dash_bootstrap_components.themes.BOOTSTRAP is appended when the app is created
+EXT_STYLES = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 
 class ManhattanPlot:
 
     def __init__(self, qq_spec, manhattan_spec, fig_path=None):
-        self.app = dash.Dash( __name__, external_stylesheets=EXT_STYLES)
+        import dash
+        import dash_bootstrap_components as dbc
+
+        self.app = dash.Dash( __name__, external_stylesheets=EXT_STYLES + [dbc.themes.BOOTSTRAP])
 
         self.qq_spec = qq_spec
         self.manhattan_spec = manhattan_spec
@@ -44,16 +46,19 @@ class ManhattanPlot:
             debug=False, use_reloader=False, host=host, port=port)
 
     def _construct_qq(self):
+        import plotly.graph_objects as go
 
-        x_values = self.qq_spec['df'][self.qq_spec['x_axis']]
-        y_values = self.qq_spec['df'][self.qq_spec['y_axis']]
+        df = self.qq_spec['df']
+        x_axis = self.qq_spec.get('x_axis')
+        points = qq_points(df[self.qq_spec['y_axis']].values,
+                           None if x_axis is None else df[x_axis].values)
 
-        x_max = float(x_values.max())
-        y_max = float(y_values.max())
+        x_max = float(points['expected'].max())
+        y_max = float(points['observed'].max())
 
         scatter_marker = go.Scattergl({
-                'x': self.qq_spec['df'][self.qq_spec['x_axis']].to_array(),
-                'y': y_values.to_array(),
+                'x': points['expected'].values,
+                'y': points['observed'].values,
                 'mode': 'markers',
                 'marker': {
                     'size': 2,
@@ -83,28 +88,25 @@ class ManhattanPlot:
         return scatter_fig
 
     def _construct_manhatten(self):
-        chroms = self.manhattan_spec['df'][self.manhattan_spec['group_by']].unique().to_array()
-
-        start_position = -0.5
-        scatter_traces = []
-
-        for chrom in chroms:
-            query = '%s == %s' % (self.manhattan_spec['group_by'], chrom)
-            cdf = self.manhattan_spec['df'].query(query)
-
-            x_array = cdf[self.manhattan_spec['x_axis']] + start_position 
-            scatter_trace = go.Scattergl({
-                    'x': x_array.to_array(),
-                    'y': cdf[self.manhattan_spec['y_axis']].to_array(),
-                    'name': 'Chromosome ' + str(chrom),
-                    'mode': 'markers',
-                    'marker': {
-                        'size': 2,
-                        'color': '#406278' if (start_position - 0.5) % 2 == 0 else '#e32636',
-                    },
-                })
-            scatter_traces.append(scatter_trace)
-            start_position += 1
+        import plotly.graph_objects as go
+
+        points, chroms = manhattan_points(
+            self.manhattan_spec['df'],
+            p_col=self.manhattan_spec['y_axis'],
+            chrom_col=self.manhattan_spec['group_by'],
+            pos_col=self.manhattan_spec['x_axis'])
+
+        colors = ['#406278', '#e32636']
+        scatter_traces = [go.Scattergl({
+                'x': points['x'].values,
+                'y': points['neglog10_p'].values,
+                'text': points['chrom'].values,
+                'mode': 'markers',
+                'marker': {
+                    'size': 2,
+                    'color': [colors[i % 2] for i in points['chrom_index'].values],
+                },
+            })]
 
         manhattan_fig = go.Figure(
             data = scatter_traces, 
@@ -119,13 +121,16 @@ class ManhattanPlot:
                     'gridwidth': 1, 
                     'ticks': 'outside',
                     'zeroline': False,
-                    'tickvals': [t for t in range(int(start_position + 0.5))],
-                    'ticktext': [str(t) for t in chroms],
+                    'tickvals': chroms['center'].tolist(),
+                    'ticktext': [str(t) for t in chroms['chrom']],
                 }})
         # plotly.offline.iplot({ "data": manhattan_fig, "layout": go.Layout(title="Sine wave")})
         return manhattan_fig
 
     def _construct(self):
+        import dash_core_components as dcc
+        import dash_html_components as html
+
         manhattan_fig = self._construct_manhatten()
         # qq_plot_fig = self._construct_qq()
 
@@ -151,18 +156,18 @@ class ManhattanPlot:
 
 
 def main():
-    df = cudf.read_csv('./data/data.csv')
+    df = get_backend().df.read_csv('./data/data.csv')
 
     qq_spec = {}
     qq_spec['df'] = df
-    qq_spec['x_axis'] = 'P'
-    qq_spec['y_axis'] = 'ZSCORE'
+    qq_spec['x_axis'] = None
+    qq_spec['y_axis'] = 'P'
 
     manhattan_spec = {}
     manhattan_spec['df'] = df
     manhattan_spec['group_by'] = 'CHR'
-    manhattan_spec['x_axis'] = 'P'
-    manhattan_spec['y_axis'] = 'ZSCORE'
+    manhattan_spec['x_axis'] = 'BP'
+    manhattan_spec['y_axis'] = 'P'
 
     fig_path = None
 
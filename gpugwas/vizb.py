@@ -3,89 +3,93 @@
 Pre-reqs:
 ---------
 /opt/conda/envs/rapids/bin/pip install bokeh
+
+Bokeh is imported on first use and notebook output is only enabled when a
+plot is shown. Saving with `save_to` needs selenium and a browser; use
+gpugwas.vizstatic to write PNG/SVG files on headless machines.
 """
 
-import cudf
-import cupy
+from gpugwas.vizprep import manhattan_points, qq_points
 
-from  bokeh.io.export import export_png
 
-from bokeh.plotting import figure
-from bokeh.models.tickers import FixedTicker
-from bokeh.io import output_notebook, push_notebook, show
+def _show(fig):
+    from bokeh.io import output_notebook, push_notebook, show
 
-output_notebook()
+    output_notebook()
+    handle = show(fig, notebook_handle=True)
+    push_notebook(handle=handle)
 
 
-def show_qq_plot(df, x_axis, y_axis, title="QQ", 
-                 save_to=None, x_max=None, y_max=None):
+def _export(fig, save_to):
+    from bokeh.io.export import export_png
 
-    x_values = cupy.fromDlpack(df[x_axis].to_dlpack())
-    y_values = cupy.fromDlpack(df[y_axis].to_dlpack())
+    export_png(fig, filename=save_to)
 
-    x_values = -cupy.log10(x_values)
-    y_values = -cupy.log10(y_values)
+
+def show_qq_plot(df, x_axis, y_axis, title="QQ", 
+                 save_to=None, x_max=None, y_max=None,
+                 significance=1e-5):
+    """
+    Q-Q plot of the p-values in `y_axis` against the expected p-values in
+    `x_axis` (None to derive them from the ranks). Points below
+    `significance` are drawn exactly, the rest thinned by vizprep.qq_points.
+    """
+    from bokeh.plotting import figure
+
+    expected = None if x_axis is None else df[x_axis].values
+    points = qq_points(df[y_axis].values, expected, significance=significance)
 
     if x_max is None:
-        x_max = cupy.max(x_values).tolist()
+        x_max = float(points['expected'].max())
     if y_max is None:
-        y_max = cupy.max(y_values).tolist()
-
-    if y_max == cupy.inf:
-        print("Please pass y_max. Input contains inf.")
-        return
-    if x_max == cupy.inf:
-        print("Please pass x_max. Input contains inf.")
-        return
+        y_max = float(points['observed'].max())
 
     qq_fig = figure(x_range=(0, x_max), 
                     y_range=(0, y_max),
                     title=title)
-    qq_fig.circle(x_values.get(), y_values.get(), size=1)
+    qq_fig.circle(points['expected'].values, points['observed'].values, size=1)
     qq_fig.line([0, x_max], [0, y_max], line_color='orange', line_width=2)
 
     if save_to:
-        export_png(qq_fig, filename=save_to)
+        _export(qq_fig, save_to)
     else:
-        qq_handle = show(qq_fig, notebook_handle=True)
-        push_notebook(handle=qq_handle)
+        _show(qq_fig)
     
     return qq_fig
 
 
 def show_manhattan_plot(df, group_by, x_axis, y_axis, 
                         title='Manhattan Plot',
-                        save_to=None):
-    chroms = df[group_by].unique().to_array()
-    
-    plot_width = len(chroms) * 50
+                        save_to=None, significance=1e-5):
+    """
+    Manhattan plot of p-values `y_axis` at positions `x_axis` within the
+    chromosomes `group_by`. Points below `significance` are drawn exactly,
+    the rest thinned by vizprep.manhattan_points, in a single glyph.
+    """
+    from bokeh.plotting import figure
+    from bokeh.models.tickers import FixedTicker
+
+    points, chroms = manhattan_points(df, p_col=y_axis, chrom_col=group_by, pos_col=x_axis,
+                                      significance=significance)
 
     manhattan_fig = figure(title=title)
     manhattan_fig.xaxis.axis_label = 'Chromosomes'
     manhattan_fig.yaxis.axis_label = '-log10(p)'
 
-    manhattan_fig.xaxis.ticker = FixedTicker(ticks=[t for t in chroms])
-
-    start_position = 0.5
-    for chrom in chroms:
-        query = '%s == %s' % (group_by, chrom)
-        cdf = df.query(query)
-
-        x_array = cupy.fromDlpack(cdf[x_axis].to_dlpack())  + start_position
-        y_array = -cupy.log10(cupy.fromDlpack(cdf[y_axis].to_dlpack()))
-
-        manhattan_fig.circle(
-            x_array.get(),
-            y_array.get(),
-            size=2, color='orange' if (start_position - 0.5) % 2 == 0 else 'gray', alpha=0.5)
-
-        start_position += 1
+    manhattan_fig.xaxis.ticker = FixedTicker(ticks=chroms['center'].tolist())
+    manhattan_fig.xaxis.major_label_overrides = {
+        center: str(chrom) for center, chrom in zip(chroms['center'].tolist(), chroms['chrom'])
+    }
 
+    colors = ['orange', 'gray']
+    manhattan_fig.circle(
+        points['x'].values,
+        points['neglog10_p'].values,
+        size=2, color=[colors[i % 2] for i in points['chrom_index'].values], alpha=0.5)
 
     if save_to:
-        export_png(manhattan_fig, filename=save_to)
+        _export(manhattan_fig, save_to)
     else:
-        manhattan_handle = show(manhattan_fig, notebook_handle=True)
-        push_notebook(handle=manhattan_handle)
+        _show(manhattan_fig)
     
-    return manhattan_fig
\ No newline at end of file
+    return manhattan_fig
@@ -0,0 +1,124 @@
+"""Module for reducing GWAS results to a plottable number of points.
+
+Manhattan and Q-Q plots of millions of variants are dominated by the
+non-significant bulk, which renders as a solid band. Points above a
+significance threshold are kept exactly; the rest are binned on a
+(x, -log10 p) grid and each occupied cell is drawn once, with the number
+of variants it stands for. All steps are whole-array operations (one sort
+and one unique over cell ids), with no per-chromosome queries.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from gpugwas.backend import to_host
+from gpugwas.results import chrom_sort_key
+
+
+ManhattanData = namedtuple("ManhattanData", ["points", "chroms"])
+ManhattanData.__doc__ = """
+points: pd.DataFrame
+    x (genome-wide position), neglog10_p, chrom, chrom_index (for
+    alternating colors) and count (variants represented by the point).
+chroms: pd.DataFrame
+    chrom, start, end and center of every chromosome on the x axis.
+"""
+
+
+def _column(df, name):
+    """Host numpy array of a pandas or cudf column."""
+    column = df[name]
+    if hasattr(column, "to_pandas"):
+        column = column.to_pandas()
+    return np.asarray(column.to_numpy())
+
+
+def _neglog10(p_values):
+    with np.errstate(divide="ignore"):
+        return -np.log10(np.asarray(p_values, dtype=np.float64))
+
+
+def thin_points(x, y, keep, x_bins=1000, y_bins=100):
+    """
+    Indices of the points to draw and the number of points each stands for:
+    every point with `keep` set, plus one point per occupied cell of an
+    (x_bins, y_bins) grid over the others.
+    """
+    x, y, keep = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(keep, dtype=bool)
+    finite = np.isfinite(x) & np.isfinite(y)
+    kept = np.flatnonzero(keep & finite)
+    rest = np.flatnonzero(~keep & finite)
+    if len(rest) == 0:
+        return kept, np.ones(len(kept), dtype=np.int64)
+
+    def bins(values, n_bins):
+        lo, hi = values.min(), values.max()
+        scaled = (values - lo) / (hi - lo) if hi > lo else np.zeros_like(values)
+        return np.minimum((scaled * n_bins).astype(np.int64), n_bins - 1)
+
+    cells = bins(x[rest], x_bins) * y_bins + bins(y[rest], y_bins)
+    _, first, counts = np.unique(cells, return_index=True, return_counts=True)
+    index = np.concatenate([kept, rest[first]])
+    count = np.concatenate([np.ones(len(kept), dtype=np.int64), counts])
+    order = np.argsort(index, kind="stable")
+    return index[order], count[order]
+
+
+def manhattan_points(results, p_col="p_value", chrom_col="chrom", pos_col="pos", significance=1e-5,
+                     x_bins=1000, y_bins=100):
+    """
+    Lay results out along the genome (chromosomes in natural order, each
+    offset by the length of the previous ones) and thin them with
+    `thin_points`, keeping every variant with p < `significance`.
+    Results without `pos_col` are laid out by `feature`.
+    """
+    if pos_col not in results.columns:
+        pos_col = "feature"
+    chrom = _column(results, chrom_col).astype(str)
+    pos = _column(results, pos_col).astype(np.int64)
+    neglog10_p = _neglog10(_column(results, p_col))
+
+    names, codes = np.unique(chrom, return_inverse=True)
+    order = sorted(range(len(names)), key=lambda i: chrom_sort_key(names[i]))
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[order] = np.arange(len(names))
+    codes = rank[codes]
+    names = names[order]
+
+    # Chromosome extents from one grouped reduction
+    ends = np.zeros(len(names), dtype=np.int64)
+    np.maximum.at(ends, codes, pos)
+    offsets = np.concatenate([[0], np.cumsum(ends)[:-1]])
+    x = offsets[codes] + pos
+
+    index, count = thin_points(x, neglog10_p, neglog10_p > -np.log10(significance), x_bins, y_bins)
+    points = pd.DataFrame({
+        "x": x[index],
+        "neglog10_p": neglog10_p[index],
+        "chrom": names[codes[index]],
+        "chrom_index": codes[index],
+        "count": count,
+    })
+    chroms = pd.DataFrame({"chrom": names, "start": offsets, "end": offsets + ends})
+    chroms["center"] = (chroms["start"] + chroms["end"]) / 2
+    return ManhattanData(points, chroms)
+
+
+def qq_points(p_values, expected=None, significance=1e-5, x_bins=1000, y_bins=1000):
+    """
+    (expected -log10 p, observed -log10 p, count) frame of a Q-Q plot,
+    with expected p-values from the ranks unless given, thinned like
+    `manhattan_points`.
+    """
+    observed = _neglog10(to_host(p_values))
+    finite = np.isfinite(observed)
+    observed = np.sort(observed[finite])[::-1]
+    if expected is None:
+        n = len(observed)
+        expected = -np.log10((np.arange(1, n + 1) - 0.5) / max(n, 1))
+    else:
+        expected = np.sort(_neglog10(to_host(expected))[finite])[::-1]
+    index, count = thin_points(expected, observed, observed > -np.log10(significance), x_bins, y_bins)
+    return pd.DataFrame({"expected": expected[index], "observed": observed[index], "count": count})
@@ -0,0 +1,79 @@
+"""Module for rendering Manhattan and Q-Q plots to PNG/SVG files without a browser.
+
+Plots are drawn with matplotlib's Agg canvas directly (no pyplot, so no
+display or GUI backend is touched) from the points of gpugwas.vizprep.
+The thinned non-significant bulk is rasterized even in SVG output, while
+significant variants stay vector markers, so file size and render time do
+not grow with the number of variants. matplotlib is imported on the first
+plot, so importing this module stays cheap.
+"""
+
+import numpy as np
+
+from gpugwas.vizprep import manhattan_points, qq_points
+
+
+COLORS = ("#406278", "#e32636")
+
+
+def _figure(size):
+    from matplotlib.figure import Figure
+
+    return Figure(figsize=size)
+
+
+def _save(fig, save_to, dpi):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    FigureCanvasAgg(fig)
+    fig.savefig(save_to, dpi=dpi)
+    return save_to
+
+
+def manhattan_plot(df, save_to, group_by="chrom", x_axis="pos", y_axis="p_value", title="GWAS Manhattan Plot",
+                   significance=1e-5, genome_wide=5e-8, size=(12, 4), dpi=150):
+    """
+    Write a Manhattan plot of p-values `y_axis` at positions `x_axis`
+    within chromosomes `group_by` to `save_to` (format from the extension).
+    """
+    points, chroms = manhattan_points(df, p_col=y_axis, chrom_col=group_by, pos_col=x_axis,
+                                      significance=significance)
+    fig = _figure(size)
+    ax = fig.add_subplot()
+    bulk = points["neglog10_p"] <= -np.log10(significance)
+    for parity, color in enumerate(COLORS):
+        for part, rasterized in ((points[bulk], True), (points[~bulk], False)):
+            part = part[part["chrom_index"] % 2 == parity]
+            ax.scatter(part["x"], part["neglog10_p"], s=2, c=color, linewidths=0, rasterized=rasterized)
+    if genome_wide:
+        ax.axhline(-np.log10(genome_wide), color="gray", linestyle="--", linewidth=0.8)
+    ax.set_xticks(chroms["center"])
+    ax.set_xticklabels(chroms["chrom"], fontsize=7)
+    ax.set_xlim(chroms["start"].min(), chroms["end"].max())
+    ax.set_ylim(bottom=0)
+    ax.set_xlabel("Chromosomes")
+    ax.set_ylabel("-log10(p)")
+    ax.set_title(title)
+    fig.tight_layout()
+    return _save(fig, save_to, dpi)
+
+
+def qq_plot(df, save_to, y_axis="p_value", x_axis=None, title="Q-Q Plot", significance=1e-5, size=(5, 5), dpi=150):
+    """
+    Write a Q-Q plot of the p-values in `y_axis` against expected p-values
+    (the column `x_axis`, or derived from the ranks when None) to `save_to`.
+    """
+    expected = None if x_axis is None else df[x_axis].values
+    points = qq_points(df[y_axis].values, expected, significance=significance)
+    fig = _figure(size)
+    ax = fig.add_subplot()
+    bulk = points["observed"] <= -np.log10(significance)
+    ax.scatter(points["expected"][bulk], points["observed"][bulk], s=2, c=COLORS[0], linewidths=0, rasterized=True)
+    ax.scatter(points["expected"][~bulk], points["observed"][~bulk], s=2, c=COLORS[0], linewidths=0)
+    limit = float(points["expected"].max()) if len(points) else 1.0
+    ax.plot([0, limit], [0, limit], color="orange", linewidth=1.5)
+    ax.set_xlabel("Expected -log10(p)")
+    ax.set_ylabel("Observed -log10(p)")
+    ax.set_title(title)
+    fig.tight_layout()
+    return _save(fig, save_to, dpi)
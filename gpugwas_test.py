@@ -1,5 +1,15 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+
 import gpugwas.io as gwasio
-import cudf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+import synthetic  # noqa: E402
+
+tmp_dir = tempfile.mkdtemp()
 
 # Test loading VCF
 print("Test loading VCF to DF")
@@ -8,6 +18,16 @@ vcf_df = gwasio.load_vcf("data/test.vcf", info_keys=["*"], format_keys=["*"])
 #vcf_df.to_parquet(path="1kg_full_jdaw_v2.pqt", compression="auto", index=False)
 print(vcf_df)
 
+# Test streaming VCF blocks
+print("Test streaming VCF blocks")
+for block in gwasio.iter_vcf_blocks("data/test.vcf", variants_per_block=1000):
+    print(block.variants.shape, block.calls["call_GT"].shape)
+
+# Test loading packed genotypes
+print("Test loading packed genotypes")
+genotype_data = gwasio.load_genotypes("data/test.vcf")
+print(genotype_data.genotypes.shape, genotype_data.genotypes.nbytes)
+
 # Test loading annotation file
 print("Test loading annotation file")
 ann_df = gwasio.load_annotations("data/1kg_annotations.txt")
@@ -20,4 +40,286 @@ vcf_df_2 = gwasio.load_vcf_variantworks(
 )
 print(vcf_df_2)
 
+# Test that a cache is rebuilt when its VCF changes
+print("Test VCF cache invalidation")
+vcf_path = os.path.join(tmp_dir, "cache.vcf")
+cache_path = os.path.join(tmp_dir, "cache.vcf.cache")
+synthetic.write_vcf(vcf_path, synthetic.simulate_genotypes(10, 20)[0])
+gwasio.build_vcf_cache(vcf_path, cache_path, ["AF"], ["GT", "DP"])
+assert gwasio.vcf_cache_is_current(cache_path, vcf_path)
+stat = os.stat(vcf_path)
+synthetic.write_vcf(vcf_path, synthetic.simulate_genotypes(10, 30)[0])
+os.utime(vcf_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+assert not gwasio.vcf_cache_is_current(cache_path, vcf_path)
+gwasio.build_vcf_cache(vcf_path, cache_path, ["AF"], ["GT", "DP"])
+assert len(gwasio.read_vcf_cache(cache_path).variants) == 30
+
+# Test that cached genotypes are served memory-mapped from the cache
+print("Test genotypes served from the VCF cache")
+uncached = gwasio.load_genotypes(vcf_path)
+gwasio.load_genotypes(vcf_path, cache_dir=os.path.join(tmp_dir, "vcf_cache"))
+cached = gwasio.load_genotypes(vcf_path, cache_dir=os.path.join(tmp_dir, "vcf_cache"))
+assert isinstance(cached.genotypes.packed, np.memmap)
+assert (cached.genotypes.to_int8() == uncached.genotypes.to_int8()).all()
+assert list(cached.variants["pos"]) == list(uncached.variants["pos"])
+
+# Test that loading an indexed VCF without SNVs in parallel gives an empty frame
+print("Test loading an empty indexed VCF by region")
+import pysam  # noqa: E402
+
+with open(vcf_path) as f:
+    header = [line for line in f if line.startswith("#")]
+empty_vcf = os.path.join(tmp_dir, "empty.vcf")
+with open(empty_vcf, "w") as f:
+    f.writelines(header)
+empty_vcf = pysam.tabix_index(empty_vcf, preset="vcf", force=True)
+empty_df, empty_mapping = gwasio.load_vcf(empty_vcf, ["AF"], ["GT"], num_workers=2, region_size=100)
+assert len(empty_df) == 0 and "call_GT" in empty_df.columns and len(empty_mapping) == 0
+
+# Test that missing calls reach association as the variant mean dosage, not -1
+print("Test missing calls in the phenotype matrix")
+import pandas as pd  # noqa: E402
+
+import gpugwas.association as association  # noqa: E402
+import gpugwas.dataprep as dataprep  # noqa: E402
+import gpugwas.runner as runner  # noqa: E402
+
+calls = np.array([[0, 1], [1, -1], [2, 2], [1, 0], [0, 1], [2, 2]])
+samples = [f"S{i}" for i in range(len(calls))]
+long_df = pd.DataFrame({
+    "sample": np.repeat(samples, 2),
+    "feature_id": np.tile([0, 1], len(samples)),
+    "call_GT": calls.ravel(),
+})
+ann_df = pd.DataFrame({"Sample": samples, "y": [0.1, 0.9, 2.2, 1.1, 0.2, 1.8]})
+pheno_df, matrix, feature_ids = dataprep.create_phenotype_matrix(long_df, ann_df, ["y"])
+assert np.isclose(matrix[1, 1], 1.2)
+result = runner.run_gwas(pheno_df, "y", feature_ids, association.LinearAssociation, genotypes=matrix)
+expected = np.polyfit(np.array([1, 1.2, 2, 0, 1, 2]), ann_df["y"].values, 1)[0]
+assert np.isclose(result["beta"].values[1], expected)
+
+# Test that stage peaks are per stage: a small stage after a large one reports less
+print("Test per-stage peak memory")
+import gpugwas.instrument as instrument  # noqa: E402
+
+os.environ[instrument.EXACT_PEAK_ENV_VAR] = "1"
+report = instrument.Report()
+with instrument.stage("large", report=report):
+    large = np.ones(2 ** 25)
+    del large
+with instrument.stage("small", report=report):
+    small = np.ones(2 ** 10)
+    del small
+large_stage, small_stage = report.stages
+assert large_stage["host_peak_delta_bytes"] >= 2 ** 28
+assert small_stage["host_peak_delta_bytes"] < large_stage["host_peak_delta_bytes"] / 4
+assert small_stage["host_peak_bytes"] < large_stage["host_peak_bytes"]
+del os.environ[instrument.EXACT_PEAK_ENV_VAR]
+
+# Without opting in, stages leave the process-wide high-water mark alone and reports stay bounded
+large = np.ones(2 ** 25)
+del large
+high_water = instrument.host_peak_memory()
+report = instrument.Report(max_stages=3)
+for i in range(5):
+    with instrument.stage(f"stage{i}", report=report):
+        pass
+assert instrument.host_peak_memory() >= high_water
+assert [s["stage"] for s in report.stages] == ["stage2", "stage3", "stage4"] and report.dropped_stages == 2
+
+# Test that block sizes follow the memory of each block, not of the largest one so far
+print("Test block scheduler headroom")
+
+
+def block_memory(n_bytes):
+    memory = instrument.PeakMemory()
+    memory.host_start, memory.host_peak = 0, n_bytes
+    return memory
+
+
+scheduler = runner.BlockScheduler(1000, 2, memory_budget=10_000_000)
+scheduler.observe(scheduler.block_size, block_memory(scheduler.block_size * 200_000))
+shrunk = scheduler.block_size
+scheduler.observe(scheduler.block_size, block_memory(scheduler.block_size * 8000))
+assert scheduler.block_size > shrunk
+
+# Test that association without variants returns the result columns
+print("Test association without variants")
+empty = runner.run_gwas(pheno_df, "y", feature_ids[:0], association.LinearAssociation, genotypes=matrix[:, :0])
+assert len(empty) == 0 and "p_value" in empty.columns
+
+# Test exact HWE p-values: variants without calls, and biobank-sized counts on a bounded grid
+print("Test HWE p-values")
+import gpugwas.filter as gwasfilter  # noqa: E402
+
+p_hwe = gwasfilter.hwe_pvalues([0, 2, 124_000, 125_000], [0, 5, 252_000, 250_000], [0, 1, 124_000, 125_000])
+assert np.isnan(p_hwe[0]) and np.isclose(p_hwe[1], 0.76503497)
+assert p_hwe[2] < 1e-6 < p_hwe[3] <= 1.0
+
+# Test that clumping keeps phenotypes apart
+print("Test clumping two phenotypes")
+from gpugwas.genotype import GenotypeData, GenotypeMatrix  # noqa: E402
+from gpugwas.ld import clump_results  # noqa: E402
+
+dosage = np.tile(np.array([[0], [1], [2], [1], [0], [2]], dtype=np.int8), (1, 2))
+ld_data = GenotypeData(
+    GenotypeMatrix.from_dosage(dosage),
+    pd.DataFrame({"feature_id": [0, 1], "chrom": ["1", "1"], "pos": [100, 200]}),
+    pd.DataFrame({"sample": samples}),
+)
+two_traits = pd.DataFrame({
+    "feature": [0, 1, 0, 1],
+    "phenotype": ["a", "a", "b", "b"],
+    "p_value": [1e-10, 1e-3, 0.5, 1e-3],
+})
+clumped = clump_results(two_traits, ld_data)
+assert list(clumped["clump"]) == [0, 0, -1, -1]
+
+# Test that per-phenotype models leave out samples missing the phenotype, and phenotypes keep their order
+print("Test missing phenotype values in logistic association")
+from gpugwas.results import VariantIndex  # noqa: E402
+
+rng = np.random.default_rng(0)
+dosage = rng.integers(0, 3, size=(200, 5)).astype(np.int8)
+binary = pd.DataFrame({
+    "z": (rng.random(200) < 0.5).astype(float),
+    "y": (rng.random(200) < 1 / (1 + np.exp(1 - dosage[:, 0]))).astype(float),
+})
+binary.loc[:19, "y"] = np.nan
+coords = VariantIndex(["1"] * 5, np.arange(5) * 10, ["A"] * 5, ["G"] * 5)
+both = runner.run_gwas(binary, ["z", "y"], np.arange(5), association.LogisticAssociation,
+                       genotypes=dosage.astype(float), variants=coords)
+complete = runner.run_gwas(binary.iloc[20:], "y", np.arange(5), association.LogisticAssociation,
+                           genotypes=dosage[20:].astype(float))
+assert list(pd.unique(both["phenotype"])) == ["z", "y"]
+assert np.allclose(both[both["phenotype"] == "y"]["p_value"].values, complete["p_value"].values)
+
+# Test that alleles are stored as categoricals and looked up by feature id
+print("Test variant index alleles")
+index = VariantIndex.from_table(pd.DataFrame({
+    "feature_id": [2, 0, 1], "chrom": ["2", "1", "1"], "pos": [5, 10, 20], "ref": ["A", "C", "G"], "alt": ["T", "T", "C"],
+}))
+assert isinstance(index.ref.dtype, pd.CategoricalDtype) and isinstance(index.alt.dtype, pd.CategoricalDtype)
+annotated = index.annotate(pd.DataFrame({"feature": [2, 1], "p_value": [0.1, 0.2]}))
+assert list(annotated["ref"]) == ["G", "A"] and list(annotated["alt"]) == ["C", "T"]
+
+# Test that a checkpoint never deletes files it did not write
+print("Test checkpoint directory ownership")
+ckpt_dir = os.path.join(tmp_dir, "ckpt")
+os.makedirs(ckpt_dir)
+with open(os.path.join(ckpt_dir, "keep.txt"), "w") as f:
+    f.write("user data")
+try:
+    runner.Checkpoint(ckpt_dir, {"run": 1}, resume=True)
+    raise AssertionError("Checkpoint accepted a directory holding other files")
+except FileExistsError:
+    pass
+assert os.path.exists(os.path.join(ckpt_dir, "keep.txt"))
+os.remove(os.path.join(ckpt_dir, "keep.txt"))
+ckpt = runner.Checkpoint(ckpt_dir, {"run": 1})
+ckpt.add_block(0, 2, 2, pd.DataFrame({"feature": [0, 1], "p_value": [0.1, 0.2]}))
+with open(os.path.join(ckpt_dir, "keep.txt"), "w") as f:
+    f.write("user data")
+ckpt = runner.Checkpoint(ckpt_dir, {"run": 2})
+assert ckpt.next_start == 0
+assert sorted(os.listdir(ckpt_dir)) == ["keep.txt", runner.Checkpoint.MANIFEST]
+
+# Test the Firth likelihood ratio test against a direct maximization of the penalized likelihood
+print("Test Firth penalized likelihood ratio test")
+from scipy.optimize import minimize  # noqa: E402
+
+
+def firth_objective(b, X, y):
+    eta = X @ b
+    w = 1 / (1 + np.exp(-eta)) / (1 + np.exp(eta))
+    return -(y @ eta - np.logaddexp(0, eta).sum() + 0.5 * np.linalg.slogdet(X.T @ (w[:, None] * X))[1])
+
+
+rng = np.random.default_rng(1)
+covs = rng.normal(size=(300, 2))
+status = (rng.random(300) < 1 / (1 + np.exp(2 - covs[:, 0]))).astype(float)
+rare = rng.binomial(2, 0.05, size=(300, 4)).astype(float)
+firth = association.LogisticAssociation(firth_threshold=1.1).fit(status, covs).test(rare)
+assert firth["firth"].all()
+for j in range(rare.shape[1]):
+    X = np.column_stack([np.ones(300), covs, rare[:, j]])
+    full = minimize(firth_objective, np.zeros(4), args=(X, status), method="BFGS", options={"gtol": 1e-10})
+    null = minimize(lambda b: firth_objective(np.append(b, 0.0), X, status), np.zeros(3), method="BFGS",
+                    options={"gtol": 1e-10})
+    assert np.isclose(firth["chi_sq"][j], 2 * (null.fun - full.fun), atol=1e-6)
+
+# Test that stages without a backend argument follow their input, or the configured backend
+print("Test backend defaults")
+from gpugwas import backend  # noqa: E402
+
+packed = GenotypeMatrix.from_dosage(dosage)
+assert backend.compute_backend(packed) is backend.get_backend()
+assert backend.compute_backend(dosage.astype(float)).name == "numpy"
+assert backend.compute_backend(packed, "numpy").name == "numpy"
+
+# Test that a checkpoint is not resumed on other phenotype values or genotypes with the same ids
+print("Test checkpoint fingerprint of the data")
+saved = os.path.join(tmp_dir, "fingerprint_genotypes")
+GenotypeMatrix.from_dosage(dosage).save(saved)
+ckpt_dir = os.path.join(tmp_dir, "fingerprint_ckpt")
+
+
+def resume_with(phenotypes, genotypes):
+    return runner.run_gwas(phenotypes, "z", np.arange(5), association.LinearAssociation, genotypes=genotypes,
+                           checkpoint=ckpt_dir, resume=True)
+
+
+def assert_not_resumed(phenotypes, genotypes):
+    try:
+        resume_with(phenotypes, genotypes)
+        raise AssertionError("Resumed a checkpoint written on other data")
+    except ValueError:
+        pass
+
+
+resume_with(binary, GenotypeMatrix.load(saved))
+resume_with(binary, GenotypeMatrix.load(saved))
+assert_not_resumed(binary.assign(z=binary["z"][::-1].values), GenotypeMatrix.load(saved))
+assert_not_resumed(binary, GenotypeMatrix.from_dosage(np.where(dosage == 0, 2, dosage)))
+stat = os.stat(os.path.join(saved, "packed.npy"))
+os.utime(os.path.join(saved, "packed.npy"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+assert_not_resumed(binary, GenotypeMatrix.load(saved))
+
+# Test fused QC of a GenotypeData: variant call rates over the samples kept by DP and call rate
+print("Test fused genotype QC")
+rng = np.random.default_rng(2)
+qc_dosage = rng.integers(0, 3, size=(40, 30)).astype(np.int8)
+qc_dosage[rng.random((40, 30)) < np.linspace(0, 0.4, 40)[:, None]] = -1
+qc_samples = pd.DataFrame({"sample": [f"S{i}" for i in range(40)], "dp_mean": rng.random(40) * 20})
+qc_variants = pd.DataFrame({"feature_id": np.arange(30), "AF": rng.random(30)})
+qc_data = gwasfilter.filter_qc(GenotypeData(GenotypeMatrix.from_dosage(qc_dosage), qc_variants, qc_samples),
+                               min_dp_mean=5, min_sample_call_rate=0.8, min_af=0.1, min_variant_call_rate=0.8)
+kept_samples = ((qc_dosage >= 0).mean(axis=1) > 0.8) & (qc_samples["dp_mean"].values >= 5)
+kept_variants = ((qc_dosage[kept_samples] >= 0).mean(axis=0) > 0.8) & (qc_variants["AF"].values >= 0.1)
+assert (qc_data.genotypes.to_int8() == qc_dosage[kept_samples][:, kept_variants]).all()
+assert (GenotypeMatrix.from_dosage(qc_dosage).subset(samples=[3, 17]).to_int8() == qc_dosage[[3, 17]]).all()
+
+# Test that sufficient statistics merged over sample batches and variant shards match one association run
+print("Test merging linear sufficient statistics")
+rng = np.random.default_rng(3)
+stats_dosage = rng.integers(0, 3, size=(120, 12)).astype(np.int8)
+stats_dosage[rng.random((120, 12)) < 0.1] = -1
+stats_covs = rng.normal(size=(120, 2))
+stats_y = 0.3 * np.where(stats_dosage[:, 0] < 0, 1, stats_dosage[:, 0]) + stats_covs[:, 0] + rng.normal(size=120)
+stats_matrix = GenotypeMatrix.from_dosage(stats_dosage)
+
+
+def batch_stats(rows, columns):
+    genotypes = GenotypeMatrix.from_dosage(stats_dosage[rows][:, columns])
+    return association.LinearSufficientStats.from_batch(genotypes, stats_y[rows], stats_covs[rows])
+
+
+merged = batch_stats(slice(0, 50), slice(0, 5)).add_samples(batch_stats(slice(50, 120), slice(0, 5)))
+merged = merged.add_variants(batch_stats(slice(0, 120), slice(5, 12)))
+merged.save(os.path.join(tmp_dir, "stats.npz"))
+merged = association.LinearSufficientStats.load(os.path.join(tmp_dir, "stats.npz"))
+single = association.LinearAssociation().fit(stats_y, stats_covs).test(stats_matrix)
+for name, values in merged.test().items():
+    assert np.allclose(values, single[name]), name
+
 print("===== TEST PASSED ====")
@@ -1,18 +1,22 @@
 import argparse
+import logging
+import os
 import time
 from collections import defaultdict
 
-import cupy as cp
-import cudf
 import pandas as pd
-import rmm
 
 import gpugwas.io as gwasio
 import gpugwas.filter as gwasfilter
 import gpugwas.algorithms as algos
+import gpugwas.association as assoc
 import gpugwas.dataprep as dp
 import gpugwas.runner as runner
+import gpugwas.instrument as instrument
+from gpugwas.backend import set_backend, set_blas_threads
+from gpugwas.results import VariantIndex
 
+from gpugwas import vizstatic
 from gpugwas.vizb import show_qq_plot, show_manhattan_plot
 #import gpugwas.processing as gwasproc
 
@@ -25,15 +29,33 @@ parser = argparse.ArgumentParser(description='Run GPU GWAS Pipeline')
 parser.add_argument('--vcf_path', default = './data/test.vcf')
 parser.add_argument('--annotation_path', default = './data/1kg_annotations.txt')
 parser.add_argument('--workdir', default = './temp/')
+parser.add_argument('--cache_dir', default = None, help='Directory for the parsed VCF cache (skips VCF parsing on later runs)')
+parser.add_argument('--backend', default = None, help='numpy (pandas, CPU), cupy (cuDF, GPU) or auto (default: $GPUGWAS_BACKEND or auto)')
+parser.add_argument('--threads', type=int, default = None, help='BLAS threads for the numpy backend')
+parser.add_argument('--gpu_pool_size', type=float, default = 1e10, help='Initial RMM pool size in bytes')
+parser.add_argument('--memory_budget', type=float, default = None, help='Bytes available to association blocks (default: free GPU memory)')
+parser.add_argument('--checkpoint_dir', default = None, help='Record finished association blocks here and resume from them when rerun')
+parser.add_argument('--report', default = None, help='Write per-stage timing/memory report as JSON to this path')
+parser.add_argument('--plot_dir', default = None, help='Write static Manhattan/Q-Q PNGs to this directory instead of showing interactive plots')
+parser.add_argument('--log_level', default = 'INFO')
 args = parser.parse_args()
 
-# Initialize Memory Pool to 10GB
-cudf.set_allocator(pool=True, initial_pool_size=1e10)
-cp.cuda.set_allocator(rmm.rmm_cupy_allocator)
+logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+backend = set_backend(args.backend)
+print("Backend:", backend.name)
+if backend.name == 'cupy':
+    import rmm
+
+    # Initialize Memory Pool (10GB by default)
+    backend.df.set_allocator(pool=True, initial_pool_size=args.gpu_pool_size)
+    backend.xp.cuda.set_allocator(rmm.rmm_cupy_allocator)
+elif args.threads:
+    set_blas_threads(args.threads)
 
 # Load data
 print("Loading data")
-vcf_df, feature_mapping = gwasio.load_vcf(args.vcf_path, info_keys=["AF"], format_keys=["GT", "DP"])
+vcf_df, feature_mapping = gwasio.load_vcf(args.vcf_path, info_keys=["AF"], format_keys=["GT", "DP"], cache_dir=args.cache_dir)
 print(vcf_df.head())
 print("Loading annotations")
 ann_df = gwasio.load_annotations(args.annotation_path)
@@ -43,33 +65,45 @@ ann_df = gwasio.load_annotations(args.annotation_path)
 t0 = time.time()
 
 # Filter data
-print("Filtering samples")
-vcf_df = gwasfilter.filter_samples(vcf_df)
-print(vcf_df.head())
-print("Filtering variants")
-vcf_df = gwasfilter.filter_variants(vcf_df)
+print("Filtering samples and variants")
+vcf_df = gwasfilter.filter_qc(vcf_df, min_dp_mean=4, min_sample_call_rate=0.95, min_af=0.1, min_variant_call_rate=0.95)
 print(vcf_df.head())
 
+# Coordinates of the filtered variants, looked up by feature id in the results
+variant_coords = VariantIndex.from_table(vcf_df)
+
 # Generate phenotypes dataframe
-phenotypes_df, features = dp.create_phenotype_df(vcf_df, ann_df, ['CaffeineConsumption','isFemale','PurpleHair'], "call_GT",
+phenotypes_df, genotypes, variant_index = dp.create_phenotype_matrix(vcf_df, ann_df, ['CaffeineConsumption','isFemale','PurpleHair'], "call_GT",
                                        vcf_sample_col="sample", ann_sample_col="Sample")
 
-# Run PCA on phenotype dataframe
-phenotypes_df = algos.PCA_concat(phenotypes_df, 3)
+# Run PCA on the genotype matrix
+phenotypes_df = algos.PCA_concat(phenotypes_df, 3, genotypes=genotypes)
 print(phenotypes_df)
 
-# Fit linear regression model for each variant feature
+# Fit linear regression model for each variant feature, all phenotypes in one pass
 print("Fitting linear regression model")
 
-p_value_df = runner.run_gwas(phenotypes_df, 'CaffeineConsumption', features, algos.cuml_LinearReg, add_cols=['PC0', 'PC1'])
+gwas_report = {}
+p_value_df = runner.run_gwas(phenotypes_df, ['CaffeineConsumption', 'isFemale', 'PurpleHair'], variant_index, assoc.LinearAssociation, add_cols=['PC0', 'PC1'], genotypes=genotypes,
+                             memory_budget=args.memory_budget, report=gwas_report, variants=variant_coords,
+                             checkpoint=args.checkpoint_dir, resume=True)
 print(p_value_df)
-
-# Please save_to='manhattan.svg' argument to save the plot. This require firefox installed.
-# conda install -c conda-forge firefox geckodriver
-manhattan_plot = show_manhattan_plot(
-    p_value_df, 
-    'chrom',  
-    'p_value', 'feature', 
-    title='GWAS Manhattan Plot')
+print(gwas_report)
+
+caffeine_df = p_value_df[p_value_df['phenotype'] == 'CaffeineConsumption']
+if args.plot_dir:
+    os.makedirs(args.plot_dir, exist_ok=True)
+    vizstatic.manhattan_plot(caffeine_df, os.path.join(args.plot_dir, 'manhattan.png'))
+    vizstatic.qq_plot(caffeine_df, os.path.join(args.plot_dir, 'qq.png'))
+else:
+    # Please save_to='manhattan.svg' argument to save the plot. This require firefox installed.
+    # conda install -c conda-forge firefox geckodriver
+    manhattan_plot = show_manhattan_plot(
+        caffeine_df, 
+        'chrom', 'pos', 'p_value',
+        title='GWAS Manhattan Plot')
 
 print('Time Elapsed: {}'.format(time.time()- t0))
+
+if args.report:
+    instrument.get_report().to_json(args.report)